@@ -0,0 +1,289 @@
+"""
+Regenerates Gold from the Bronze archive with the current enrichment logic.
+
+Use it after changing data-processing-ccc-iot-2026/lambda_function.py (a new
+status, a new Gold field...), instead of re-firing the S3 events one object at
+a time. For each Bronze day in [--from, --to], in order, it:
+
+    1. lists the Bronze objects of that day (raw_data_*, raw_batch_* and
+       lineage/raw_batch_*, by the date in their key) page by page,
+    2. downloads and parses them in a bounded thread pool (--workers),
+    3. routes and enriches the readings with the Lambda's own code
+       (resolve_lots, enrich_readings, is_status_change), in event-time order,
+    4. writes Gold in bulk: one NDJSON object per lot and event day (split at
+       --max-object-mb), uploaded in parallel under --output-prefix,
+    5. saves a checkpoint, so an interrupted run resumes at the next day.
+
+Only Gold is written: no MQTT alerts, STATUS# items, rollups or change-feed
+versions. Reservation states and lot capacity come from the current DynamoDB
+state (Bronze does not keep them); see BACKFILL_SETUP.md.
+
+Usage:
+    python backfill/backfill.py --from 2026-01-01 --to 2026-03-31
+    python backfill/backfill.py --from 2026-01-01 --to 2026-03-31 --workers 64 --reservations available
+    python backfill/backfill.py --from 2026-02-27 --to 2026-02-27 --dry-run
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.config import Config
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# The processing Lambda imports stage_metrics from the metrics layer
+sys.path.insert(0, os.path.join(ROOT, "metrics-layer", "python"))
+
+BRONZE_BUCKET = "raw-bucket-ccc-iot-2026"
+GOLD_BUCKET = "gold-bucket-ccc-iot-2026"
+STATE_TABLE = "ParkingLotState"
+# Bronze key prefixes; the ingestion date (YYYYMMDD) follows them
+BRONZE_KINDS = ("raw_data_", "raw_batch_", "lineage/raw_batch_")
+CHECKPOINT_VERSION = 1
+
+def load_processing():
+    """Imports the data-processing Lambda, whose enrichment core the backfill reuses."""
+    os.environ.setdefault("METRICS_SAMPLE_RATE", "0")
+    os.environ.setdefault("IOT_ENDPOINT", "unused.invalid")  # Only alerts use it, and the backfill sends none
+    spec = importlib.util.spec_from_file_location(
+        "processing", os.path.join(ROOT, "data-processing-ccc-iot-2026", "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def parse_day(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+def list_bronze_keys(s3, bucket, day):
+    """Keys of the Bronze objects ingested on `day`, following ListObjectsV2 pagination."""
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = []
+    for kind in BRONZE_KINDS:
+        for page in paginator.paginate(Bucket=bucket, Prefix=f"{kind}{day:%Y%m%d}"):
+            keys += [obj["Key"] for obj in page.get("Contents", [])]
+    return keys
+
+def chunk_ndjson(rows, max_bytes):
+    """Serializes rows as NDJSON bodies no larger than max_bytes (one row per line)."""
+    chunks, lines, size = [], [], 0
+    for row in rows:
+        line = json.dumps(row)
+        if lines and size + len(line) + 1 > max_bytes:
+            chunks.append("\n".join(lines) + "\n")
+            lines, size = [], 0
+        lines.append(line)
+        size += len(line) + 1
+    if lines:
+        chunks.append("\n".join(lines) + "\n")
+    return chunks
+
+class LotStates:
+    """METADATA and SPOT# items of each lot, read once per run (Bronze does not keep them)."""
+
+    def __init__(self, table, reservations):
+        self.table = table
+        self.reservations = reservations
+        self.cache = {}
+
+    def get(self, lot_id):
+        if lot_id not in self.cache:
+            meta = self.table.get_item(Key={"LotID": lot_id, "EntityID": "METADATA"}).get("Item", {})
+            spots = {}
+            if self.reservations == "current":
+                query_kwargs = {"KeyConditionExpression": Key("LotID").eq(lot_id) & Key("EntityID").begins_with("SPOT#")}
+                while True:
+                    resp = self.table.query(**query_kwargs)
+                    spots.update({item["EntityID"][len("SPOT#"):]: item for item in resp.get("Items", [])})
+                    if "LastEvaluatedKey" not in resp:
+                        break
+                    query_kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+            self.cache[lot_id] = (meta, spots)
+        return self.cache[lot_id]
+
+class Backfill:
+    def __init__(self, args, processing):
+        self.args = args
+        self.processing = processing
+        # One connection per worker, or the pool becomes the bottleneck
+        self.s3 = boto3.client("s3", config=Config(max_pool_connections=args.workers))
+        processing.s3_client = self.s3
+        self.table = processing.dynamodb.Table(args.table)
+        self.lot_states = LotStates(self.table, args.reservations)
+        self.pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    # -----------------------------
+    # Checkpoint
+    # -----------------------------
+    def run_id(self):
+        args = self.args
+        return {"from": args.date_from, "to": args.date_to, "bronze_bucket": args.bronze_bucket,
+                "gold_bucket": args.gold_bucket, "output_prefix": args.output_prefix, "write_mode": args.write_mode}
+
+    def load_checkpoint(self):
+        path = self.args.checkpoint
+        if self.args.restart or not os.path.exists(path):
+            return {"version": CHECKPOINT_VERSION, "run": self.run_id(), "next_day": self.args.date_from,
+                    "gold_state": {}, "totals": defaultdict(int), "failed_objects": []}
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("run") != self.run_id():
+            sys.exit(f"{path} belongs to another run ({checkpoint.get('run')}). Use --restart or another --checkpoint.")
+        checkpoint["totals"] = defaultdict(int, checkpoint["totals"])
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint):
+        if self.args.dry_run:
+            return
+        # Written to a temporary file first, so an interruption never leaves a truncated checkpoint
+        tmp_path = self.args.checkpoint + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.args.checkpoint)
+
+    # -----------------------------
+    # One Bronze day
+    # -----------------------------
+    def fetch(self, key):
+        try:
+            return key, self.processing.read_bronze_readings(self.args.bronze_bucket, key)
+        except Exception as e:
+            print(f"Error reading {key}: {e}")
+            return key, None
+
+    def enrich(self, readings, gold_state, stats):
+        """Routes and enriches one day's readings. Returns {gold partition prefix: [gold payloads]}."""
+        processing = self.processing
+        args = self.args
+        lot_by_device = processing.resolve_lots(self.table, {r.get("device_id") for r in readings}, args.default_lot)
+        readings_by_lot = defaultdict(list)
+        for raw_payload in readings:
+            readings_by_lot[lot_by_device[raw_payload.get("device_id")]].append(raw_payload)
+
+        rows_by_partition = defaultdict(list)
+        for lot_id, lot_readings in readings_by_lot.items():
+            meta_item, spot_items = self.lot_states.get(lot_id)
+            lot_physical_capacity = int(meta_item.get("TotalCapacity", 14))
+            lot_usable_spaces = lot_physical_capacity - int(meta_item.get("SpotsUnderRepair", 0))
+            lot_gold_state = gold_state.setdefault(lot_id, {})
+            prefix = args.output_prefix + processing.gold_lot_prefix(lot_id)
+
+            # Event-time order, as in the Lambda, so status transitions are detected correctly
+            ordered = sorted(lot_readings, key=lambda r: r.get("timestamp") or "")
+            for result in processing.enrich_readings(ordered, spot_items, lot_physical_capacity, lot_usable_spaces):
+                if isinstance(result, Exception):
+                    stats["invalid_readings"] += 1
+                    continue
+                gold_payload, event_epoch = result
+                if args.write_mode == "transitions" and not processing.is_status_change(
+                        lot_gold_state, gold_payload["sensor_id"], gold_payload["status"],
+                        gold_payload["event_timestamp"], event_epoch, args.heartbeat_seconds):
+                    continue
+                rows_by_partition[processing.build_gold_key(prefix, gold_payload, "")].append(gold_payload)
+        return rows_by_partition
+
+    def put(self, upload):
+        key, body = upload
+        self.s3.put_object(Bucket=self.args.gold_bucket, Key=key, Body=body.encode("utf-8"),
+                           ContentType="application/json")
+        return len(body)
+
+    def run_day(self, day, checkpoint):
+        started = time.perf_counter()
+        stats = defaultdict(int)
+
+        # 1-2. List and download the day's Bronze objects in parallel
+        keys = list_bronze_keys(self.s3, self.args.bronze_bucket, day)
+        readings = []
+        for key, payloads in self.pool.map(self.fetch, keys):
+            if payloads is None:
+                checkpoint["failed_objects"].append(key)
+                stats["failed_objects"] += 1
+            else:
+                readings += payloads
+        stats["bronze_objects"] = len(keys)
+        stats["readings"] = len(readings)
+
+        # 3. Enrich with the Lambda's code. The transition state is only committed with the checkpoint.
+        gold_state = json.loads(json.dumps(checkpoint["gold_state"]))
+        rows_by_partition = self.enrich(readings, gold_state, stats) if readings else {}
+
+        # 4. Bulk Gold writes; deterministic keys, so redoing a day overwrites instead of duplicating
+        max_bytes = int(self.args.max_object_mb * 1024 * 1024)
+        uploads = []
+        for partition, rows in sorted(rows_by_partition.items()):
+            stats["gold_rows"] += len(rows)
+            for n, body in enumerate(chunk_ndjson(rows, max_bytes)):
+                uploads.append((f"{partition}backfill_{day:%Y%m%d}_{n:04d}.json", body))
+        stats["gold_objects"] = len(uploads)
+        if not self.args.dry_run:
+            stats["gold_bytes"] = sum(self.pool.map(self.put, uploads))
+
+        # 5. Checkpoint: the next run starts at the following day
+        checkpoint["gold_state"] = gold_state
+        checkpoint["next_day"] = (day + timedelta(days=1)).isoformat()
+        for name, value in stats.items():
+            checkpoint["totals"][name] += value
+        self.save_checkpoint(checkpoint)
+
+        elapsed = time.perf_counter() - started
+        print(f"[{day}] {stats['bronze_objects']} Bronze objects, {stats['readings']} readings -> "
+              f"{stats['gold_rows']} Gold rows in {stats['gold_objects']} objects "
+              f"({stats['failed_objects']} unreadable, {stats['invalid_readings']} invalid) "
+              f"in {elapsed:.1f}s ({stats['readings'] / elapsed if elapsed else 0:.0f} readings/s)")
+
+    def run(self):
+        checkpoint = self.load_checkpoint()
+        day = parse_day(checkpoint["next_day"])
+        last = parse_day(self.args.date_to)
+        if day > last:
+            print(f"Nothing to do: {self.args.checkpoint} says the run already finished (use --restart to redo it).")
+        while day <= last:
+            self.run_day(day, checkpoint)
+            day += timedelta(days=1)
+
+        totals = checkpoint["totals"]
+        print(f"Done: {totals['readings']} readings, {totals['gold_rows']} Gold rows in {totals['gold_objects']} objects"
+              f" under s3://{self.args.gold_bucket}/{self.args.output_prefix}")
+        if checkpoint["failed_objects"]:
+            print(f"{len(checkpoint['failed_objects'])} Bronze objects could not be read (listed in the checkpoint).")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--from", dest="date_from", required=True, help="first Bronze day (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", required=True, help="last Bronze day, inclusive (YYYY-MM-DD)")
+    parser.add_argument("--bronze-bucket", default=BRONZE_BUCKET)
+    parser.add_argument("--gold-bucket", default=os.environ.get("GOLD_BUCKET_NAME", GOLD_BUCKET))
+    parser.add_argument("--output-prefix", default="backfill/",
+                        help="written under this prefix of the Gold bucket ('' = in place, see BACKFILL_SETUP.md)")
+    parser.add_argument("--table", default=os.environ.get("DYNAMODB_TABLE_NAME", STATE_TABLE))
+    parser.add_argument("--default-lot", default=os.environ.get("LOT_ID", "LOT#pi-zone-A"),
+                        help="lot of the readings without a device_id")
+    parser.add_argument("--reservations", choices=["current", "available"], default="current",
+                        help="enrich with today's SPOT# reservation states, or as if every spot were AVAILABLE")
+    parser.add_argument("--write-mode", choices=["transitions", "all"],
+                        default=os.environ.get("GOLD_WRITE_MODE", "transitions").lower(),
+                        help="like GOLD_WRITE_MODE: only status changes, or every reading")
+    parser.add_argument("--heartbeat-seconds", type=int, default=int(os.environ.get("GOLD_HEARTBEAT_SECONDS", "0")))
+    parser.add_argument("--workers", type=int, default=32, help="parallel S3 downloads and uploads")
+    parser.add_argument("--max-object-mb", type=float, default=64.0, help="size cap of each Gold object")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start at --from")
+    parser.add_argument("--dry-run", action="store_true", help="read and enrich, but write nothing")
+    args = parser.parse_args()
+
+    if parse_day(args.date_from) > parse_day(args.date_to):
+        parser.error("--from must not be after --to")
+    if args.output_prefix and not args.output_prefix.endswith("/"):
+        args.output_prefix += "/"
+
+    Backfill(args, load_processing()).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""
+In-memory stand-ins for the AWS services used by the Lambdas (S3, DynamoDB,
+IoT Data, Athena and Secrets Manager).
+
+They implement only the calls and expression forms the Lambdas actually use,
+count every call per service and operation, and can optionally sleep on each
+call to simulate network latency. Used by benchmarks/pipeline_bench.py.
+"""
+import io
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from collections import Counter
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+
+class CallLog:
+    """Counts AWS calls per (stage, service, operation). Thread-safe."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.stage = "setup"
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, service, operation):
+        with self._lock:
+            self.counts[(self.stage, service, operation)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def by_stage(self, stage):
+        return {f"{service}.{op}": n for (s, service, op), n in sorted(self.counts.items()) if s == stage}
+
+def _client_error(code, operation, **extra):
+    return ClientError({"Error": {"Code": code, "Message": code}, **extra}, operation)
+
+# -----------------------------
+# S3
+# -----------------------------
+class FakeS3:
+    """Keeps the bodies of the buckets listed in `readable_buckets` only; other puts are just counted."""
+
+    def __init__(self, log, readable_buckets=()):
+        self.log = log
+        self.readable_buckets = set(readable_buckets)
+        self.objects = {}
+        self.puts = Counter()  # bucket -> objects written
+        self.created = []  # (bucket, key) in creation order, drained by the driver
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.log.record("s3", "PutObject")
+        data = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+        with self._lock:
+            if Bucket in self.readable_buckets:
+                self.objects[(Bucket, Key)] = data
+            self.puts[Bucket] += 1
+            self.created.append((Bucket, Key))
+        return {"ETag": uuid.uuid4().hex}
+
+    def delete(self, bucket, key):
+        self.objects.pop((bucket, key), None)
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.log.record("s3", "GetObject")
+        if (Bucket, Key) not in self.objects:
+            raise _client_error("NoSuchKey", "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def drain_created(self):
+        with self._lock:
+            created, self.created = self.created, []
+        return created
+
+# -----------------------------
+# DynamoDB
+# -----------------------------
+_COMPARISON = re.compile(r"^(\w+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)$")
+_FUNCTION = re.compile(r"^(attribute_exists|attribute_not_exists)\((\w+)\)$")
+
+def _compare(left, operator, right):
+    if left is None:
+        return operator == "<>"
+    return {
+        "=": left == right, "<>": left != right,
+        "<": left < right, "<=": left <= right,
+        ">": left > right, ">=": left >= right,
+    }[operator]
+
+def evaluate_condition(expression, item, values):
+    """Evaluates the ConditionExpression strings used by the Lambdas (OR/AND of simple terms)."""
+    for alternative in re.split(r"\s+OR\s+", expression.strip()):
+        if all(_evaluate_term(term, item, values) for term in re.split(r"\s+AND\s+", alternative)):
+            return True
+    return False
+
+def _evaluate_term(term, item, values):
+    term = term.strip()
+    if term.startswith("(") and term.endswith(")"):
+        term = term[1:-1].strip()
+    match = _FUNCTION.match(term)
+    if match:
+        exists = item is not None and match.group(2) in item
+        return exists if match.group(1) == "attribute_exists" else not exists
+    match = _COMPARISON.match(term)
+    if match:
+        return _compare((item or {}).get(match.group(1)), match.group(2), values[match.group(3)])
+    raise NotImplementedError(f"Unsupported condition: {term}")
+
+def substitute_names(expression, names):
+    """Replaces #placeholders with their ExpressionAttributeNames."""
+    if not expression or not names:
+        return expression
+    return re.sub(r"#\w+", lambda m: names.get(m.group(0), m.group(0)), expression)
+
+def apply_update(item, expression, values):
+    """Applies SET / ADD / REMOVE clauses to item in place."""
+    clauses = re.findall(r"(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)", expression.strip())
+    for action, body in clauses:
+        for part in (p.strip() for p in body.split(",") if p.strip()):
+            if action == "SET":
+                name, value = (x.strip() for x in part.split("=", 1))
+                item[name] = _set_value(item, value, values)
+            elif action == "ADD":
+                name, value = part.split()
+                item[name] = item.get(name, 0) + values[value]
+            else:
+                item.pop(part, None)
+
+def _set_value(item, value, values):
+    # "if_not_exists(a, :x) + :y" and "a + :y" are the only arithmetic forms used
+    total = None
+    for operand in (o.strip() for o in value.split("+")):
+        match = re.match(r"if_not_exists\((\w+),\s*(:\w+)\)", operand)
+        if match:
+            current = item.get(match.group(1), values[match.group(2)])
+        elif operand.startswith(":"):
+            current = values[operand]
+        else:
+            current = item.get(operand)
+        total = current if total is None else total + current
+    return total
+
+def _normalize(value):
+    """Mimics boto3: numbers come back as Decimal."""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    return value
+
+class FakeTable:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.key_names = db.key_schemas.get(name, ("LotID", "EntityID"))
+
+    @property
+    def items(self):
+        return self.db.tables.setdefault(self.name, {})
+
+    def _key(self, key):
+        return tuple(key[k] for k in self.key_names)
+
+    def get_item(self, Key, **kwargs):
+        self.db.log.record("dynamodb", "GetItem")
+        item = self.items.get(self._key(Key))
+        return {"Item": dict(item)} if item else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        self.db.log.record("dynamodb", "PutItem")
+        with self.db.lock:
+            current = self.items.get(self._key(Item))
+            if ConditionExpression and not evaluate_condition(ConditionExpression, current, ExpressionAttributeValues or {}):
+                raise _client_error("ConditionalCheckFailedException", "PutItem")
+            self.items[self._key(Item)] = _normalize(dict(Item))
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ConditionExpression=None,
+                    ReturnValues="NONE", ExpressionAttributeNames=None, **kwargs):
+        self.db.log.record("dynamodb", "UpdateItem")
+        names = ExpressionAttributeNames or {}
+        return self.db.update(self.name, Key, substitute_names(UpdateExpression, names), ExpressionAttributeValues or {},
+                              substitute_names(ConditionExpression, names), ReturnValues)
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, Limit=None, ScanIndexForward=True,
+              FilterExpression=None, **kwargs):
+        self.db.log.record("dynamodb", "Query")
+        matches = [
+            dict(item) for key, item in sorted(self.items.items(), reverse=not ScanIndexForward)
+            if _match_key_condition(KeyConditionExpression, item)
+            and (FilterExpression is None or _match_key_condition(FilterExpression, item))
+        ]
+        if ExclusiveStartKey:
+            start = self._key(ExclusiveStartKey)
+            keys = [self._key(m) for m in matches]
+            matches = matches[keys.index(start) + 1:] if start in keys else matches
+        response = {"Items": matches[:Limit] if Limit else matches}
+        if Limit and len(matches) > Limit:
+            response["LastEvaluatedKey"] = {k: matches[Limit - 1][k] for k in self.key_names}
+        return response
+
+def _match_key_condition(condition, item):
+    """Evaluates boto3.dynamodb.conditions Key/Attr objects (eq, begins_with, between, comparisons, &)."""
+    expression = condition.get_expression()
+    operator, operands = expression["operator"], expression["values"]
+    if operator == "AND":
+        return all(_match_key_condition(c, item) for c in operands)
+    value = item.get(operands[0].name)
+    if value is None:
+        return False
+    if operator == "begins_with":
+        return str(value).startswith(operands[1])
+    if operator == "BETWEEN":
+        return operands[1] <= value <= operands[2]
+    return _compare(value, operator, operands[1])
+
+class _FakeDynamoClient:
+    """Low-level client (dynamodb.meta.client) for transact_write_items."""
+
+    def __init__(self, db):
+        self.db = db
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def transact_write_items(self, TransactItems):
+        self.db.log.record("dynamodb", "TransactWriteItems")
+        decode = lambda attrs: {k: self.deserializer.deserialize(v) for k, v in (attrs or {}).items()}
+        with self.db.lock:
+            reasons, failed = [], False
+            for action in TransactItems:
+                (kind, spec), = action.items()
+                table = self.db.Table(spec["TableName"])
+                current = table.items.get(table._key(decode(spec.get("Key") or spec["Item"])))
+                condition = spec.get("ConditionExpression")
+                if condition and not evaluate_condition(condition, current, decode(spec.get("ExpressionAttributeValues"))):
+                    reason = {"Code": "ConditionalCheckFailed"}
+                    if spec.get("ReturnValuesOnConditionCheckFailure") == "ALL_OLD" and current:
+                        reason["Item"] = {k: self.serializer.serialize(v) for k, v in current.items()}
+                    reasons.append(reason)
+                    failed = True
+                else:
+                    reasons.append({"Code": "None"})
+            if failed:
+                raise _client_error("TransactionCanceledException", "TransactWriteItems", CancellationReasons=reasons)
+
+            for action in TransactItems:
+                (kind, spec), = action.items()
+                if kind == "Update":
+                    self.db.update(spec["TableName"], decode(spec["Key"]), spec["UpdateExpression"],
+                                   decode(spec.get("ExpressionAttributeValues")), None, "NONE", locked=True)
+                elif kind == "Put":
+                    table = self.db.Table(spec["TableName"])
+                    item = decode(spec["Item"])
+                    table.items[table._key(item)] = item
+        return {}
+
+class FakeDynamoDB:
+    """Stand-in for boto3.resource('dynamodb'). Tables are created on first use."""
+
+    def __init__(self, log, key_schemas=None):
+        self.log = log
+        self.key_schemas = key_schemas or {}
+        self.tables = {}
+        self.lock = threading.RLock()
+        self.meta = type("Meta", (), {})()
+        self.meta.client = _FakeDynamoClient(self)
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+    def update(self, table_name, key, expression, values, condition, return_values, locked=False):
+        table = self.Table(table_name)
+        with self.lock:
+            current = table.items.get(table._key(key))
+            if condition and not evaluate_condition(condition, current, values):
+                raise _client_error("ConditionalCheckFailedException", "UpdateItem")
+            old = dict(current) if current else None
+            item = dict(current) if current else dict(key)
+            apply_update(item, expression, _normalize(values))
+            table.items[table._key(key)] = item
+        if return_values == "ALL_OLD":
+            return {"Attributes": old} if old else {}
+        if return_values in ("ALL_NEW", "UPDATED_NEW"):
+            return {"Attributes": dict(item)}
+        return {}
+
+    def batch_get_item(self, RequestItems):
+        self.log.record("dynamodb", "BatchGetItem")
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            found = (table.items.get(table._key(key)) for key in request["Keys"])
+            responses[table_name] = [dict(item) for item in found if item]
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def item_count(self):
+        return sum(len(items) for items in self.tables.values())
+
+# -----------------------------
+# IoT Data, Athena, Secrets Manager
+# -----------------------------
+class FakeIoTData:
+    def __init__(self, log):
+        self.log = log
+        self.messages = Counter()
+
+    def publish(self, topic, qos=0, payload=b"", **kwargs):
+        self.log.record("iot-data", "Publish")
+        self.messages[topic] += 1
+        return {}
+
+class FakeAthena:
+    """Every query succeeds on its first poll and returns up to max_rows synthetic Gold rows (fewer if it has a LIMIT)."""
+
+    def __init__(self, log, columns, max_rows=100):
+        self.log = log
+        self.columns = columns
+        self.max_rows = max_rows
+        self.queries = {}
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.log.record("athena", "StartQueryExecution")
+        query_id = str(uuid.uuid4())
+        limit = re.search(r"\bLIMIT\s+(\d+)", QueryString, re.IGNORECASE)
+        self.queries[query_id] = min(self.max_rows, int(limit.group(1))) if limit else self.max_rows
+        return {"QueryExecutionId": query_id}
+
+    def get_query_execution(self, QueryExecutionId):
+        self.log.record("athena", "GetQueryExecution")
+        state = "SUCCEEDED" if QueryExecutionId in self.queries else "FAILED"
+        return {"QueryExecution": {"Status": {"State": state},
+                                   "Statistics": {"DataScannedInBytes": 0, "EngineExecutionTimeInMillis": 0,
+                                                  "QueryQueueTimeInMillis": 0}}}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.log.record("athena", "BatchGetQueryExecution")
+        executions = []
+        for query_id in QueryExecutionIds:
+            state = "SUCCEEDED" if query_id in self.queries else "FAILED"
+            executions.append({"QueryExecutionId": query_id, "Status": {"State": state},
+                               "Statistics": {"DataScannedInBytes": 0, "EngineExecutionTimeInMillis": 0,
+                                              "QueryQueueTimeInMillis": 0}})
+        return {"QueryExecutions": executions, "UnprocessedQueryExecutionIds": []}
+
+    def get_query_results(self, QueryExecutionId, MaxResults=1000, NextToken=None):
+        self.log.record("athena", "GetQueryResults")
+        total = self.queries[QueryExecutionId]
+        start = int(NextToken or 0)
+        rows = [] if NextToken else [{"Data": [{"VarCharValue": c} for c in self.columns]}]
+        end = min(total, start + MaxResults - len(rows))
+        for i in range(start, end):
+            rows.append({"Data": [{"VarCharValue": f"{c}-{i}"} for c in self.columns]})
+        result = {"ResultSet": {"ResultSetMetadata": {"ColumnInfo": [{"Name": c} for c in self.columns]}, "Rows": rows}}
+        if end < total:
+            result["NextToken"] = str(end)
+        return result
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.log.record("athena", "StopQueryExecution")
+        return {}
+
+class FakeSecretsManager:
+    def __init__(self, log):
+        self.log = log
+
+    def get_secret_value(self, SecretId):
+        self.log.record("secretsmanager", "GetSecretValue")
+        return {"SecretString": '{"api_key": "fake"}'}
+
+class FakeAgent:
+    """Stand-in for pydantic_ai.Agent: answers instantly, SQL for SQL prompts and a sentence otherwise."""
+    log = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def run_sync(self, prompt):
+        if FakeAgent.log:
+            FakeAgent.log.record("llm", "RunSync")
+        if "Generate a SQL query" in prompt:
+            output = "SELECT sensor_id, status FROM iot_data.gold_bucket_ccc_iot_2026 LIMIT 20"
+        else:
+            output = "spot-01 and spot-02 are free."
+        usage = types.SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(output) // 4)
+        return types.SimpleNamespace(output=output, usage=lambda: usage)
+
+def install_fake_llm(log):
+    """Makes `from pydantic_ai import Agent` return FakeAgent (keeps the real import cost when installed)."""
+    FakeAgent.log = log
+    try:
+        import pydantic_ai
+        pydantic_ai.Agent = FakeAgent
+    except ImportError:
+        sys.modules["pydantic_ai"] = types.SimpleNamespace(Agent=FakeAgent)
@@ -0,0 +1,113 @@
+"""
+Cold-start benchmark for the lookup Lambda.
+
+Each measurement runs in a fresh Python process (like a new Lambda container):
+it times the import of lookup-ccc-iot-2026/lambda_function.py, the first request
+of the selected mode (cold) and a second identical request (warm).
+
+By default AWS calls are replaced with instant in-process fakes so that only the
+Lambda's own overhead is measured. Use --live to hit the real AWS services with
+your current credentials.
+
+Usage:
+    python benchmarks/lookup_startup.py                # filters, latest and llm modes
+    python benchmarks/lookup_startup.py --modes filters --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lookup-ccc-iot-2026")
+
+REQUESTS = {
+    "filters": {"queryStringParameters": {"mode": "filters", "device_id": "pi-zone-A", "limit": "10"}},
+    "latest": {"queryStringParameters": {"mode": "filters", "latest": "true"}},
+    "llm": {"queryStringParameters": {"mode": "llm", "prompt": "Where can I park right now?"}},
+}
+
+# Code executed inside the child process
+CHILD = r'''
+import json, os, sys, time, types
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, sys.argv[1])
+sys.path.insert(0, os.path.join(sys.argv[1], "..", "metrics-layer", "python"))
+event = json.loads(sys.argv[2])
+live = sys.argv[3] == "1"
+
+t0 = time.perf_counter()
+import lambda_function as lf
+t1 = time.perf_counter()
+pydantic_at_import = "pydantic_ai" in sys.modules
+
+if not live:
+    class FakeAthena:
+        def start_query_execution(self, **kw): return {"QueryExecutionId": "00000000-0000-0000-0000-000000000000"}
+        def get_query_execution(self, **kw): return {"QueryExecution": {"Status": {"State": "SUCCEEDED"}}}
+        def get_query_results(self, **kw):
+            return {"ResultSet": {"ResultSetMetadata": {"ColumnInfo": [{"Name": "sensor_id"}]},
+                                  "Rows": [{"Data": [{"VarCharValue": "sensor_id"}]}, {"Data": [{"VarCharValue": "spot-01"}]}]}}
+    class FakeTable:
+        def query(self, **kw): return {"Items": [{"Record": {"sensor_id": "spot-01", "status": "FREE"}}]}
+        def get_item(self, **kw): return {}
+        def put_item(self, **kw): return {}
+    class FakeDynamo:
+        def Table(self, name): return FakeTable()
+    class FakeSecrets:
+        def get_secret_value(self, **kw): return {"SecretString": json.dumps({"api_key": "fake"})}
+    class FakeAgent:
+        def __init__(self, *a, **k): pass
+        def run_sync(self, prompt): return types.SimpleNamespace(output="SELECT 1")
+    lf.athena, lf.dynamodb, lf._secrets_client = FakeAthena(), FakeDynamo(), FakeSecrets()
+    try:
+        import pydantic_ai
+        pydantic_ai.Agent = FakeAgent  # Keeps the real import cost, skips the network call
+    except ImportError:
+        sys.modules["pydantic_ai"] = types.SimpleNamespace(Agent=FakeAgent)
+
+t2 = time.perf_counter()
+first = lf.lambda_handler(event, None)
+t3 = time.perf_counter()
+lf.lambda_handler(event, None)
+t4 = time.perf_counter()
+
+print(json.dumps({
+    "import_ms": (t1 - t0) * 1000,
+    "first_ms": (t3 - t2) * 1000,
+    "warm_ms": (t4 - t3) * 1000,
+    "status": first["statusCode"],
+    "pydantic_at_import": pydantic_at_import,
+    "agent_built": lf._agent is not None,
+}))
+'''
+
+def run_once(mode, live):
+    env = dict(os.environ)
+    proc = subprocess.run(
+        [sys.executable, "-c", CHILD, LAMBDA_DIR, json.dumps(REQUESTS[mode]), "1" if live else "0"],
+        capture_output=True, text=True, env=env
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"{mode} run failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=sorted(REQUESTS), default=["filters", "latest", "llm"])
+    parser.add_argument("--runs", type=int, default=3, help="fresh processes per mode (default 3)")
+    parser.add_argument("--live", action="store_true", help="call real AWS services instead of fakes")
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'import ms':>10} {'1st req ms':>11} {'warm ms':>9}  {'pydantic_ai at import':>21}  {'agent built':>11}  HTTP")
+    for mode in args.modes:
+        samples = [run_once(mode, args.live) for _ in range(args.runs)]
+        print(f"{mode:<8} "
+              f"{statistics.median(s['import_ms'] for s in samples):>10.1f} "
+              f"{statistics.median(s['first_ms'] for s in samples):>11.1f} "
+              f"{statistics.median(s['warm_ms'] for s in samples):>9.1f}  "
+              f"{str(samples[-1]['pydantic_at_import']):>21}  {str(samples[-1]['agent_built']):>11}  {samples[-1]['status']}")
+
+if __name__ == "__main__":
+    main()
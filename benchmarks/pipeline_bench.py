@@ -0,0 +1,318 @@
+"""
+Offline end-to-end benchmark of the parking pipeline.
+
+Drives the four Lambda handlers (ingestion, processing, modify-state and
+lookup) in-process against the in-memory AWS stand-ins of fake_aws.py, fed by
+the synthetic readings of synthetic_load.py:
+
+    SQS batch -> ingestion -> Bronze -> S3 event -> processing -> Gold / DynamoDB / MQTT
+    (or, with --path sqs, SQS batch -> processing directly)
+
+One deployment serves every lot: SQS batches mix the readings of all lots
+(--per-lot-batches gives each lot its own batches instead). Every --modify-every
+batches an operator request goes to modify-state, and every --lookup-every
+batches a dashboard request (filters, latest, routed llm or stats) goes to
+lookup, each for a random lot. Nothing leaves the machine: the LLM is replaced by an instant fake too.
+
+It reports the reading throughput, latency percentiles per stage (per handler
+invocation) and the AWS calls per reading / per request, so a change that adds
+a round trip or slows a handler shows up before deploy. Use --latency-ms to add
+a fixed delay to every AWS call and see how round trips turn into wall time.
+
+Usage:
+    python benchmarks/pipeline_bench.py                              # ~50k readings
+    python benchmarks/pipeline_bench.py --lots 100 --hours 6         # ~1M readings
+    python benchmarks/pipeline_bench.py --path sqs --bronze-batch --json
+    python benchmarks/pipeline_bench.py --envelope snapshot          # one message per device and round
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# The Lambdas import stage_metrics from the metrics layer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "metrics-layer", "python"))
+
+import fake_aws  # noqa: E402
+import synthetic_load  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BRONZE_BUCKET = "raw-bucket-ccc-iot-2026"
+GOLD_BUCKET = "gold-bucket-ccc-iot-2026"
+STATE_TABLE = "ParkingLotState"
+CACHE_TABLE = "LookupQueryCache"
+
+LOOKUP_REQUESTS = [
+    ("filters", lambda device_id: {"mode": "filters", "device_id": device_id, "date": "2026-02-27", "limit": "50"}),
+    ("latest", lambda device_id: {"mode": "filters", "latest": "true", "fields": "sensor_id,status,event_time",
+                                  "format": "columnar"}),
+    ("llm", lambda device_id: {"mode": "llm", "prompt": "Where can I park right now?"}),
+    ("stats", lambda device_id: {"mode": "stats", "date": "2026-02-27", "granularity": "day"}),
+    ("changes", lambda device_id: {"mode": "changes", "since": "1", "fields": "sensor_id,status,event_time",
+                                   "format": "columnar"}),
+    ("dashboard", lambda device_id: {"mode": "dashboard", "views": "latest,history,violations",
+                                     "date": "2026-02-27", "limit": "50", "format": "columnar"}),
+]
+
+def lot_id_for(device_id):
+    return f"LOT#{device_id}"
+
+def load_lambda(directory, name):
+    """Imports <directory>/lambda_function.py under its own module name."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, directory, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+class Pipeline:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.log = fake_aws.CallLog(args.latency_ms)
+        self.s3 = fake_aws.FakeS3(self.log, readable_buckets=[BRONZE_BUCKET])
+        self.dynamodb = fake_aws.FakeDynamoDB(self.log, {CACHE_TABLE: ("CacheKey",)})
+        self.iot = fake_aws.FakeIoTData(self.log)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.readings = 0
+        self.messages = 0
+        self.message_seq = 0
+
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        os.environ.update({
+            "IOT_ENDPOINT": "localhost",
+            "BRONZE_BUCKET_NAME": BRONZE_BUCKET,
+            "GOLD_BUCKET_NAME": GOLD_BUCKET,
+            "DYNAMODB_TABLE_NAME": STATE_TABLE,
+            "BRONZE_BATCH_MODE": "true" if args.bronze_batch else "false",
+            "BRONZE_COMPRESSION": "gzip" if args.gzip else "none",
+        })
+        if args.shared_cache:
+            os.environ["QUERY_CACHE_TABLE"] = CACHE_TABLE
+
+        with self.quiet():
+            self.ingestion = load_lambda("data-ingestion-ccc-iot-2026", "bench_ingestion")
+            self.processing = load_lambda("data-processing-ccc-iot-2026", "bench_processing")
+            self.modify = load_lambda("modify-state-ccc-iot-2026", "bench_modify_state")
+            self.lookup = load_lambda("lookup-ccc-iot-2026", "bench_lookup")
+
+        self.ingestion.s3_client = self.s3
+        self.processing.s3_client = self.s3
+        self.processing.dynamodb = self.dynamodb
+        self.processing.iot_client = self.iot
+        self.modify.dynamodb = self.dynamodb
+        self.lookup.dynamodb = self.dynamodb
+        self.lookup.athena = fake_aws.FakeAthena(self.log, self.lookup.GOLD_COLUMNS, args.athena_rows)
+        self.lookup._secrets_client = fake_aws.FakeSecretsManager(self.log)
+        fake_aws.install_fake_llm(self.log)
+
+        # Lot metadata, as created by hand in the DynamoDB setup
+        table = self.dynamodb.Table(STATE_TABLE)
+        for lot in range(args.lots):
+            table.put_item(Item={"LotID": lot_id_for(synthetic_load.lot_device_id(lot)), "EntityID": "METADATA",
+                                 "TotalCapacity": args.spots, "SpotsUnderRepair": 0})
+
+    @contextlib.contextmanager
+    def quiet(self):
+        if self.args.verbose:
+            yield
+            return
+        with contextlib.redirect_stdout(io.StringIO()) as buffer:
+            yield
+            buffer.truncate(0)
+
+    def invoke(self, stage, handler, event):
+        self.log.stage = stage
+        start = time.perf_counter()
+        try:
+            with self.quiet():
+                response = handler(event, None)
+        except Exception as e:
+            self.errors[stage] += 1
+            print(f"[DEBUG] {stage} raised {type(e).__name__}: {e}", file=sys.stderr)
+            response = None
+        self.latencies[stage].append((time.perf_counter() - start) * 1000.0)
+        if isinstance(response, dict) and response.get("statusCode", 200) >= 500:
+            self.errors[stage] += 1
+        return response
+
+    # -----------------------------
+    # Stages
+    # -----------------------------
+    def sqs_event(self, messages):
+        records = []
+        for message in messages:
+            self.message_seq += 1
+            records.append({
+                "messageId": f"{self.message_seq:012d}-0000-4000-8000-000000000000",
+                "body": json.dumps(message),
+                "eventSource": "aws:sqs",
+            })
+        return {"Records": records}
+
+    def run_batch(self, messages):
+        event = self.sqs_event(messages)
+
+        if self.args.path == "sqs":
+            self.invoke("processing", self.processing.lambda_handler, event)
+            self.s3.drain_created()
+        else:
+            self.invoke("ingestion", self.ingestion.lambda_handler, event)
+            bronze_keys = [key for bucket, key in self.s3.drain_created() if bucket == BRONZE_BUCKET]
+            for key in bronze_keys:
+                # S3 sends one notification per object
+                s3_event = {"Records": [{"s3": {"bucket": {"name": BRONZE_BUCKET}, "object": {"key": key}}}]}
+                self.invoke("processing", self.processing.lambda_handler, s3_event)
+                self.s3.drain_created()
+                self.s3.delete(BRONZE_BUCKET, key)  # Keeps memory flat on million-reading runs
+        self.messages += len(messages)
+        self.readings += sum(len(message["readings"]) if "readings" in message else 1 for message in messages)
+
+    def run_modify(self):
+        device_id = synthetic_load.lot_device_id(self.rng.randrange(self.args.lots))
+        spots = self.rng.sample(range(1, self.args.spots + 1), min(self.args.bulk_size, self.args.spots))
+        changes = [{"sensor_id": f"spot-{s:02d}", "state": self.rng.choice(["AVAILABLE", "BOOKED", "MAINTENANCE"])}
+                   for s in spots]
+        body = {"changes": changes} if len(changes) > 1 else changes[0]
+        body["lot"] = device_id
+        self.invoke("modify-state", self.modify.lambda_handler, {"httpMethod": "POST", "body": json.dumps(body)})
+
+    def run_lookup(self, counter):
+        kind, build = LOOKUP_REQUESTS[counter % len(LOOKUP_REQUESTS)]
+        device_id = synthetic_load.lot_device_id(self.rng.randrange(self.args.lots))
+        params = dict(build(device_id), lot=device_id)
+        self.invoke(f"lookup:{kind}", self.lookup.lambda_handler, {"queryStringParameters": params})
+
+    def run(self):
+        args = self.args
+        buffers = defaultdict(list)
+        batches = 0
+        start = time.perf_counter()
+
+        if args.envelope == "none":
+            messages = synthetic_load.generate_readings(args.lots, args.spots, args.hours, args.interval,
+                                                        seed=args.seed, max_readings=args.max_readings)
+        else:
+            # One multi-sensor envelope per device and report round
+            messages = synthetic_load.generate_envelopes(args.lots, args.spots, args.hours, args.interval,
+                                                         seed=args.seed, max_readings=args.max_readings,
+                                                         kind=args.envelope)
+
+        # One shared queue for all lots, or one per lot with --per-lot-batches
+        for message in messages:
+            queue = message["device_id"] if args.per_lot_batches else None
+            buffer = buffers[queue]
+            buffer.append(message)
+            if len(buffer) < args.batch_size:
+                continue
+            self.run_batch(buffer)
+            buffers[queue] = []
+            batches += 1
+            if args.modify_every and batches % args.modify_every == 0:
+                self.run_modify()
+            if args.lookup_every and batches % args.lookup_every == 0:
+                self.run_lookup(batches // args.lookup_every)
+
+        for buffer in buffers.values():
+            if buffer:
+                self.run_batch(buffer)
+
+        self.elapsed = time.perf_counter() - start
+
+    # -----------------------------
+    # Report
+    # -----------------------------
+    def report(self):
+        pipeline_ms = sum(sum(self.latencies.get(s, [])) for s in ("ingestion", "processing"))
+        stages = {}
+        for stage, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            per_reading = stage in ("ingestion", "processing")
+            divisor = self.readings if per_reading else len(values)
+            stages[stage] = {
+                "invocations": len(values),
+                "errors": self.errors.get(stage, 0),
+                "p50_ms": round(percentile(values, 50), 3),
+                "p95_ms": round(percentile(values, 95), 3),
+                "p99_ms": round(percentile(values, 99), 3),
+                "max_ms": round(values[-1], 3),
+                "calls_per": "reading" if per_reading else "request",
+                "aws_calls": {op: round(n / max(divisor, 1), 4) for op, n in self.log.by_stage(stage).items()},
+            }
+        return {
+            "config": vars(self.args),
+            "readings": self.readings,
+            "messages": self.messages,
+            "wall_seconds": round(self.elapsed, 3),
+            "readings_per_second": round(self.readings / self.elapsed, 1) if self.elapsed else 0.0,
+            "pipeline_ms_per_reading": round(pipeline_ms / max(self.readings, 1), 4),
+            "gold_objects": self.s3.puts[GOLD_BUCKET],
+            "mqtt_messages": sum(self.iot.messages.values()),
+            "dynamodb_items": self.dynamodb.item_count(),
+            "stages": stages,
+        }
+
+def print_report(report):
+    print(f"Readings: {report['readings']} ({report['messages']} messages)  wall: {report['wall_seconds']}s  "
+          f"throughput: {report['readings_per_second']} readings/s  "
+          f"(ingestion+processing {report['pipeline_ms_per_reading']} ms/reading)")
+    print(f"Gold objects: {report['gold_objects']}  MQTT messages: {report['mqtt_messages']}  "
+          f"DynamoDB items: {report['dynamodb_items']}")
+    print()
+    print(f"{'stage':<16}{'calls':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, s in report["stages"].items():
+        print(f"{stage:<16}{s['invocations']:>8}{s['errors']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['max_ms']:>10}")
+    print()
+    print("AWS calls")
+    for stage, s in report["stages"].items():
+        calls = ", ".join(f"{op}={n}" for op, n in s["aws_calls"].items()) or "-"
+        print(f"  {stage} (per {s['calls_per']}): {calls}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lots", type=int, default=20)
+    parser.add_argument("--spots", type=int, default=14, help="spots per lot")
+    parser.add_argument("--hours", type=float, default=1.5)
+    parser.add_argument("--interval", type=float, default=30.0, help="seconds between reports of one sensor")
+    parser.add_argument("--max-readings", type=int, default=None, help="stop after this many readings")
+    parser.add_argument("--batch-size", type=int, default=10, help="SQS batch size (messages)")
+    parser.add_argument("--envelope", choices=["none", "snapshot", "delta"], default="none",
+                        help="send one multi-sensor envelope per device and round instead of one message per reading")
+    parser.add_argument("--per-lot-batches", action="store_true", help="give each lot its own SQS batches")
+    parser.add_argument("--path", choices=["s3", "sqs"], default="s3", help="S3-triggered enricher or SQS fast path")
+    parser.add_argument("--bronze-batch", action="store_true", help="ingestion with BRONZE_BATCH_MODE=true")
+    parser.add_argument("--gzip", action="store_true", help="BRONZE_COMPRESSION=gzip")
+    parser.add_argument("--modify-every", type=int, default=50, help="batches between modify-state requests (0 = never)")
+    parser.add_argument("--bulk-size", type=int, default=3, help="spots per modify-state request")
+    parser.add_argument("--lookup-every", type=int, default=20, help="batches between lookup requests (0 = never)")
+    parser.add_argument("--athena-rows", type=int, default=100, help="rows returned by each fake Athena query")
+    parser.add_argument("--shared-cache", action="store_true", help="enable the DynamoDB tier of the lookup cache")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated delay per AWS call")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the Lambdas' own logs")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(args)
+    pipeline.run()
+    report = pipeline.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Synthetic sensor load for the parking pipeline.
+
+Generates readings in the same JSON shape the Raspberry Pi sends to SQS, for
+many lots at once. Every spot is a small two-state process (free/occupied) with
+its own mean dwell time, drawn from a log-normal distribution: a few
+short-stay spots change every few minutes while most stay the same for hours,
+as in a real car park. Each sensor reports its state every `interval` seconds
+(with jitter), whether it changed or not.
+
+Readings are produced lazily, one report round at a time (in event-time order
+up to the jitter), so millions of them can be streamed without holding them in
+memory. With --envelope, each device sends one multi-sensor envelope per round
+instead: a snapshot of all its spots, or a delta with only the changed ones.
+
+Usage:
+    python benchmarks/synthetic_load.py --lots 100 --hours 6 > readings.jsonl
+    python benchmarks/synthetic_load.py --lots 100 --hours 6 --envelope delta > envelopes.jsonl
+"""
+import argparse
+import json
+import math
+import random
+import sys
+from datetime import datetime, timedelta
+
+SENSOR_TYPES = ["infrared", "ultrasonic"]
+
+def lot_device_id(lot_index):
+    return f"pi-zone-{lot_index:03d}"
+
+def build_spots(lots, spots_per_lot, rng, median_dwell_minutes=45.0, dwell_sigma=1.0):
+    """One state per spot: [device_id, sensor_id, occupancy_type, is_occupied, mean_dwell_seconds, next_change]."""
+    spots = []
+    for lot in range(lots):
+        for spot in range(1, spots_per_lot + 1):
+            mean_dwell = 60.0 * median_dwell_minutes * math.exp(rng.gauss(0.0, dwell_sigma))
+            spots.append([
+                lot_device_id(lot),
+                f"spot-{spot:02d}",
+                SENSOR_TYPES[spot % len(SENSOR_TYPES)],
+                rng.random() < 0.5,
+                mean_dwell,
+                rng.expovariate(1.0 / mean_dwell),
+            ])
+    return spots
+
+def generate_rounds(lots=10, spots_per_lot=14, hours=1.0, interval=30.0, start=None, seed=42,
+                    median_dwell_minutes=45.0):
+    """Yields one report round at a time: the list of reading dicts of every spot."""
+    rng = random.Random(seed)
+    start = start or datetime(2026, 2, 27, 8, 0, 0)
+    spots = build_spots(lots, spots_per_lot, rng, median_dwell_minutes)
+    ticks = int(hours * 3600 / interval)
+
+    for tick in range(ticks):
+        elapsed = tick * interval
+        readings = []
+        for spot in spots:
+            device_id, sensor_id, occupancy_type, is_occupied, mean_dwell, next_change = spot
+            # Apply every change that happened before this report
+            while next_change <= elapsed:
+                is_occupied = not is_occupied
+                next_change += rng.expovariate(1.0 / mean_dwell)
+            spot[3], spot[5] = is_occupied, next_change
+
+            event_time = start + timedelta(seconds=elapsed + rng.uniform(0, interval * 0.2))
+            readings.append({
+                "device_id": device_id,
+                "sensor_id": sensor_id,
+                "is_occupied": is_occupied,
+                "occupancy_type": occupancy_type,
+                "timestamp": event_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            })
+        yield readings
+
+def generate_readings(lots=10, spots_per_lot=14, hours=1.0, interval=30.0, start=None, seed=42,
+                      median_dwell_minutes=45.0, max_readings=None):
+    """Yields reading dicts, one report round of every spot at a time."""
+    produced = 0
+    for readings in generate_rounds(lots, spots_per_lot, hours, interval, start, seed, median_dwell_minutes):
+        for reading in readings:
+            yield reading
+            produced += 1
+            if max_readings and produced >= max_readings:
+                return
+
+def generate_envelopes(lots=10, spots_per_lot=14, hours=1.0, interval=30.0, start=None, seed=42,
+                       median_dwell_minutes=45.0, max_readings=None, kind="snapshot"):
+    """
+    Yields multi-sensor envelopes, one per device and report round: every spot of the device
+    (kind="snapshot") or only the spots whose state changed since its previous envelope (kind="delta").
+    Each entry keeps its own report time as an offset in seconds after the envelope timestamp.
+    """
+    last_state = {}
+    produced = 0
+    for readings in generate_rounds(lots, spots_per_lot, hours, interval, start, seed, median_dwell_minutes):
+        by_device = {}
+        for reading in readings:
+            by_device.setdefault(reading["device_id"], []).append(reading)
+
+        for device_id, device_readings in by_device.items():
+            base = min(reading["timestamp"] for reading in device_readings)
+            base_time = datetime.strptime(base, "%Y-%m-%dT%H:%M:%SZ")
+            entries = []
+            for reading in device_readings:
+                spot_key = (device_id, reading["sensor_id"])
+                if kind == "delta" and last_state.get(spot_key) == reading["is_occupied"]:
+                    continue
+                last_state[spot_key] = reading["is_occupied"]
+                entry = {key: reading[key] for key in ("sensor_id", "is_occupied", "occupancy_type")}
+                offset = int((datetime.strptime(reading["timestamp"], "%Y-%m-%dT%H:%M:%SZ") - base_time).total_seconds())
+                if offset:
+                    entry["offset"] = offset
+                entries.append(entry)
+            if not entries:
+                continue
+
+            yield {"device_id": device_id, "timestamp": base, "kind": kind, "readings": entries}
+            produced += len(entries)
+            if max_readings and produced >= max_readings:
+                return
+
+def expected_readings(lots, spots_per_lot, hours, interval):
+    return lots * spots_per_lot * int(hours * 3600 / interval)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lots", type=int, default=10)
+    parser.add_argument("--spots", type=int, default=14, help="spots per lot")
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--interval", type=float, default=30.0, help="seconds between reports of one sensor")
+    parser.add_argument("--median-dwell", type=float, default=45.0, help="median minutes a spot keeps its state")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--envelope", choices=["none", "snapshot", "delta"], default="none",
+                        help="one multi-sensor envelope per device and round instead of one line per reading")
+    args = parser.parse_args()
+
+    print(f"[DEBUG] ~{expected_readings(args.lots, args.spots, args.hours, args.interval)} readings", file=sys.stderr)
+    if args.envelope == "none":
+        messages = generate_readings(args.lots, args.spots, args.hours, args.interval,
+                                     seed=args.seed, median_dwell_minutes=args.median_dwell)
+    else:
+        messages = generate_envelopes(args.lots, args.spots, args.hours, args.interval, seed=args.seed,
+                                      median_dwell_minutes=args.median_dwell, kind=args.envelope)
+    for message in messages:
+        sys.stdout.write(json.dumps(message) + "\n")
+
+if __name__ == "__main__":
+    main()
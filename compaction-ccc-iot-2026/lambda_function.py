@@ -0,0 +1,226 @@
+import io
+import json
+import boto3
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Initialize clients outside the handler to reuse connections
+s3_client = boto3.client('s3')
+
+# Typed schema of the compacted Gold layer (matches the JSON written by data-processing)
+GOLD_SCHEMA = pa.schema([
+    ("device_id", pa.string()),
+    ("sensor_id", pa.string()),
+    ("occupancy_type", pa.string()),
+    ("status", pa.string()),
+    ("is_physically_occupied", pa.bool_()),
+    ("db_reservation_state", pa.string()),
+    ("license_plate", pa.string()),
+    ("booked_until", pa.string()),
+    ("event_timestamp", pa.string()),
+    ("event_date", pa.string()),
+    ("event_time", pa.string()),
+    ("lot_physical_capacity", pa.int32()),
+    ("lot_usable_spaces", pa.int32()),
+    ("processed_at", pa.string()),
+])
+
+# Parquet files are written under this prefix, next to the raw JSON partitions
+COMPACTED_PREFIX = "compacted"
+
+# S3 DeleteObjects accepts at most 1000 keys per request
+DELETE_MAX_KEYS = 1000
+
+def resolve_window(event):
+    """Returns (date, hour) to compact. Defaults to the previous UTC day (or hour for granularity=hour)."""
+    granularity = event.get("granularity", os.environ.get("COMPACTION_GRANULARITY", "day")).lower()
+    if granularity not in ("day", "hour"):
+        raise ValueError(f"Invalid granularity: {granularity} (expected 'day' or 'hour')")
+
+    now = datetime.utcnow()
+    if granularity == "day":
+        date = event.get("date") or (now - timedelta(days=1)).strftime("%Y-%m-%d")
+        return date, None
+
+    previous = now - timedelta(hours=1)
+    date = event.get("date") or previous.strftime("%Y-%m-%d")
+    hour = event.get("hour")
+    if hour is None or hour == "":
+        hour = previous.strftime("%H")
+    return date, f"{int(hour):02d}"
+
+def list_json_keys(bucket, prefix):
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('.json'):
+                keys.append(obj['Key'])
+    return keys
+
+def read_gold_rows(bucket, key):
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+def read_parquet_rows(bucket, key):
+    """Rows of an existing Parquet file, or [] if it does not exist yet."""
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return []
+    return pq.read_table(io.BytesIO(body)).to_pylist()
+
+def merge_rows(previous_rows, new_rows):
+    """Previous rows of the window plus the new ones, without exact duplicates (re-runs read the same JSON again)."""
+    merged, seen = [], set()
+    for row in previous_rows + new_rows:
+        identity = tuple(row.get(field.name) for field in GOLD_SCHEMA)
+        if identity not in seen:
+            seen.add(identity)
+            merged.append(row)
+    return merged
+
+def to_arrow_table(rows):
+    columns = {}
+    for field in GOLD_SCHEMA:
+        values = [row.get(field.name) for row in rows]
+        if pa.types.is_integer(field.type):
+            values = [int(v) if v is not None else None for v in values]
+        columns[field.name] = pa.array(values, type=field.type)
+    return pa.table(columns, schema=GOLD_SCHEMA)
+
+def delete_keys(bucket, keys):
+    for i in range(0, len(keys), DELETE_MAX_KEYS):
+        chunk = keys[i:i + DELETE_MAX_KEYS]
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True}
+        )
+
+def list_lots(bucket):
+    """Lot partitions (lot=<name>/) at the root of the Gold bucket."""
+    lots = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix="lot=", Delimiter="/"):
+        for common in page.get('CommonPrefixes', []):
+            lots.append(common['Prefix'][len("lot="):].rstrip("/"))
+    return lots
+
+def compact_partition(gold_bucket, source_prefix, hour, suffix, delete_source, max_workers):
+    """Compacts the JSON files under source_prefix into one Parquet file. Returns its summary, or None if empty."""
+    # 1. List the small JSON files of the partition
+    keys = list_json_keys(gold_bucket, source_prefix)
+    print(f"[DEBUG] Found {len(keys)} JSON objects under {source_prefix}")
+
+    # 2. Fetch them concurrently
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        per_key_rows = list(pool.map(lambda k: read_gold_rows(gold_bucket, k), keys))
+
+    rows, compacted_keys, mixed_keys = [], [], []
+    for key, key_rows in zip(keys, per_key_rows):
+        if hour is not None:
+            in_window = [r for r in key_rows if (r.get("event_time") or "").startswith(f"{hour}:")]
+            if not in_window:
+                continue
+            if len(in_window) < len(key_rows):
+                # NDJSON batch spanning several hours: deleting it would lose the other hours' rows,
+                # and compacting it without deleting it would count these twice. Left for the day run
+                mixed_keys.append(key)
+                if delete_source:
+                    continue
+            key_rows = in_window
+        rows.extend(key_rows)
+        compacted_keys.append(key)
+
+    if mixed_keys:
+        print(f"[DEBUG] {len(mixed_keys)} JSON objects hold rows of other hours and are kept"
+              + (" out of this window" if delete_source else ""))
+
+    if not rows:
+        return None
+
+    # 3. A previous run of the window may already have compacted (and deleted) other JSON files:
+    #    its rows are kept, so re-running a window never loses data
+    parquet_key = f"{COMPACTED_PREFIX}/{source_prefix}events_{suffix}.snappy.parquet"
+    previous_rows = read_parquet_rows(gold_bucket, parquet_key)
+    if previous_rows:
+        print(f"[DEBUG] Merging {len(previous_rows)} rows already compacted in {parquet_key}")
+    rows = merge_rows(previous_rows, rows)
+
+    # 4. Sort so that row-group statistics let Athena skip data on sensor/time filters
+    rows.sort(key=lambda r: (r.get("sensor_id") or "", r.get("event_timestamp") or ""))
+    table = to_arrow_table(rows)
+
+    # 5. Write one Snappy-compressed Parquet file for the window
+
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='snappy')
+    s3_client.put_object(
+        Bucket=gold_bucket,
+        Key=parquet_key,
+        Body=buffer.getvalue(),
+        ContentType='application/vnd.apache.parquet'
+    )
+    print(f"Successfully compacted {len(rows)} rows from {len(compacted_keys)} files into {parquet_key}")
+
+    # 6. Optionally remove the JSON sources so the union view never counts an event twice
+    #    (only objects whose rows all fell inside the window)
+    if delete_source:
+        delete_keys(gold_bucket, compacted_keys)
+        print(f"[DEBUG] Deleted {len(compacted_keys)} source JSON objects")
+
+    return {
+        'parquet_key': parquet_key,
+        'rows': len(rows),
+        'source_files': len(compacted_keys),
+        'mixed_files': len(mixed_keys),
+        'deleted_source': delete_source
+    }
+
+def lambda_handler(event, context):
+    gold_bucket = os.environ.get('GOLD_BUCKET_NAME')
+    delete_source = os.environ.get('DELETE_SOURCE_JSON', 'false').lower() == 'true'
+    max_workers = int(os.environ.get('COMPACTION_MAX_WORKERS', '16'))
+    by_lot = os.environ.get('GOLD_LAYOUT', 'lot').lower() == 'lot'
+
+    if not gold_bucket:
+        raise ValueError("GOLD_BUCKET_NAME environment variable is missing.")
+
+    event = event or {}
+    date, hour = resolve_window(event)
+    year, month, day = date.split("-")
+    date_prefix = f"year={year}/month={month}/day={day}/"
+    suffix = f"{year}{month}{day}" + (f"_{hour}" if hour else "")
+
+    # Gold partitioned by lot: one Parquet file per lot and window (or only the lot in the event)
+    if by_lot:
+        lots = [event["lot"]] if event.get("lot") else list_lots(gold_bucket)
+        source_prefixes = [f"lot={lot}/{date_prefix}" for lot in lots]
+    else:
+        source_prefixes = [date_prefix]
+
+    compacted = []
+    for source_prefix in source_prefixes:
+        summary = compact_partition(gold_bucket, source_prefix, hour, suffix, delete_source, max_workers)
+        if summary:
+            compacted.append(summary)
+
+    if not compacted:
+        return {
+            'statusCode': 200,
+            'body': f'Nothing to compact for {date}' + (f' {hour}h' if hour else '') + '.'
+        }
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'partitions': compacted,
+            'rows': sum(c['rows'] for c in compacted),
+            'source_files': sum(c['source_files'] for c in compacted),
+            'deleted_source': delete_source
+        })
+    }
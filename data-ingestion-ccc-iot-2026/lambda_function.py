@@ -1,45 +1,182 @@
 import json
 import boto3
 import os
+import gzip
 import uuid
 from datetime import datetime
+from stage_metrics import StageMetrics
 
 # Initialize the S3 client
 s3_client = boto3.client('s3')
 
-def lambda_handler(event, context):
-    # Fetch the destination bucket name from Environment Variables
-    bucket_name = os.environ.get('BRONZE_BUCKET_NAME')
-    
-    if not bucket_name:
-        raise ValueError("BRONZE_BUCKET_NAME environment variable is missing.")
+# Per-stage timings (metrics layer)
+metrics = StageMetrics('data-ingestion')
 
-    # SQS can send multiple messages in a single batch (event['Records'])
-    for record in event.get('Records', []):
+# Bronze objects written in batch mode are capped at this size (before compression)
+DEFAULT_MAX_OBJECT_BYTES = 5 * 1024 * 1024
+
+# Batch mode: messages that are not valid JSON are kept as received under this prefix (ignored by processing)
+INVALID_PREFIX = "invalid/"
+
+def build_bronze_key(prefix, extension):
+    # Create a unique filename (e.g., raw_data_20260223_193015_a1b2c3d4.json)
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    unique_id = str(uuid.uuid4())[:8]
+    return f"{prefix}_{timestamp}_{unique_id}.{extension}"
+
+def count_readings(payload):
+    """
+    Readings carried by one message: a legacy message is one reading, a multi-sensor envelope
+    ({"device_id", "timestamp", "readings": [...]}) one per entry. Envelopes are stored as received.
+    """
+    if isinstance(payload, dict) and "readings" in payload:
+        if not isinstance(payload["readings"], list):
+            raise TypeError("the 'readings' field of an envelope must be a list")
+        return len(payload["readings"])
+    return 1
+
+def write_single(bucket_name, records):
+    """Legacy mode: one Bronze object per SQS message. Returns the failed message IDs."""
+    failed_ids = []
+
+    for record in records:
         # The raw JSON payload from your Raspberry Pi
         payload = record['body']
-        
-        # Create a unique filename (e.g., raw_data_20260223_193015_a1b2c3d4.json)
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        unique_id = str(uuid.uuid4())[:8]
-        file_name = f"raw_data_{timestamp}_{unique_id}.json"
-        
+        file_name = build_bronze_key("raw_data", "json")
+
         try:
             # Upload the raw payload directly to the S3 Bronze bucket
+            with metrics.stage('s3_put'):
+                s3_client.put_object(
+                    Bucket=bucket_name,
+                    Key=file_name,
+                    Body=payload,
+                    ContentType='application/json'
+                )
+            print(f"Successfully saved {file_name} to {bucket_name}")
+
+        except Exception as e:
+            print(f"Error saving message {record['messageId']} to S3: {str(e)}")
+            failed_ids.append(record['messageId'])
+
+    return failed_ids
+
+def quarantine_invalid(bucket_name, record):
+    """
+    Stores a body that is not valid JSON as its own object under INVALID_PREFIX, as legacy mode would
+    have stored it. A redelivery would fail the same way, so the message is acknowledged once it is saved.
+    Returns True if it was saved.
+    """
+    file_name = build_bronze_key(f"{INVALID_PREFIX}raw_invalid", "txt")
+    try:
+        with metrics.stage('s3_put'):
             s3_client.put_object(
                 Bucket=bucket_name,
                 Key=file_name,
-                Body=payload,
-                ContentType='application/json'
+                Body=record['body'],
+                ContentType='text/plain'
             )
-            print(f"Successfully saved {file_name} to {bucket_name}")
-            
+        print(f"Stored invalid message {record['messageId']} as {file_name}")
+        return True
+    except Exception as e:
+        print(f"Error saving invalid message {record['messageId']} to S3: {str(e)}")
+        return False
+
+def chunk_lines(records, max_object_bytes):
+    """Groups SQS messages into newline-delimited chunks no larger than max_object_bytes."""
+    chunks = []
+    current_lines, current_ids, current_size = [], [], 0
+
+    for message_id, line in records:
+        line_size = len(line) + 1
+        if current_lines and current_size + line_size > max_object_bytes:
+            chunks.append((current_lines, current_ids))
+            current_lines, current_ids, current_size = [], [], 0
+        current_lines.append(line)
+        current_ids.append(message_id)
+        current_size += line_size
+
+    if current_lines:
+        chunks.append((current_lines, current_ids))
+    return chunks
+
+def write_batched(bucket_name, records, compress, max_object_bytes):
+    """Batch mode: the whole SQS batch becomes one (or a few size-capped) NDJSON objects."""
+    failed_ids = []
+    lines = []
+    invalid = []
+    readings = 0
+
+    with metrics.stage('serialize'):
+        for record in records:
+            try:
+                # Re-serialize so every message (single reading or envelope) occupies exactly one line
+                payload = json.loads(record['body'])
+                readings += count_readings(payload)
+                lines.append((record['messageId'], json.dumps(payload)))
+            except (json.JSONDecodeError, TypeError) as e:
+                print(f"Invalid JSON in message {record['messageId']}: {str(e)}")
+                invalid.append(record)
+
+    # Outside the serialize stage: these are S3 writes
+    for record in invalid:
+        metrics.count('invalid_messages')
+        if not quarantine_invalid(bucket_name, record):
+            failed_ids.append(record['messageId'])
+
+    for chunk, message_ids in chunk_lines(lines, max_object_bytes):
+        body = ("\n".join(chunk) + "\n").encode('utf-8')
+        extra_args = {}
+        if compress:
+            with metrics.stage('compress'):
+                body = gzip.compress(body)
+            extra_args['ContentEncoding'] = 'gzip'
+        file_name = build_bronze_key("raw_batch", "jsonl.gz" if compress else "jsonl")
+
+        try:
+            with metrics.stage('s3_put'):
+                s3_client.put_object(
+                    Bucket=bucket_name,
+                    Key=file_name,
+                    Body=body,
+                    ContentType='application/x-ndjson',
+                    **extra_args
+                )
+            metrics.count('bronze_bytes', len(body))
+            print(f"Successfully saved {len(chunk)} messages as {file_name} to {bucket_name}")
+
         except Exception as e:
-            print(f"Error saving message to S3: {str(e)}")
-            # Raise the error so SQS knows the message failed and can retry it
-            raise e
+            print(f"Error saving batch {file_name} to S3: {str(e)}")
+            failed_ids.extend(message_ids)
+
+    metrics.count('readings', readings)
+    return failed_ids
+
+@metrics.handler
+def lambda_handler(event, context):
+    # Fetch the destination bucket name from Environment Variables
+    bucket_name = os.environ.get('BRONZE_BUCKET_NAME')
+    batch_mode = os.environ.get('BRONZE_BATCH_MODE', 'false').lower() == 'true'
+    compress = os.environ.get('BRONZE_COMPRESSION', 'none').lower() == 'gzip'
+    max_object_bytes = int(os.environ.get('BRONZE_MAX_OBJECT_BYTES', DEFAULT_MAX_OBJECT_BYTES))
+
+    if not bucket_name:
+        raise ValueError("BRONZE_BUCKET_NAME environment variable is missing.")
+
+    # SQS can send multiple messages in a single batch (event['Records'])
+    records = event.get('Records', [])
+
+    if batch_mode:
+        failed_ids = write_batched(bucket_name, records, compress, max_object_bytes)
+    else:
+        failed_ids = write_single(bucket_name, records)
+
+    metrics.count('messages', len(records))
+    metrics.count('failed_messages', len(failed_ids))
+    if failed_ids:
+        print(f"{len(failed_ids)} of {len(records)} messages failed and will be retried by SQS")
 
+    # Only the failed messages go back to the queue (requires ReportBatchItemFailures on the trigger)
     return {
-        'statusCode': 200,
-        'body': 'Successfully processed SQS batch and saved to S3 Bronze.'
-    }
\ No newline at end of file
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_ids]
+    }
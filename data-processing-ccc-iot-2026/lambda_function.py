@@ -1,140 +1,883 @@
 import json
 import boto3
 import os
+import gzip
+import time
+import calendar
+import random
+import uuid
 import urllib.parse
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.exceptions import ClientError
+from stage_metrics import StageMetrics
 
 # Initialize clients outside the handler to reuse connections
 s3_client = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 
+# Per-stage timings (metrics layer)
+metrics = StageMetrics('data-processing')
+
 # Initialize IoT client for MQTT publishing
 # Note: In production, you may need to specify your specific IoT Core endpoint URL here.
 iot_endpoint_url = os.environ.get('IOT_ENDPOINT') # e.g., 'a1b2c3d4e5f6g7-ats.iot.eu-west-1.amazonaws.com'
 iot_client = boto3.client('iot-data', endpoint_url=f"https://{iot_endpoint_url}")
 
-def lambda_handler(event, context):
-    gold_bucket = os.environ.get('GOLD_BUCKET_NAME')
-    table_name = os.environ.get('DYNAMODB_TABLE_NAME')
-    lot_id = os.environ.get('LOT_ID', 'LOT#pi-zone-A') 
-    
-    if not gold_bucket or not table_name:
-        raise ValueError("Missing essential environment variables (GOLD_BUCKET_NAME or DYNAMODB_TABLE_NAME).")
-        
-    table = dynamodb.Table(table_name)
+# Fast path (SQS -> Gold): the Bronze lineage copy is written in the background under this prefix,
+# which the S3 path below ignores so it never triggers a second enrichment
+LINEAGE_PREFIX = "lineage/"
+# Messages the ingestion Lambda could not parse, kept as received for inspection
+INVALID_PREFIX = "invalid/"
+background = ThreadPoolExecutor(max_workers=2)
 
-    for record in event.get('Records', []):
-        bronze_bucket = record['s3']['bucket']['name']
-        file_key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+# Statuses that raise an MQTT alert, and the error code sent for each one
+VIOLATION_STATUSES = {"OCCUPIED_BUT_BOOKED": "BOOKED", "OCCUPIED_MAINTENANCE": "MAINTENANCE"}
+publisher = ThreadPoolExecutor(max_workers=int(os.environ.get('ALERT_PUBLISH_WORKERS', '8')))
 
+# Occupancy rollups kept in the state table (read by lookup mode=stats):
+# ROLLUP#HOUR#{YYYY-MM-DDTHH} per lot and hour, ROLLUP#DAY#{YYYY-MM-DD} per lot and day,
+# and ROLLUP#OCCUPANCY with the number of spots physically occupied right now
+ROLLUP_HOUR_PREFIX = "ROLLUP#HOUR#"
+ROLLUP_DAY_PREFIX = "ROLLUP#DAY#"
+OCCUPANCY_COUNTER_ID = "ROLLUP#OCCUPANCY"
+# {(lot_id, hour): highest PeakOccupied known to be stored}, avoids rewriting an unchanged peak
+_peak_cache = {}
+
+# Change feed (read by lookup mode=changes): STATE#VERSION holds a per-lot counter that grows by one
+# with every transaction that changes the status of some spots, and each STATUS# item keeps the
+# StateVersion in which its status last changed
+STATE_VERSION_ID = "STATE#VERSION"
+TRANSACT_MAX_STATUS = 99  # TransactWriteItems takes 100 actions: the counter plus 99 spots
+MAX_VERSION_RETRIES = 5
+# Jittered backoff between version conflicts, so racing invocations of a lot stop colliding in lockstep
+VERSION_RETRY_BASE_SECONDS = 0.02
+VERSION_RETRY_MAX_SECONDS = 0.5
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+# Multi-sensor envelopes: one message carries a snapshot (every spot) or a delta (changed spots only)
+# of a device, as {"device_id", "timestamp", "kind", "readings": [{"sensor_id", "is_occupied", "offset"?}]}
+ENVELOPE_KEYS = ("readings", "kind")
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def expand_envelope(payload):
+    """
+    Returns the flat readings carried by one message. A legacy payload is a single reading; an envelope
+    yields one reading per entry, inheriting the envelope fields (device_id, timestamp, occupancy_type...).
+    An entry's `offset` is its delay in seconds after the envelope timestamp.
+    """
+    if not isinstance(payload, dict) or "readings" not in payload:
+        return [payload]
+    entries = payload["readings"]
+    if not isinstance(entries, list):
+        raise ValueError("The 'readings' field of an envelope must be a list.")
+
+    shared = {key: value for key, value in payload.items() if key not in ENVELOPE_KEYS}
+    readings = []
+    for entry in entries:
+        reading = {**shared, **entry}
+        offset = reading.pop("offset", None)
+        if offset:
+            event_time = datetime.strptime(reading["timestamp"], TIMESTAMP_FORMAT) + timedelta(seconds=offset)
+            reading["timestamp"] = event_time.strftime(TIMESTAMP_FORMAT)
+        readings.append(reading)
+    return readings
+
+def read_bronze_readings(bucket, key):
+    """
+    Returns the list of raw readings stored in a Bronze object (single JSON or NDJSON batch, optionally gzip),
+    with the envelopes already expanded.
+    """
+    response = s3_client.get_object(Bucket=bucket, Key=key)
+    body = response['Body'].read()
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+    text = body.decode('utf-8')
+
+    if '.jsonl' in key:
+        payloads = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        payloads = [json.loads(text)]
+    return [reading for payload in payloads for reading in expand_envelope(payload)]
+
+def build_gold_filename(file_key, index, total):
+    """Gold filename derived from the Bronze key, with a suffix when one object carries several readings."""
+    filename = os.path.basename(file_key).replace("raw", "processed")
+    if total == 1 and filename.endswith(".json"):
+        return filename
+    base = filename.split(".")[0]
+    return f"{base}_{index:04d}.json"
+
+def readings_from_sqs(records):
+    """Returns (readings, failed_ids) for an SQS batch delivered straight to this function."""
+    readings, failed_ids = [], []
+    for record in records:
+        try:
+            raw_payloads = expand_envelope(json.loads(record['body']))
+        except (json.JSONDecodeError, TypeError, KeyError, ValueError) as e:
+            print(f"Invalid message {record['messageId']}: {str(e)}")
+            failed_ids.append(record['messageId'])
+            continue
+        # Deterministic Gold key per message (and reading), so an SQS redelivery overwrites instead of duplicating
+        for index, raw_payload in enumerate(raw_payloads):
+            readings.append((f"raw_sqs_{record['messageId']}.json", index, len(raw_payloads), raw_payload, record['messageId']))
+    return readings, failed_ids
+
+def write_lineage_copy(bronze_bucket, records, compress):
+    """Saves the raw SQS batch to Bronze as one NDJSON object (lineage only, off the critical path)."""
+    body = ("\n".join(record['body'].replace("\n", " ") for record in records) + "\n").encode('utf-8')
+    extra_args = {}
+    if compress:
+        body = gzip.compress(body)
+        extra_args['ContentEncoding'] = 'gzip'
+    timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+    key = f"{LINEAGE_PREFIX}raw_batch_{timestamp}_{str(uuid.uuid4())[:8]}.jsonl" + (".gz" if compress else "")
+
+    s3_client.put_object(
+        Bucket=bronze_bucket,
+        Key=key,
+        Body=body,
+        ContentType='application/x-ndjson',
+        **extra_args
+    )
+    print(f"Saved lineage copy of {len(records)} messages to {bronze_bucket}/{key}")
+
+# DynamoDB BatchGetItem accepts at most 100 keys per request
+BATCH_GET_MAX_KEYS = 100
+
+# Warm-container cache of each lot's METADATA row, reused across invocations:
+# {lot_id: {'item': {...}, 'fetched_at': epoch, 'seen_spots': set(), 'maintenance_spots': set()}}
+_metadata_cache = {}
+
+# Warm-container cache of the device -> lot routing: {device_id: (lot_id, fetched_at)}
+_device_lot_cache = {}
+
+def batch_get_items(table_name, keys):
+    """Fetches all keys with BatchGetItem (100 keys per call), retrying UnprocessedKeys with backoff."""
+    items = []
+    for i in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request = {table_name: {'Keys': keys[i:i + BATCH_GET_MAX_KEYS]}}
+        attempt = 0
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            items.extend(response.get('Responses', {}).get(table_name, []))
+            request = response.get('UnprocessedKeys') or {}
+            if request:
+                attempt += 1
+                time.sleep(min(0.05 * (2 ** attempt), 1.0))
+    return items
+
+def lot_name(lot_id):
+    """'LOT#pi-zone-A' -> 'pi-zone-A', as used in MQTT topics and Gold partitions."""
+    return lot_id.split('#', 1)[-1]
+
+def resolve_lots(table, device_ids, default_lot_id):
+    """
+    Returns {device_id: lot_id}. A device belongs to the lot of its DEVICE#{device_id} route item
+    (several devices can feed one lot), or to LOT#{device_id} when it has none.
+    """
+    if os.environ.get('LOT_ROUTING', 'device').lower() == 'fixed':
+        return {device_id: default_lot_id for device_id in device_ids}
+
+    ttl_seconds = float(os.environ.get('DEVICE_LOT_CACHE_TTL_SECONDS', '300'))
+    now = time.time()
+    lots = {}
+    missing = []
+    for device_id in device_ids:
+        cached = _device_lot_cache.get(device_id)
+        if cached is not None and now - cached[1] <= ttl_seconds:
+            lots[device_id] = cached[0]
+        elif device_id:
+            missing.append(device_id)
+        else:
+            lots[device_id] = default_lot_id  # Readings without a device_id keep the old single-lot behaviour
+
+    if missing:
+        keys = [{'LotID': f'DEVICE#{device_id}', 'EntityID': 'ROUTE'} for device_id in sorted(missing)]
+        routes = {item['LotID'][len('DEVICE#'):]: item['TargetLotID'] for item in batch_get_items(table.name, keys)}
+        for device_id in missing:
+            # Devices without a route item are cached too, so they don't cost a read per batch
+            lots[device_id] = routes.get(device_id, f'LOT#{device_id}')
+            _device_lot_cache[device_id] = (lots[device_id], now)
+    return lots
+
+def fetch_lots_state(table, sensors_by_lot):
+    """
+    Returns {lot_id: (metadata_item, {sensor_id: spot_item}, {sensor_id: status_item}, occupancy_item)}
+    for every lot of the batch, in as few round trips as possible.
+    """
+    ttl_seconds = float(os.environ.get('METADATA_CACHE_TTL_SECONDS', '60'))
+    now = time.time()
+    refresh_metadata = {
+        lot_id for lot_id in sensors_by_lot
+        if lot_id not in _metadata_cache or now - _metadata_cache[lot_id]['fetched_at'] > ttl_seconds
+    }
+
+    # One BatchGetItem for every distinct spot and its last known status (plus METADATA when the cached copy is stale)
+    keys = []
+    for lot_id, sensor_ids in sensors_by_lot.items():
+        keys += [{'LotID': lot_id, 'EntityID': f'SPOT#{sensor_id}'} for sensor_id in sorted(sensor_ids)]
+        keys += [{'LotID': lot_id, 'EntityID': f'STATUS#{sensor_id}'} for sensor_id in sorted(sensor_ids)]
+        keys.append({'LotID': lot_id, 'EntityID': OCCUPANCY_COUNTER_ID})
+        if lot_id in refresh_metadata:
+            keys.append({'LotID': lot_id, 'EntityID': 'METADATA'})
+
+    items_by_lot = {lot_id: [] for lot_id in sensors_by_lot}
+    for item in batch_get_items(table.name, keys):
+        items_by_lot[item['LotID']].append(item)
+
+    return {
+        lot_id: split_lot_state(table, lot_id, sensors_by_lot[lot_id], items, lot_id in refresh_metadata, now)
+        for lot_id, items in items_by_lot.items()
+    }
+
+def split_lot_state(table, lot_id, sensor_ids, items, refresh_metadata, now):
+    """Sorts one lot's items into (metadata_item, spot_items, status_items, occupancy_item), caching METADATA."""
+    meta_item = {}
+    spot_items = {}
+    status_items = {}
+    occupancy_item = {}
+    for item in items:
+        if item['EntityID'] == 'METADATA':
+            meta_item = item
+        elif item['EntityID'] == OCCUPANCY_COUNTER_ID:
+            occupancy_item = item
+        elif item['EntityID'].startswith('STATUS#'):
+            status_items[item['EntityID'][len('STATUS#'):]] = item
+        else:
+            spot_items[item['EntityID'][len('SPOT#'):]] = item
+
+    maintenance_spots = {s for s, item in spot_items.items() if item.get('ReservationState') == 'MAINTENANCE'}
+
+    if refresh_metadata:
+        _metadata_cache[lot_id] = {
+            'item': meta_item,
+            'fetched_at': now,
+            'seen_spots': set(sensor_ids),
+            'maintenance_spots': maintenance_spots
+        }
+        return meta_item, spot_items, status_items, occupancy_item
+
+    # SpotsUnderRepair only changes when a spot enters or leaves MAINTENANCE (see modify-state),
+    # so a maintenance flip on a spot we have already seen invalidates the cached METADATA.
+    cached = _metadata_cache[lot_id]
+    known_spots = cached['seen_spots'] & set(sensor_ids)
+    if (cached['maintenance_spots'] & known_spots) != (maintenance_spots & known_spots):
+        print(f"[DEBUG] Maintenance change detected in {lot_id}, refreshing METADATA")
+        cached['item'] = table.get_item(Key={'LotID': lot_id, 'EntityID': 'METADATA'}).get('Item', {})
+        cached['fetched_at'] = now
+
+    cached['seen_spots'] |= set(sensor_ids)
+    cached['maintenance_spots'] = (cached['maintenance_spots'] - set(sensor_ids)) | maintenance_spots
+    return cached['item'], spot_items, status_items, occupancy_item
+
+def evaluate_alert(alert_state, sensor_id, final_status, event_timestamp, event_epoch):
+    """Returns 'violation', 'cleared' or None, publishing only on transitions (plus periodic re-notifies)."""
+    renotify_seconds = int(os.environ.get('ALERT_RENOTIFY_SECONDS', '900'))
+    notify_cleared = os.environ.get('ALERT_NOTIFY_CLEARED', 'true').lower() == 'true'
+
+    previous = alert_state.get(sensor_id, {'status': None, 'event_timestamp': '', 'alerted_at': 0})
+    if event_timestamp < previous['event_timestamp']:
+        return None  # A newer state is already known for this sensor
+
+    in_violation = final_status in VIOLATION_STATUSES
+    was_violation = previous['status'] in VIOLATION_STATUSES
+    alerted_at = previous['alerted_at']
+    kind = None
+
+    if in_violation and (final_status != previous['status']
+                         or (renotify_seconds > 0 and event_epoch - alerted_at >= renotify_seconds)):
+        kind, alerted_at = 'violation', event_epoch
+    elif was_violation and not in_violation:
+        kind, alerted_at = ('cleared' if notify_cleared else None), 0
+
+    alert_state[sensor_id] = {'status': final_status, 'event_timestamp': event_timestamp, 'alerted_at': alerted_at}
+    return kind
+
+def publish_alerts(lot_id, alerts):
+    """Publishes the batch's coalesced alerts concurrently. Returns the futures to wait on."""
+    topic_mode = os.environ.get('ALERT_TOPIC_MODE', 'legacy').lower()
+    name = lot_name(lot_id)  # '#' is an MQTT wildcard, it cannot appear in a topic
+
+    if topic_mode == 'lot':
+        messages = [(f"parking/{name}/alerts", {"lot": name, "alerts": alerts})] if alerts else []
+    elif topic_mode == 'sensor':
+        messages = [(f"parking/{name}/{alert['sensor_id']}/alerts", alert) for alert in alerts]
+    else:
+        messages = [("esp32/sub", alert) for alert in alerts]
+
+    return [
+        publisher.submit(iot_client.publish, topic=topic, qos=1, payload=json.dumps(payload))
+        for topic, payload in messages
+    ]
+
+def is_status_change(gold_state, sensor_id, final_status, event_timestamp, event_epoch, heartbeat_seconds):
+    """True if the reading changes the sensor's status (or a heartbeat is due), i.e. it belongs in Gold."""
+    previous = gold_state.get(sensor_id)
+    if previous is not None and event_timestamp < previous['event_timestamp']:
+        # Late reading: kept for the history only if it differs from the current status
+        return final_status != previous['status']
+
+    changed = (previous is None
+               or final_status != previous['status']
+               or (heartbeat_seconds > 0 and event_epoch - previous['gold_epoch'] >= heartbeat_seconds))
+    gold_epoch = event_epoch if changed else previous['gold_epoch']
+    gold_state[sensor_id] = {'status': final_status, 'event_timestamp': event_timestamp, 'gold_epoch': gold_epoch}
+    return changed
+
+def update_latest_state(table, lot_id, latest_by_sensor, alert_state, gold_state, status_items):
+    """
+    Upserts the STATUS#{sensor_id} record of each sensor, ignoring events older than the stored one.
+    A reading with the same status only refreshes the record; status changes go through write_status_changes.
+    """
+    changed = {}
+    for sensor_id, gold_payload in latest_by_sensor.items():
+        item = {
+            'LotID': lot_id,
+            'EntityID': f'STATUS#{sensor_id}',
+            'EventTimestamp': gold_payload['event_timestamp'],
+            'Status': gold_payload['status'],
+            'AlertedAt': alert_state.get(sensor_id, {}).get('alerted_at', 0),
+            'GoldWrittenAt': gold_state.get(sensor_id, {}).get('gold_epoch', 0),
+            'Record': gold_payload
+        }
+        stored = status_items.get(sensor_id)
+        if stored is None or stored.get('Status') != gold_payload['status']:
+            changed[sensor_id] = item
+            continue
+        try:
+            # Same status: the StateVersion is kept, so change-feed clients don't download the spot again
+            table.update_item(
+                Key={'LotID': lot_id, 'EntityID': f'STATUS#{sensor_id}'},
+                UpdateExpression="SET EventTimestamp = :ts, AlertedAt = :alerted, GoldWrittenAt = :gold, #rec = :rec",
+                ConditionExpression="EventTimestamp <= :ts AND #st = :st",
+                ExpressionAttributeNames={'#rec': 'Record', '#st': 'Status'},
+                ExpressionAttributeValues={
+                    ':ts': item['EventTimestamp'], ':alerted': item['AlertedAt'], ':gold': item['GoldWrittenAt'],
+                    ':rec': gold_payload, ':st': gold_payload['status']
+                }
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Out of order, or another batch changed the status meanwhile: handled as a change below
+            changed[sensor_id] = item
+
+    changed_items = list(changed.values())
+    for i in range(0, len(changed_items), TRANSACT_MAX_STATUS):
+        write_status_changes(table, lot_id, changed_items[i:i + TRANSACT_MAX_STATUS])
+
+def write_status_changes(table, lot_id, items):
+    """
+    Writes the STATUS# items and bumps the lot's STATE#VERSION in one transaction, so a reader that sees
+    version N also sees every spot changed in N. Concurrent batches retry with the next version.
+    """
+    version_key = {'LotID': lot_id, 'EntityID': STATE_VERSION_ID}
+    current = int(table.get_item(Key=version_key, ConsistentRead=True).get('Item', {}).get('StateVersion', 0))
+
+    for attempt in range(MAX_VERSION_RETRIES + 1):
+        if not items:
+            return
+        actions = [{'Update': {
+            'TableName': table.name,
+            'Key': {k: serializer.serialize(v) for k, v in version_key.items()},
+            'UpdateExpression': "SET StateVersion = :next",
+            'ConditionExpression': "StateVersion = :current" if current else "attribute_not_exists(StateVersion)",
+            'ExpressionAttributeValues': {
+                ':next': serializer.serialize(current + 1),
+                **({':current': serializer.serialize(current)} if current else {})
+            },
+            'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+        }}]
+        for item in items:
+            actions.append({'Put': {
+                'TableName': table.name,
+                'Item': {k: serializer.serialize(v) for k, v in dict(item, StateVersion=current + 1).items()},
+                'ConditionExpression': "attribute_not_exists(EventTimestamp) OR EventTimestamp <= :ts",
+                'ExpressionAttributeValues': {':ts': serializer.serialize(item['EventTimestamp'])}
+            }})
+        try:
+            with metrics.stage('state_transaction'):
+                dynamodb.meta.client.transact_write_items(TransactItems=actions)
+            return
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if not any(r.get('Code') == 'ConditionalCheckFailed' for r in reasons) or attempt == MAX_VERSION_RETRIES:
+                raise
+            if reasons[0].get('Code') == 'ConditionalCheckFailed':
+                # Another batch took this version: retry with the next one
+                stored = reasons[0].get('Item', {}).get('StateVersion')
+                current = int(deserializer.deserialize(stored)) if stored else 0
+                metrics.count('state_version_conflicts')
+                time.sleep(random.uniform(0, min(VERSION_RETRY_MAX_SECONDS, VERSION_RETRY_BASE_SECONDS * 2 ** attempt)))
+            stale = {i for i, r in enumerate(reasons[1:]) if r.get('Code') == 'ConditionalCheckFailed'}
+            for i in sorted(stale):
+                print(f"[DEBUG] Skipped out-of-order event for {items[i]['Record']['sensor_id']} ({items[i]['EventTimestamp']})")
+            items = [item for i, item in enumerate(items) if i not in stale]
+
+def split_by_hour(start_epoch, end_epoch):
+    """Yields (hour, seconds) for the interval [start, end), cut at hour boundaries."""
+    t = start_epoch
+    while t < end_epoch:
+        chunk_end = min(end_epoch, t - t % 3600 + 3600)
+        yield time.strftime("%Y-%m-%dT%H", time.gmtime(t)), chunk_end - t
+        t = chunk_end
+
+def accumulate_rollups(enriched, status_items, occupancy_item, skip_sensors):
+    """
+    Turns the batch's enriched readings (in event-time order) into rollup deltas:
+    occupied seconds per spot and hour, peak occupied spots per hour, and violations per day.
+    """
+    max_gap = int(os.environ.get('ROLLUP_MAX_GAP_SECONDS', '900'))
+    # Previous reading of each spot: (event_epoch, physically occupied, status)
+    previous = {}
+    for sensor_id, item in status_items.items():
+        record = item.get('Record', {})
+        if item.get('EventTimestamp'):
+            previous[sensor_id] = (calendar.timegm(time.strptime(item['EventTimestamp'], "%Y-%m-%dT%H:%M:%SZ")),
+                                   bool(record.get('is_physically_occupied')), item.get('Status'))
+
+    hours = {}  # hour -> {'seconds': {sensor_id: s}, 'peak': n}
+    days = {}   # date -> {status: violations}
+    occupied_now = max(0, int(occupancy_item.get('Occupied', 0)))
+    occupancy_delta = 0
+
+    for _, _, _, gold_payload, event_epoch, _ in enriched:
+        sensor_id = gold_payload['sensor_id']
+        if sensor_id in skip_sensors:
+            continue
+        prev = previous.get(sensor_id)
+        if prev is not None and event_epoch < prev[0]:
+            continue  # Late reading, already covered by a newer one
+        is_occupied = bool(gold_payload['is_physically_occupied'])
+        hour = hours.setdefault(time.strftime("%Y-%m-%dT%H", time.gmtime(event_epoch)), {'seconds': {}, 'peak': 0})
+
+        # Time occupied since the previous reading (sensors that went silent are not counted beyond max_gap)
+        if prev is not None and prev[1]:
+            for hour_key, seconds in split_by_hour(prev[0], min(event_epoch, prev[0] + max_gap)):
+                spot_seconds = hours.setdefault(hour_key, {'seconds': {}, 'peak': 0})['seconds']
+                spot_seconds[sensor_id] = spot_seconds.get(sensor_id, 0) + seconds
+
+        # Spots occupied at the same time
+        was_occupied = prev is not None and prev[1]
+        if is_occupied != was_occupied:
+            change = 1 if is_occupied else -1
+            occupied_now = max(0, occupied_now + change)
+            occupancy_delta += change
+        hour['peak'] = max(hour['peak'], occupied_now)
+
+        # New violations (not re-notifies of an ongoing one)
+        status = gold_payload['status']
+        if status in VIOLATION_STATUSES and (prev is None or prev[2] != status):
+            violations = days.setdefault(gold_payload['event_date'], {})
+            violations[status] = violations.get(status, 0) + 1
+
+        previous[sensor_id] = (event_epoch, is_occupied, status)
+
+    return hours, days, occupancy_delta
+
+def write_rollups(table, lot_id, hours, days, occupancy_delta, capacity):
+    """Applies the rollup deltas with atomic ADDs (one UpdateItem per hour and day touched)."""
+    if occupancy_delta:
+        table.update_item(
+            Key={'LotID': lot_id, 'EntityID': OCCUPANCY_COUNTER_ID},
+            UpdateExpression="ADD Occupied :d",
+            ExpressionAttributeValues={':d': occupancy_delta}
+        )
+
+    for hour, rollup in hours.items():
+        names = {}
+        values = {':cap': capacity}
+        adds = []
+        for i, (sensor_id, seconds) in enumerate(sorted(rollup['seconds'].items())):
+            names[f'#s{i}'] = f'Occupied_{sensor_id}'
+            values[f':s{i}'] = seconds
+            adds.append(f"#s{i} :s{i}")
+        if adds:
+            values[':total'] = sum(rollup['seconds'].values())
+            adds.append("OccupiedSeconds :total")
+            table.update_item(
+                Key={'LotID': lot_id, 'EntityID': f'{ROLLUP_HOUR_PREFIX}{hour}'},
+                UpdateExpression="SET Capacity = :cap ADD " + ", ".join(adds),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+
+        # Peak: only raised, never lowered (the condition keeps concurrent batches from overwriting a higher one)
+        if rollup['peak'] > _peak_cache.get((lot_id, hour), -1):
+            try:
+                table.update_item(
+                    Key={'LotID': lot_id, 'EntityID': f'{ROLLUP_HOUR_PREFIX}{hour}'},
+                    UpdateExpression="SET PeakOccupied = :p, Capacity = :cap",
+                    ConditionExpression="attribute_not_exists(PeakOccupied) OR PeakOccupied < :p",
+                    ExpressionAttributeValues={':p': rollup['peak'], ':cap': capacity}
+                )
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+            _peak_cache[(lot_id, hour)] = rollup['peak']
+
+    for date, violations in days.items():
+        names = {f'#v{i}': f'Violations_{status}' for i, status in enumerate(sorted(violations))}
+        values = {f':v{i}': violations[status] for i, status in enumerate(sorted(violations))}
+        values[':total'] = sum(violations.values())
+        table.update_item(
+            Key={'LotID': lot_id, 'EntityID': f'{ROLLUP_DAY_PREFIX}{date}'},
+            UpdateExpression="ADD Violations :total, " + ", ".join(f"#v{i} :v{i}" for i in range(len(violations))),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+
+def bump_gold_watermark(table, lot_id):
+    """Records that new Gold data landed so lookup can invalidate cached results touching today."""
+    table.update_item(
+        Key={'LotID': lot_id, 'EntityID': 'GOLD#WATERMARK'},
+        UpdateExpression="SET UpdatedAt = :now",
+        ExpressionAttributeValues={':now': int(time.time() * 1000)}
+    )
+
+def build_sqs_response(records, failed_ids, lineage_future):
+    """Partial batch response. If the lineage copy failed, the whole batch is retried (Gold keys are idempotent)."""
+    if lineage_future is not None:
+        try:
+            with metrics.stage('lineage_wait'):
+                lineage_future.result()
+        except Exception as e:
+            print(f"Error saving lineage copy to Bronze: {str(e)}")
+            failed_ids = [record['messageId'] for record in records]
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in dict.fromkeys(failed_ids)]
+    }
+
+def derive_status(is_occupied, reservation_state):
+    """Final status of a spot from its sensor reading and its reservation state."""
+    final_status = "UNKNOWN"
+    if is_occupied:
+        if reservation_state == "AVAILABLE":
+            final_status = "OCCUPIED"
+        elif reservation_state == "BOOKED":
+            final_status = "OCCUPIED_BUT_BOOKED"
+        elif reservation_state == "MAINTENANCE":
+            final_status = "OCCUPIED_MAINTENANCE"
+    else:
+        if reservation_state == "AVAILABLE":
+            final_status = "FREE"
+        elif reservation_state == "BOOKED":
+            final_status = "BOOKED_WAITING" 
+        elif reservation_state == "MAINTENANCE":
+            final_status = "MAINTENANCE"
+    return final_status
+
+def parse_event_time(full_timestamp):
+    """'2026-02-27T18:37:00Z' -> ('2026-02-27', '18:37:00', epoch seconds)."""
+    date_part, time_part = full_timestamp.replace('Z', '').split('T')
+    dt_obj = datetime.strptime(full_timestamp, TIMESTAMP_FORMAT)
+    return date_part, time_part, calendar.timegm(dt_obj.timetuple())
+
+def enrich_readings(raw_payloads, spot_items, lot_physical_capacity, lot_usable_spaces):
+    """
+    Enrichment core shared by the live path and the Bronze backfill (backfill/backfill.py): builds the
+    Gold payloads of a batch of one lot's raw readings. The readings of a snapshot share their timestamp
+    and most of their statuses, so each distinct timestamp is parsed and each (occupancy, reservation)
+    pair derived once per batch. No I/O. Returns a list aligned with raw_payloads, holding
+    (gold_payload, event_epoch) for each reading, or the exception raised by an invalid one.
+    """
+    processed_at = datetime.utcnow().strftime(TIMESTAMP_FORMAT)
+    event_times = {}
+    statuses = {}
+    results = []
+
+    for raw_payload in raw_payloads:
         try:
-            # 1. Fetch the raw payload
-            response = s3_client.get_object(Bucket=bronze_bucket, Key=file_key)
-            raw_payload = json.loads(response['Body'].read().decode('utf-8'))
-            
-            device_id = raw_payload.get("device_id")
-            sensor_id = raw_payload.get("sensor_id")
-            is_occupied = raw_payload.get("is_occupied", False)
-            occupancy_type = raw_payload.get("occupancy_type", "unknown")
             full_timestamp = raw_payload.get("timestamp")
-            
-            # 2. Extract Date/Time
-            date_part, time_part = full_timestamp.replace('Z', '').split('T')
-            dt_obj = datetime.strptime(full_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-            year, month, day = dt_obj.strftime("%Y"), dt_obj.strftime("%m"), dt_obj.strftime("%d")
-
-            # 3. Fetch DynamoDB State
-            meta_response = table.get_item(Key={'LotID': lot_id, 'EntityID': 'METADATA'})
-            meta_item = meta_response.get('Item', {})
-            lot_physical_capacity = int(meta_item.get('TotalCapacity', 14)) 
-            spots_under_repair = int(meta_item.get('SpotsUnderRepair', 0))
-            lot_usable_spaces = lot_physical_capacity - spots_under_repair
-
-            spot_response = table.get_item(Key={'LotID': lot_id, 'EntityID': f'SPOT#{sensor_id}'})
-            spot_item = spot_response.get('Item', {})
-            
+            spot_item = spot_items.get(raw_payload.get("sensor_id"), {})
+
+            # 3. Extract Date/Time
+            if full_timestamp not in event_times:
+                event_times[full_timestamp] = parse_event_time(full_timestamp)
+            date_part, time_part, event_epoch = event_times[full_timestamp]
+
             # Extract Reservation State and New Fields
             reservation_state = spot_item.get('ReservationState', 'AVAILABLE')
-            license_plate = spot_item.get('LicensePlate')
-            booked_until = spot_item.get('BookedUntil')
+            is_occupied = raw_payload.get("is_occupied", False)
 
             # 4. State Logic
-            final_status = "UNKNOWN"
-            if is_occupied:
-                if reservation_state == "AVAILABLE":
-                    final_status = "OCCUPIED"
-                elif reservation_state == "BOOKED":
-                    final_status = "OCCUPIED_BUT_BOOKED"
-                elif reservation_state == "MAINTENANCE":
-                    final_status = "OCCUPIED_MAINTENANCE"
-            else:
-                if reservation_state == "AVAILABLE":
-                    final_status = "FREE"
-                elif reservation_state == "BOOKED":
-                    final_status = "BOOKED_WAITING" 
-                elif reservation_state == "MAINTENANCE":
-                    final_status = "MAINTENANCE"
+            status_key = (bool(is_occupied), reservation_state)
+            if status_key not in statuses:
+                statuses[status_key] = derive_status(is_occupied, reservation_state)
+
+            # 6. Build the Enriched Gold Payload
+            gold_payload = {
+                "device_id": raw_payload.get("device_id"),
+                "sensor_id": raw_payload.get("sensor_id"),
+                "occupancy_type": raw_payload.get("occupancy_type", "unknown"),
+                "status": statuses[status_key],
+                "is_physically_occupied": is_occupied,
+                "db_reservation_state": reservation_state,
+                "license_plate": spot_item.get('LicensePlate'),  # Added to Data Lake
+                "booked_until": spot_item.get('BookedUntil'),    # Added to Data Lake
+                "event_timestamp": full_timestamp,
+                "event_date": date_part,
+                "event_time": time_part,
+                "lot_physical_capacity": lot_physical_capacity,
+                "lot_usable_spaces": lot_usable_spaces,
+                "processed_at": processed_at
+            }
+            results.append((gold_payload, event_epoch))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def gold_lot_prefix(lot_id):
+    """Gold is partitioned by lot as well as by date, so Athena queries can prune down to one lot."""
+    return f"lot={lot_name(lot_id)}/" if os.environ.get('GOLD_LAYOUT', 'lot').lower() == 'lot' else ""
+
+def build_gold_key(gold_prefix, gold_payload, filename):
+    year, month, day = gold_payload["event_date"].split('-')
+    return f"{gold_prefix}year={year}/month={month}/day={day}/{filename}"
 
+def process_lot(table, gold_bucket, lot_id, lot_readings, lot_state, record_failure):
+    """Enriches one lot's readings, writes them to Gold and updates its state. Returns the pending MQTT futures."""
+    meta_item, spot_items, status_items, occupancy_item = lot_state
+    lot_physical_capacity = int(meta_item.get('TotalCapacity', 14))
+    spots_under_repair = int(meta_item.get('SpotsUnderRepair', 0))
+    lot_usable_spaces = lot_physical_capacity - spots_under_repair
+
+    # Newest enriched reading of each sensor in this invocation
+    latest_by_sensor = {}
+    # Alert state per sensor, seeded from the stored STATUS# records
+    alert_state = {
+        sensor_id: {
+            'status': item.get('Status'),
+            'event_timestamp': item.get('EventTimestamp', ''),
+            'alerted_at': int(item.get('AlertedAt', 0))
+        }
+        for sensor_id, item in status_items.items()
+    }
+    # Last status per sensor as seen by Gold: unchanged readings are not written again
+    gold_state = {
+        sensor_id: {
+            'status': item.get('Status'),
+            'event_timestamp': item.get('EventTimestamp', ''),
+            'gold_epoch': int(item.get('GoldWrittenAt', 0))
+        }
+        for sensor_id, item in status_items.items()
+    }
+    transitions_only = os.environ.get('GOLD_WRITE_MODE', 'transitions').lower() == 'transitions'
+    gold_prefix = gold_lot_prefix(lot_id)
+    heartbeat_seconds = int(os.environ.get('GOLD_HEARTBEAT_SECONDS', '0'))
+    pending_alerts = {}
+    enriched = []
+    # Sensors whose Gold write failed keep their stored state, so the retried reading is still seen as a change
+    failed_sensors = set()
+    gold_written = False
+
+    # Readings are enriched in event-time order so alert transitions are evaluated correctly.
+    # The Gold payloads of the whole lot are built in one batch; the per-sensor state follows below.
+    enrich_started = time.perf_counter()
+    ordered = sorted(lot_readings, key=lambda r: r[3].get("timestamp") or "")
+    batch = enrich_readings([r[3] for r in ordered], spot_items, lot_physical_capacity, lot_usable_spaces)
+    for (file_key, index, total, raw_payload, message_id), result in zip(ordered, batch):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            gold_payload, event_epoch = result
+            sensor_id = gold_payload["sensor_id"]
+            final_status = gold_payload["status"]
+            full_timestamp = gold_payload["event_timestamp"]
             print(f"[DEBUG] Final Status is: {final_status}")
-            
-            # 5. Alerting via MQTT
-            if final_status in ["OCCUPIED_BUT_BOOKED", "OCCUPIED_MAINTENANCE"]:
+
+            # 5. Alerting via MQTT (only on transitions; coalesced per sensor and published below)
+            previous_status = alert_state.get(sensor_id, {}).get('status')
+            write_gold = not transitions_only or is_status_change(
+                gold_state, sensor_id, final_status, full_timestamp, event_epoch, heartbeat_seconds)
+
+            alert_kind = evaluate_alert(alert_state, sensor_id, final_status, full_timestamp, event_epoch)
+            if alert_kind == 'violation':
                 print(f"ALERT: Sensor {sensor_id} reported an invalid occupancy state ({final_status})!")
-                status_send = "BOOKED" if final_status == "OCCUPIED_BUT_BOOKED" else "MAINTENANCE"
                 # Build the MQTT payload
                 mqtt_payload = {
-                    "error": status_send,
+                    "error": VIOLATION_STATUSES[final_status],
                     "sensor_id": sensor_id,
                     "timestamp": full_timestamp
                 }
-                
+
                 # Inject reservation details if someone parked in a booked spot
                 if final_status == "OCCUPIED_BUT_BOOKED":
-                    mqtt_payload["expected_license_plate"] = license_plate
-                    mqtt_payload["booked_until"] = booked_until
-
-                # Publish to IoT Core
-                iot_client.publish(
-                    topic=f"esp32/sub",
-                    qos=1,
-                    payload=json.dumps(mqtt_payload)
-                )
+                    mqtt_payload["expected_license_plate"] = gold_payload["license_plate"]
+                    mqtt_payload["booked_until"] = gold_payload["booked_until"]
 
-                print("[DEBUG] Published MQTT topic")
+                pending_alerts[sensor_id] = mqtt_payload
+            elif alert_kind == 'cleared':
+                if pending_alerts.get(sensor_id, {}).get("error") in VIOLATION_STATUSES.values():
+                    # Entered and left the violation within this batch: nothing to report
+                    del pending_alerts[sensor_id]
+                else:
+                    pending_alerts[sensor_id] = {
+                        "error": "CLEARED",
+                        "previous_error": VIOLATION_STATUSES[previous_status],
+                        "sensor_id": sensor_id,
+                        "timestamp": full_timestamp
+                    }
 
-            # 6. Build the Enriched Gold Payload
-            gold_payload = {
-                "device_id": device_id,
-                "sensor_id": sensor_id,
-                "occupancy_type": occupancy_type,            
-                "status": final_status,                      
-                "is_physically_occupied": is_occupied,       
-                "db_reservation_state": reservation_state,
-                "license_plate": license_plate,              # Added to Data Lake
-                "booked_until": booked_until,                # Added to Data Lake
-                "event_timestamp": full_timestamp,
-                "event_date": date_part,
-                "event_time": time_part,
-                "lot_physical_capacity": lot_physical_capacity,
-                "lot_usable_spaces": lot_usable_spaces,
-                "processed_at": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
-            }
+            gold_key = build_gold_key(gold_prefix, gold_payload, build_gold_filename(file_key, index, total))
+            enriched.append((file_key, message_id, gold_key, gold_payload, event_epoch, write_gold))
 
-            # 7. Save to Gold S3 Bucket
-            filename = os.path.basename(file_key).replace("raw", "processed")
-            gold_key = f"year={year}/month={month}/day={day}/{filename}"
+        except Exception as e:
+            record_failure(file_key, message_id, e)
+    metrics.add_time('enrich', (time.perf_counter() - enrich_started) * 1000.0)
 
-            s3_client.put_object(
-                Bucket=gold_bucket,
-                Key=gold_key,
-                Body=json.dumps(gold_payload),
-                ContentType='application/json'
-            )
-            print(f"Successfully saved to Gold: {gold_key}")
+    # Alerts go out concurrently while Gold (and the other lots of the batch) are being written
+    alert_futures = publish_alerts(lot_id, list(pending_alerts.values()))
 
+    # 7. Save to Gold S3 Bucket
+    for file_key, message_id, gold_key, gold_payload, event_epoch, write_gold in enriched:
+        sensor_id = gold_payload["sensor_id"]
+        if write_gold:
+            try:
+                with metrics.stage('gold_put'):
+                    s3_client.put_object(
+                        Bucket=gold_bucket,
+                        Key=gold_key,
+                        Body=json.dumps(gold_payload),
+                        ContentType='application/json'
+                    )
+                print(f"Successfully saved to Gold: {gold_key}")
+                gold_written = True
+                # Sensor event -> Gold object, per reading
+                metrics.observe('record_latency', time.time() * 1000.0 - event_epoch * 1000.0)
+            except Exception as e:
+                failed_sensors.add(sensor_id)
+                record_failure(file_key, message_id, e)
+                continue
+        else:
+            # Same status as the last Gold record: only the live state is refreshed
+            metrics.count('gold_suppressed')
+
+        current = latest_by_sensor.get(sensor_id)
+        if current is None or current['event_timestamp'] <= gold_payload["event_timestamp"]:
+            latest_by_sensor[sensor_id] = gold_payload
+
+    for sensor_id in failed_sensors:
+        latest_by_sensor.pop(sensor_id, None)
+
+    # 8. Materialize the current state of each spot (read by lookup for latest=true)
+    with metrics.stage('state_write'):
+        update_latest_state(table, lot_id, latest_by_sensor, alert_state, gold_state, status_items)
+        # Only new Gold objects make lookup's cached results stale (suppressed heartbeats don't)
+        if gold_written:
+            bump_gold_watermark(table, lot_id)
+
+    # 9. Roll the batch into the occupancy/violation aggregates, after STATUS# so a retried
+    #    batch finds its readings already applied instead of counting them twice
+    if os.environ.get('ROLLUPS_ENABLED', 'true').lower() == 'true':
+        try:
+            with metrics.stage('rollups'):
+                hours, days, occupancy_delta = accumulate_rollups(enriched, status_items, occupancy_item, failed_sensors)
+                write_rollups(table, lot_id, hours, days, occupancy_delta, lot_physical_capacity)
         except Exception as e:
-            print(f"Error processing {file_key}: {str(e)}")
+            # Best effort: never fail (and re-enrich) a batch because of the aggregates
+            print(f"Error updating rollups: {str(e)}")
+
+    return alert_futures
+
+@metrics.handler
+def lambda_handler(event, context):
+    gold_bucket = os.environ.get('GOLD_BUCKET_NAME')
+    table_name = os.environ.get('DYNAMODB_TABLE_NAME')
+    default_lot_id = os.environ.get('LOT_ID', 'LOT#pi-zone-A')
+    
+    if not gold_bucket or not table_name:
+        raise ValueError("Missing essential environment variables (GOLD_BUCKET_NAME or DYNAMODB_TABLE_NAME).")
+        
+    table = dynamodb.Table(table_name)
+
+    records = event.get('Records', [])
+    from_sqs = bool(records) and records[0].get('eventSource') == 'aws:sqs'
+    failed_ids = []
+    lineage_future = None
+
+    # 1. Fetch the raw payload(s)
+    if from_sqs:
+        # Fast path: enrich the SQS batch directly and write the Bronze copy in the background
+        with metrics.stage('parse'):
+            readings, failed_ids = readings_from_sqs(records)
+        bronze_bucket = os.environ.get('BRONZE_BUCKET_NAME')
+        if bronze_bucket:
+            compress = os.environ.get('BRONZE_COMPRESSION', 'none').lower() == 'gzip'
+            lineage_future = background.submit(write_lineage_copy, bronze_bucket, records, compress)
+        else:
+            print("[DEBUG] BRONZE_BUCKET_NAME not set, skipping the lineage copy")
+    else:
+        readings = []
+        for record in records:
+            bronze_bucket = record['s3']['bucket']['name']
+            file_key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+            if file_key.startswith((LINEAGE_PREFIX, INVALID_PREFIX)):
+                continue
+
+            try:
+                with metrics.stage('s3_get'):
+                    raw_payloads = read_bronze_readings(bronze_bucket, file_key)
+            except Exception as e:
+                print(f"Error reading {file_key}: {str(e)}")
+                raise e
+
+            for index, raw_payload in enumerate(raw_payloads):
+                readings.append((file_key, index, len(raw_payloads), raw_payload, None))
+
+    if not readings:
+        if from_sqs:
+            return build_sqs_response(records, failed_ids, lineage_future)
+        return {
+            'statusCode': 200,
+            'body': 'No Bronze readings to process.'
+        }
+
+    # 2. Route every reading to its lot and fetch the DynamoDB state of all of them (one BatchGetItem)
+    with metrics.stage('lot_routing'):
+        lot_by_device = resolve_lots(table, {raw_payload.get("device_id") for _, _, _, raw_payload, _ in readings}, default_lot_id)
+    readings_by_lot = {}
+    for reading in readings:
+        readings_by_lot.setdefault(lot_by_device[reading[3].get("device_id")], []).append(reading)
+    sensors_by_lot = {
+        lot_id: {raw_payload.get("sensor_id") for _, _, _, raw_payload, _ in lot_readings if raw_payload.get("sensor_id")}
+        for lot_id, lot_readings in readings_by_lot.items()
+    }
+    with metrics.stage('dynamodb_read'):
+        lot_states = fetch_lots_state(table, sensors_by_lot)
+
+    def record_failure(file_key, message_id, e):
+        print(f"Error processing {file_key}: {str(e)}")
+        if not from_sqs:
             raise e
+        # Only this message goes back to the queue
+        failed_ids.append(message_id)
+
+    # 3-9. Each lot is enriched against its own spots, METADATA and alert state
+    alert_futures = []
+    for lot_id, lot_readings in readings_by_lot.items():
+        alert_futures += process_lot(table, gold_bucket, lot_id, lot_readings, lot_states[lot_id], record_failure)
+
+    with metrics.stage('mqtt_publish_wait'):
+        for future in alert_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error publishing MQTT alert: {str(e)}")
+    if alert_futures:
+        print(f"[DEBUG] Published {len(alert_futures)} MQTT messages")
+
+    metrics.count('lots', len(readings_by_lot))
+    metrics.count('readings', len(readings))
+    metrics.count('failed_readings', len(failed_ids))
+    metrics.count('alerts_published', len(alert_futures))
+
+    if from_sqs:
+        return build_sqs_response(records, failed_ids, lineage_future)
 
     return {
         'statusCode': 200,
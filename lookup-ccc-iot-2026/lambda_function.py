@@ -1,29 +1,72 @@
 import boto3
+import base64
+import gzip
 import time
 import json
 import os
 import re
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from boto3.dynamodb.conditions import Attr, Key
 from botocore.exceptions import ClientError
-from pydantic_ai import Agent
+from stage_metrics import StageMetrics
 
 athena = boto3.client("athena")
+dynamodb = boto3.resource("dynamodb")
+
+# Tiempos por etapa (capa de métricas)
+metrics = StageMetrics("lookup")
 
 # Configuración de entorno
 DATABASE = "iot_data"
-TABLE = "gold_bucket_ccc_iot_2026"  # Ensure this matches your Crawler output
+TABLE = os.environ.get("ATHENA_TABLE", "gold_bucket_ccc_iot_2026")  # Crawler output, or the gold_events view once compaction is enabled
 OUTPUT = "s3://temporal-athena-ccc-iot-2026/athena-results/"
 
+# Estado actual por plaza, mantenido por data-processing (registros STATUS#{sensor_id})
+STATE_TABLE = os.environ.get("DYNAMODB_TABLE_NAME", "ParkingLotState")
+LOT_ID = os.environ.get("LOT_ID", "LOT#pi-zone-A")  # Parking por defecto si la petición no trae 'lot'
+
+# Gold particionado por parking (lot=<nombre>/year=/month=/day=) o solo por fecha (despliegues antiguos)
+GOLD_LAYOUT = os.environ.get("GOLD_LAYOUT", "lot").lower()
+
+# Columnas de la tabla Gold, en el orden en que las escribe data-processing
+GOLD_COLUMNS = [
+    "device_id", "sensor_id", "occupancy_type", "status", "is_physically_occupied",
+    "db_reservation_state", "license_plate", "booked_until", "event_timestamp",
+    "event_date", "event_time", "lot_physical_capacity", "lot_usable_spaces", "processed_at"
+]
+
 # -----------------------------
 # Secrets
 # -----------------------------
+LLM_MODEL = "gateway/bedrock:amazon.nova-micro-v1:0"
+SECRET_TTL_SECONDS = float(os.environ.get("SECRET_TTL_SECONDS", "3600"))
+
+# Reutilizados entre invocaciones del mismo contenedor
+_secrets_client = None
+_secret_cache = {"value": None, "fetched_at": 0.0}
+_agent = None
+_agent_key = None
+
 def get_secret():
+    """Loads the LLM API key into the environment, hitting Secrets Manager at most once per TTL."""
+    global _secrets_client
+
+    if _secret_cache["value"] and time.time() - _secret_cache["fetched_at"] < SECRET_TTL_SECONDS:
+        os.environ["PYDANTIC_AI_GATEWAY_API_KEY"] = _secret_cache["value"]
+        return
+
     secret_name = "LLM_API"
     region_name = "us-east-1"
 
-    session = boto3.session.Session()
-    client = session.client(service_name="secretsmanager", region_name=region_name)
+    if _secrets_client is None:
+        _secrets_client = boto3.client(service_name="secretsmanager", region_name=region_name)
 
-    resp = client.get_secret_value(SecretId=secret_name)
+    with metrics.stage("secret_fetch"):
+        resp = _secrets_client.get_secret_value(SecretId=secret_name)
     secret_string = resp["SecretString"]
 
     try:
@@ -32,64 +75,495 @@ def get_secret():
     except (json.JSONDecodeError, AttributeError, IndexError):
         actual_api_key = secret_string
 
-    os.environ["PYDANTIC_AI_GATEWAY_API_KEY"] = actual_api_key.strip()
+    _secret_cache["value"] = actual_api_key.strip()
+    _secret_cache["fetched_at"] = time.time()
+    os.environ["PYDANTIC_AI_GATEWAY_API_KEY"] = _secret_cache["value"]
 
-def ask_llm(prompt: str) -> str:
-    agent = Agent("gateway/bedrock:amazon.nova-micro-v1:0")
-    result = agent.run_sync(prompt)
+def get_agent():
+    """Returns the shared Agent, rebuilding it only if the API key was rotated."""
+    global _agent, _agent_key
+
+    api_key = os.environ.get("PYDANTIC_AI_GATEWAY_API_KEY")
+    if _agent is None or api_key != _agent_key:
+        # Import diferido: solo el modo LLM paga el coste de cargar pydantic_ai
+        from pydantic_ai import Agent
+        _agent = Agent(LLM_MODEL)
+        _agent_key = api_key
+    return _agent
+
+def ask_llm(prompt: str, stage: str = "llm") -> str:
+    with metrics.stage(stage):
+        result = get_agent().run_sync(prompt)
+    # Tokens consumidos (los nombres cambian según la versión de pydantic_ai)
+    usage = result.usage() if hasattr(result, "usage") else None
+    if usage is not None:
+        metrics.count("llm_input_tokens", getattr(usage, "input_tokens", None) or getattr(usage, "request_tokens", 0) or 0)
+        metrics.count("llm_output_tokens", getattr(usage, "output_tokens", None) or getattr(usage, "response_tokens", 0) or 0)
     return result.output
 
 # -----------------------------
 # Ejecución en Athena
 # -----------------------------
-def run_athena_query(query: str):
+# Espera adaptativa: empieza rápido y se espacia hasta POLL_MAX_INTERVAL
+POLL_INITIAL_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 2.0
+POLL_BACKOFF = 1.5
+ATHENA_TIMEOUT_SECONDS = float(os.environ.get("ATHENA_TIMEOUT_SECONDS", "25"))  # Por debajo de los 29 s de API Gateway
+ATHENA_PAGE_SIZE = 1000  # Máximo permitido por get_query_results
+ATHENA_MAX_ROWS = int(os.environ.get("ATHENA_MAX_ROWS", "10000"))
+
+_QUERY_ID = re.compile(r"^[a-f0-9\-]{36}$")
+
+# Varias queries a la vez (mode=dashboard): se sondean juntas y sus resultados se leen en paralelo
+ATHENA_BATCH_POLL_SIZE = 50  # Máximo de IDs por batch_get_query_execution
+result_readers = ThreadPoolExecutor(max_workers=int(os.environ.get("ATHENA_RESULT_WORKERS", "4")))
+
+def start_athena_query(query: str) -> str:
     resp = athena.start_query_execution(
         QueryString=query,
         QueryExecutionContext={"Database": DATABASE},
         ResultConfiguration={"OutputLocation": OUTPUT}
     )
-    qid = resp["QueryExecutionId"]
-    
-    # Poll de estado con protección de Timeout
-    max_retries = 15  # Máximo 15 segundos esperando a Athena
-    attempts = 0
-    state = "QUEUED"
-    
-    while attempts < max_retries:
-        status = athena.get_query_execution(QueryExecutionId=qid)
-        state = status["QueryExecution"]["Status"]["State"]
+    return resp["QueryExecutionId"]
+
+def get_query_state(qid: str):
+    """Returns (state, reason) of an Athena execution."""
+    return execution_state(athena.get_query_execution(QueryExecutionId=qid)["QueryExecution"])
+
+def execution_state(execution):
+    """(state, reason) of a QueryExecution, recording its cost once it has finished."""
+    status = execution["Status"]
+    if status["State"] in ("SUCCEEDED", "FAILED", "CANCELLED"):
+        # Coste y reparto del tiempo de la query: cola vs. ejecución
+        stats = execution.get("Statistics", {})
+        metrics.count("athena_queries")
+        metrics.count("athena_bytes_scanned", stats.get("DataScannedInBytes", 0))
+        metrics.add_time("athena_queue", stats.get("QueryQueueTimeInMillis", 0))
+        metrics.add_time("athena_engine", stats.get("EngineExecutionTimeInMillis", 0))
+    return status["State"], status.get("StateChangeReason", "Unknown reason")
+
+def stop_query(qid: str) -> None:
+    """Cancels an execution nobody will read any more, so it stops scanning (and billing). Best effort."""
+    try:
+        athena.stop_query_execution(QueryExecutionId=qid)
+        metrics.count("athena_timeout_stops")
+    except Exception as e:
+        print(f"[DEBUG] No se pudo cancelar la query {qid}: {e}")
+
+def wait_for_query(qid: str, timeout: float = ATHENA_TIMEOUT_SECONDS, max_bytes: int | None = None) -> None:
+    """
+    Polls with exponential backoff until the query finishes; raises if it fails or times out.
+    With max_bytes, a query that scans more than that while running is cancelled, and so is one
+    still running at the deadline (the request has given up on it).
+    """
+    deadline = time.time() + timeout
+    interval = POLL_INITIAL_INTERVAL
+
+    while True:
+        execution = athena.get_query_execution(QueryExecutionId=qid)["QueryExecution"]
+        state, reason = execution_state(execution)
         if state in ("SUCCEEDED", "FAILED", "CANCELLED"):
             break
-        time.sleep(0.5)
-        attempts += 1
+        scanned = execution.get("Statistics", {}).get("DataScannedInBytes", 0)
+        if max_bytes and scanned > max_bytes:
+            athena.stop_query_execution(QueryExecutionId=qid)
+            metrics.count("athena_budget_stops")
+            raise RuntimeError(f"La consulta se canceló: superó el límite de {max_bytes} bytes escaneados")
+        if time.time() + interval > deadline:
+            stop_query(qid)
+            break
+        time.sleep(interval)
+        interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
 
     if state != "SUCCEEDED":
-        reason = status["QueryExecution"]["Status"].get("StateChangeReason", "Unknown reason")
         raise RuntimeError(f"Athena falló o tardó demasiado: {state} - {reason}")
 
-    results = athena.get_query_results(QueryExecutionId=qid)
-    rows = results["ResultSet"]["Rows"]
-    
-    if not rows: 
-        return {"columns": [], "rows": []}
-    
-    header = [c.get("VarCharValue", "") for c in rows[0]["Data"]]
-    data_rows = []
-    for r in rows[1:]:
+def get_result_page(qid: str, next_token: str | None = None, max_results: int = ATHENA_PAGE_SIZE):
+    """Reads one page of results. Returns (columns, rows, next_token)."""
+    kwargs = {"QueryExecutionId": qid, "MaxResults": max_results}
+    if next_token:
+        kwargs["NextToken"] = next_token
+    results = athena.get_query_results(**kwargs)
+
+    header = [c["Name"] for c in results["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]]
+    raw_rows = results["ResultSet"]["Rows"]
+    # La primera página de un SELECT trae la cabecera como primera fila
+    if next_token is None and raw_rows and [d.get("VarCharValue") for d in raw_rows[0].get("Data", [])] == header:
+        raw_rows = raw_rows[1:]
+
+    rows = []
+    for r in raw_rows:
         values = [d.get("VarCharValue") for d in r.get("Data", [])]
-        data_rows.append(dict(zip(header, values)))
+        rows.append(dict(zip(header, values)))
+
+    return header, rows, results.get("NextToken")
+
+def iter_result_pages(qid: str, next_token: str | None = None, max_rows: int = ATHENA_MAX_ROWS):
+    """
+    Streams the results page by page, following NextToken, until the last page or max_rows rows.
+    Yields (columns, rows, next_token); the last next_token is where a later request resumes.
+    """
+    read = 0
+    while read < max_rows:
+        # Pide solo las filas que faltan (+1 por la cabecera en la primera página)
+        remaining = max_rows - read + (1 if next_token is None else 0)
+        columns, rows, next_token = get_result_page(qid, next_token, min(ATHENA_PAGE_SIZE, remaining))
+        read += len(rows)
+        yield columns, rows, next_token
+        if not next_token:
+            break
+
+def fetch_query_results(qid: str, next_token: str | None = None, max_rows: int = ATHENA_MAX_ROWS):
+    """Reads up to max_rows rows of a finished query. Returns next_token if more rows remain."""
+    columns, data_rows = [], []
+    for columns, rows, next_token in iter_result_pages(qid, next_token, max_rows):
+        data_rows.extend(rows)
+
+    result = {"columns": columns if data_rows else [], "rows": data_rows}
+    if next_token:
+        result["next_token"] = next_token
+    return result
+
+def run_athena_query(query: str, max_bytes: int | None = None):
+    qid = start_athena_query(query)
+    with metrics.stage("athena_wait"):
+        wait_for_query(qid, max_bytes=max_bytes)
+    with metrics.stage("athena_results"):
+        return fetch_query_results(qid)
+
+def get_query_states(qids: list):
+    """(state, reason) of several executions, with one batch_get_query_execution call per 50 IDs."""
+    states = {}
+    for i in range(0, len(qids), ATHENA_BATCH_POLL_SIZE):
+        resp = athena.batch_get_query_execution(QueryExecutionIds=qids[i:i + ATHENA_BATCH_POLL_SIZE])
+        for execution in resp.get("QueryExecutions", []):
+            states[execution["QueryExecutionId"]] = execution_state(execution)
+        for unprocessed in resp.get("UnprocessedQueryExecutionIds", []):
+            states[unprocessed["QueryExecutionId"]] = ("FAILED", unprocessed.get("ErrorMessage", "Unknown reason"))
+    return states
+
+def wait_for_queries(qids: list, timeout: float = ATHENA_TIMEOUT_SECONDS):
+    """Polls all the executions together, with the backoff of wait_for_query. Returns {qid: (state, reason)}."""
+    deadline = time.time() + timeout
+    interval = POLL_INITIAL_INTERVAL
+    states = {qid: ("QUEUED", "Unknown reason") for qid in qids}
+    pending = list(qids)
+
+    while pending:
+        states.update(get_query_states(pending))
+        pending = [qid for qid in pending if states[qid][0] not in ("SUCCEEDED", "FAILED", "CANCELLED")]
+        if not pending or time.time() + interval > deadline:
+            break
+        time.sleep(interval)
+        interval = min(interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+
+    # Las que siguen en cola o ejecutándose al vencer el plazo se cancelan: su panel ya es un error
+    for qid in pending:
+        stop_query(qid)
+    return states
+
+def _fetch_or_error(qid: str):
+    try:
+        return fetch_query_results(qid)
+    except Exception as e:
+        return e
+
+def run_athena_queries(queries: list):
+    """
+    Runs several queries at once: all of them are started before polling, so the wait is that of the
+    slowest one instead of the sum. Returns a list aligned with queries, holding each result or the
+    exception of the query that failed (the others are still returned).
+    """
+    outcomes = [None] * len(queries)
+    qids = {}
+    for i, query in enumerate(queries):
+        try:
+            qids[i] = start_athena_query(query)
+        except Exception as e:
+            outcomes[i] = e
+
+    with metrics.stage("athena_wait"):
+        states = wait_for_queries(list(qids.values())) if qids else {}
+    for i, qid in qids.items():
+        state, reason = states[qid]
+        if state != "SUCCEEDED":
+            outcomes[i] = RuntimeError(f"Athena falló o tardó demasiado: {state} - {reason}")
+
+    succeeded = [i for i in qids if outcomes[i] is None]
+    with metrics.stage("athena_results"):
+        for i, result in zip(succeeded, result_readers.map(_fetch_or_error, [qids[i] for i in succeeded])):
+            outcomes[i] = result
+    return outcomes
+
+# -----------------------------
+# Caché de resultados de Athena
+# -----------------------------
+# TTL (segundos) por clase de query
+CACHE_TTL = {
+    "latest": int(os.environ.get("QUERY_CACHE_TTL_LATEST", "15")),
+    "today": int(os.environ.get("QUERY_CACHE_TTL_TODAY", "60")),
+    "historical": int(os.environ.get("QUERY_CACHE_TTL_HISTORICAL", "3600")),
+}
+CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "128"))
+CACHE_TABLE = os.environ.get("QUERY_CACHE_TABLE")  # Nivel compartido opcional (DynamoDB)
+CACHE_MAX_ITEM_BYTES = 350 * 1024  # Límite de item de DynamoDB (400 KB) con margen
+WATERMARK_REFRESH_SECONDS = 1.0
+
+_SQL_DATE = re.compile(r"'(\d{4}-\d{2}-\d{2})")
+
+# LRU en el contenedor caliente: clave -> {"result", "created_at", "expires_at", "touches_today", "lot_id"}
+_result_cache = OrderedDict()
+# Marca de agua de Gold por parking: lot_id -> {"value", "read_at"}
+_watermarks = {}
+
+def normalize_sql(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+def query_touches_today(query: str) -> bool:
+    """True if the query may read today's partition (no date bound, or a range reaching today)."""
+    dates = _SQL_DATE.findall(query)
+    if not dates:
+        return True
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    if max(dates) >= today:
+        return True
+    # Un límite inferior sin límite superior llega hasta hoy
+    return bool(re.search(r">=?\s*'\d{4}-\d{2}-\d{2}", query)) and not re.search(r"<=?\s*'\d{4}-\d{2}-\d{2}", query)
+
+def classify_query(query: str) -> str:
+    if "row_number()" in query.lower():
+        return "latest"
+    return "today" if query_touches_today(query) else "historical"
+
+def read_gold_watermark(lot_id: str = LOT_ID) -> int:
+    """Last time (epoch ms) the enricher wrote the lot's Gold data, re-read at most once per second."""
+    now = time.time()
+    watermark = _watermarks.setdefault(lot_id, {"value": 0, "read_at": 0.0})
+    if now - watermark["read_at"] >= WATERMARK_REFRESH_SECONDS:
+        item = dynamodb.Table(STATE_TABLE).get_item(
+            Key={"LotID": lot_id, "EntityID": "GOLD#WATERMARK"}
+        ).get("Item", {})
+        watermark["value"] = int(item.get("UpdatedAt", 0))
+        watermark["read_at"] = now
+    return watermark["value"]
+
+def _entry_is_valid(entry) -> bool:
+    if entry["expires_at"] <= time.time():
+        return False
+    # Invalida lo que toca la partición de hoy si han llegado datos nuevos después de cachearlo
+    if entry["touches_today"] and read_gold_watermark(entry.get("lot_id", LOT_ID)) > entry["created_at"] * 1000:
+        return False
+    return True
+
+def _read_shared_cache(key):
+    if not CACHE_TABLE:
+        return None
+    item = dynamodb.Table(CACHE_TABLE).get_item(Key={"CacheKey": key}).get("Item")
+    if not item:
+        return None
+    return {
+        "result": json.loads(item["Result"]),
+        "created_at": float(item["CreatedAt"]),
+        "expires_at": float(item["ExpiresAt"]),
+        "touches_today": bool(item.get("TouchesToday", True)),
+        "lot_id": item.get("LotID", LOT_ID),
+    }
+
+def _write_shared_cache(key, entry):
+    if not CACHE_TABLE:
+        return
+    body = json.dumps(entry["result"])
+    if len(body) > CACHE_MAX_ITEM_BYTES:
+        return
+    dynamodb.Table(CACHE_TABLE).put_item(Item={
+        "CacheKey": key,
+        "Result": body,
+        "CreatedAt": str(entry["created_at"]),
+        "ExpiresAt": int(entry["expires_at"]),  # Atributo TTL de la tabla
+        "TouchesToday": entry["touches_today"],
+        "LotID": entry["lot_id"],
+    })
+
+def _store_local(key, entry):
+    _result_cache[key] = entry
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
+def _cache_get(key):
+    """Valid cached result of a query (local LRU first, then the shared tier), or None."""
+    entry = _result_cache.get(key)
+    if entry and _entry_is_valid(entry):
+        _result_cache.move_to_end(key)
+        metrics.count("cache_hits_local")
+        return entry["result"]
+
+    try:
+        entry = _read_shared_cache(key)
+    except ClientError as e:
+        print(f"Error leyendo la caché compartida: {e}")
+        entry = None
+    if entry and _entry_is_valid(entry):
+        _store_local(key, entry)
+        metrics.count("cache_hits_shared")
+        return entry["result"]
+
+    metrics.count("cache_misses")
+    return None
 
-    return {"columns": header, "rows": data_rows}
+def _cache_put(key, normalized, result, created_at, lot_id):
+    entry = {
+        "result": result,
+        "created_at": created_at,
+        "expires_at": created_at + CACHE_TTL[classify_query(normalized)],
+        "touches_today": query_touches_today(normalized),
+        "lot_id": lot_id,
+    }
+    _store_local(key, entry)
+    try:
+        _write_shared_cache(key, entry)
+    except ClientError as e:
+        print(f"Error escribiendo la caché compartida: {e}")
+
+def cached_athena_query(query: str, lot_id: str = LOT_ID, max_bytes: int | None = None):
+    """run_athena_query with a local LRU + optional shared cache. Returns (result, cache_hit)."""
+    normalized = normalize_sql(query)
+    key = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    result = _cache_get(key)
+    if result is not None:
+        return result, True
+
+    created_at = time.time()
+    result = run_athena_query(query, max_bytes=max_bytes)
+    _cache_put(key, normalized, result, created_at, lot_id)
+    return result, False
+
+def cached_athena_queries(queries: list, lot_id: str = LOT_ID):
+    """
+    cached_athena_query for several queries: the ones not in the cache run together (run_athena_queries).
+    Returns [(result or exception, cache_hit)] aligned with queries.
+    """
+    normalized = [normalize_sql(query) for query in queries]
+    keys = [hashlib.sha256(n.encode("utf-8")).hexdigest() for n in normalized]
+    outcomes = [(_cache_get(key), True) for key in keys]
+
+    misses = [i for i, (result, _) in enumerate(outcomes) if result is None]
+    created_at = time.time()
+    for i, result in zip(misses, run_athena_queries([queries[i] for i in misses])):
+        outcomes[i] = (result, False)
+        if not isinstance(result, Exception):
+            _cache_put(keys[i], normalized[i], result, created_at, lot_id)
+    return outcomes
 
 # -----------------------------
 # Filtros Directos (Para Dashboards)
 # -----------------------------
 _SAFE_ID = re.compile(r"^[a-zA-Z0-9_\-:.]+$")
 _SAFE_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_SAFE_DATETIME = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}(:\d{2})?Z?$")
+_SAFE_LOT = re.compile(r"^[a-zA-Z0-9_\-.]+$")
+_SAFE_TIMESTAMP = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z$")
+MAX_RANGE_DAYS = 366
+
+# Claves del cursor de paginación (orden de las filas del histórico)
+CURSOR_COLUMNS = ("event_timestamp", "sensor_id")
+
+def resolve_lot(value: str | None):
+    """Returns (lot_id, lot_name) for the 'lot' parameter ('north' o 'LOT#north'), or the default lot."""
+    lot_id = LOT_ID if not value else (value if value.startswith("LOT#") else f"LOT#{value}")
+    name = lot_id.split("#", 1)[-1]
+    if not _SAFE_LOT.match(name):
+        raise ValueError("Formato de lot inválido")
+    return lot_id, name
+
+def lot_predicate(lot: str | None) -> str | None:
+    """Partition filter on the lot, when Gold is partitioned by lot."""
+    if not lot or GOLD_LAYOUT != "lot":
+        return None
+    if not _SAFE_LOT.match(lot):
+        raise ValueError("Formato de lot inválido")
+    return f"lot = '{lot}'"
+
+_TABLE_REF = re.compile(rf'"?{DATABASE}"?\s*\.\s*"?{TABLE}"?', re.IGNORECASE)
+
+def restrict_table(query: str, predicates: list) -> str:
+    """Replaces every reference to the Gold table with a subquery that only reads the rows matching predicates."""
+    predicates = [p for p in predicates if p]
+    if not predicates:
+        return query
+    return _TABLE_REF.sub(f"(SELECT * FROM {DATABASE}.{TABLE} WHERE {' AND '.join(predicates)})", query)
+
+def scope_to_lot(query: str, lot: str | None) -> str:
+    """Restricts a query written against the whole table (templates, LLM SQL) to one lot's partitions."""
+    return restrict_table(query, [lot_predicate(lot)])
+
+def parse_time_bound(value: str, end_of_day: bool) -> datetime:
+    """Parses 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM[:SS][Z]'. A bare date as upper bound means the end of that day."""
+    if _SAFE_DATE.match(value):
+        day = datetime.strptime(value, "%Y-%m-%d")
+        return day + timedelta(hours=23, minutes=59, seconds=59) if end_of_day else day
+    if _SAFE_DATETIME.match(value):
+        value = value.rstrip("Z")
+        fmt = "%Y-%m-%dT%H:%M:%S" if value.count(":") == 2 else "%Y-%m-%dT%H:%M"
+        return datetime.strptime(value, fmt)
+    raise ValueError("Formato de fecha inválido (se espera YYYY-MM-DD o YYYY-MM-DDTHH:MM:SSZ)")
+
+def build_partition_predicate(start: datetime, end: datetime) -> str:
+    """Translates [start, end] into year/month/day predicates so Athena only opens those partitions."""
+    if end < start:
+        raise ValueError("'from' debe ser anterior a 'to'")
+    if (end.date() - start.date()).days >= MAX_RANGE_DAYS:
+        raise ValueError(f"El rango máximo es de {MAX_RANGE_DAYS} días")
+
+    # Un bloque por mes: (year = 'Y' AND month = 'M' AND day BETWEEN 'd1' AND 'd2')
+    months = []
+    day = start.date()
+    while day <= end.date():
+        month_end = (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        last = min(month_end, end.date())
+        months.append(
+            f"(year = '{day:%Y}' AND month = '{day:%m}' AND day BETWEEN '{day:%d}' AND '{last:%d}')"
+        )
+        day = last + timedelta(days=1)
 
-def build_filtered_query(device_id: str | None, date: str | None, limit: int) -> str:
+    return "(" + " OR ".join(months) + ")"
+
+def parse_fields(value: str | None, allowed) -> list | None:
+    """Validates the 'fields' parameter (comma-separated column names). None means every column."""
+    if not value:
+        return None
+    fields = list(dict.fromkeys(f.strip() for f in value.split(",") if f.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if not fields or unknown:
+        raise ValueError(f"Campos desconocidos en 'fields': {', '.join(unknown) or value}. Disponibles: {', '.join(allowed)}")
+    return fields
+
+def encode_cursor(row) -> str:
+    """Opaque cursor pointing just after the given row (its event_timestamp and sensor_id)."""
+    raw = json.dumps([row.get(c) for c in CURSOR_COLUMNS], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Returns (event_timestamp, sensor_id) from a cursor made by encode_cursor."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, sensor_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    if not isinstance(timestamp, str) or not _SAFE_TIMESTAMP.match(timestamp) \
+            or not isinstance(sensor_id, str) or not _SAFE_ID.match(sensor_id):
+        raise ValueError("Cursor inválido")
+    return timestamp, sensor_id
+
+def build_filtered_query(device_id: str | None, date: str | None, limit: int,
+                         time_from: str | None = None, time_to: str | None = None, lot: str | None = None,
+                         fields: list | None = None, cursor: str | None = None) -> str:
     where = []
 
+    if lot_predicate(lot):
+        where.append(lot_predicate(lot))
+
     if device_id:
         if not _SAFE_ID.match(device_id):
             raise ValueError("Formato de device_id inválido")
@@ -98,22 +572,50 @@ def build_filtered_query(device_id: str | None, date: str | None, limit: int) ->
     if date:
         if not _SAFE_DATE.match(date):
             raise ValueError("Formato de fecha inválido (se espera YYYY-MM-DD)")
-        where.append(f"event_date = '{date}'")
+        time_from, time_to = date, date
+
+    if time_to and not time_from:
+        raise ValueError("El parámetro 'to' requiere 'from'")
+
+    cursor_ts = None
+    if cursor:
+        cursor_ts, cursor_sensor = decode_cursor(cursor)
+        # Paginación por clave: solo lo anterior a la última fila devuelta (desempate por sensor_id)
+        where.append(f"(event_timestamp < '{cursor_ts}' OR (event_timestamp = '{cursor_ts}' AND sensor_id < '{cursor_sensor}'))")
+
+    if time_from:
+        start = parse_time_bound(time_from, end_of_day=False)
+        end = parse_time_bound(time_to, end_of_day=True) if time_to else datetime.utcnow()
+        if cursor_ts:
+            # Las páginas siguientes ya no abren los días posteriores al cursor
+            end = max(start, min(end, datetime.strptime(cursor_ts, "%Y-%m-%dT%H:%M:%SZ")))
+        # Poda de particiones + límites exactos dentro de ellas
+        where.append(build_partition_predicate(start, end))
+        where.append(f"event_timestamp >= '{start:%Y-%m-%dT%H:%M:%SZ}'")
+        if time_to:
+            # Sin 'to' no hay cota superior: con la hora actual cada petición sería una SQL (y una entrada
+            # de caché) distinta. La partición de hoy ya acota, y la marca de agua invalida lo nuevo
+            where.append(f"event_timestamp <= '{end:%Y-%m-%dT%H:%M:%SZ}'")
 
     where_clause = ("WHERE " + " AND ".join(where)) if where else ""
+
+    # Las columnas del cursor se leen siempre, aunque 'fields' no las pida
+    columns = fields or GOLD_COLUMNS
+    columns = columns + [c for c in CURSOR_COLUMNS if c not in columns]
     
     # Ordenamos por timestamp descendente para ver lo más reciente primero
     return f"""
-SELECT *
+SELECT {", ".join(columns)}
 FROM {DATABASE}.{TABLE}
 {where_clause}
-ORDER BY event_timestamp DESC
+ORDER BY event_timestamp DESC, sensor_id DESC
 LIMIT {limit}
 """.strip()
 
-def build_latest_status_query(device_id: str | None) -> str:
+def build_latest_status_query(device_id: str | None, lot: str | None = None) -> str:
     """Returns the latest status per sensor, ordered by sensor_id."""
     outer_where = ["rn = 1"]
+    inner_where = f"WHERE {lot_predicate(lot)}" if lot_predicate(lot) else ""
 
     if device_id:
         if not _SAFE_ID.match(device_id):
@@ -123,32 +625,577 @@ def build_latest_status_query(device_id: str | None) -> str:
     where_clause = "WHERE " + " AND ".join(outer_where)
 
     return f"""
-SELECT * FROM (
-    SELECT *, row_number() OVER (PARTITION BY sensor_id ORDER BY event_timestamp DESC) as rn
+SELECT {", ".join(GOLD_COLUMNS)} FROM (
+    SELECT {", ".join(GOLD_COLUMNS)}, row_number() OVER (PARTITION BY sensor_id ORDER BY event_timestamp DESC) as rn
     FROM {DATABASE}.{TABLE}
+    {inner_where}
 )
 {where_clause}
 ORDER BY sensor_id ASC
 """.strip()
 
+# -----------------------------
+# Enrutador de intenciones (sin LLM para las preguntas habituales)
+# -----------------------------
+_LATEST_FROM = f"(SELECT *, row_number() OVER (PARTITION BY sensor_id ORDER BY event_timestamp DESC) as rn FROM {DATABASE}.{TABLE})"
+
+# Mismas queries que los EXAMPLES del prompt de generación de SQL. {spot} se rellena con el ID extraído.
+SQL_TEMPLATES = {
+    "capacity": f"SELECT lot_physical_capacity, lot_usable_spaces FROM {DATABASE}.{TABLE} LIMIT 1",
+    "free": f"SELECT device_id, sensor_id, status, event_time, event_timestamp FROM {_LATEST_FROM} WHERE rn = 1 AND status = 'FREE' ORDER BY sensor_id ASC",
+    "occupied": f"SELECT device_id, sensor_id, status, event_time, event_timestamp FROM {_LATEST_FROM} WHERE rn = 1 AND status = 'OCCUPIED' ORDER BY sensor_id ASC",
+    "count_parked": f"SELECT COUNT(*) as parked_cars FROM {_LATEST_FROM} WHERE rn = 1 AND status = 'OCCUPIED'",
+    "status_all": f"SELECT device_id, sensor_id, status, event_time, event_timestamp FROM {_LATEST_FROM} WHERE rn = 1 ORDER BY sensor_id ASC",
+    "spot_changes": f"SELECT sensor_id, status, event_time, event_date, event_timestamp FROM {DATABASE}.{TABLE} WHERE sensor_id = '{{spot}}' ORDER BY event_timestamp DESC LIMIT 10",
+    "spot_history": f"SELECT sensor_id, status, event_time, event_date, event_timestamp FROM {DATABASE}.{TABLE} WHERE sensor_id = '{{spot}}' ORDER BY event_timestamp DESC LIMIT 20",
+    "violations": f"SELECT sensor_id, status, license_plate, event_timestamp FROM {_LATEST_FROM} WHERE rn = 1 AND status IN ('OCCUPIED_BUT_BOOKED', 'OCCUPIED_MAINTENANCE') ORDER BY sensor_id ASC",
+    "spot_booking": f"SELECT sensor_id, license_plate, booked_until, status FROM {_LATEST_FROM} WHERE rn = 1 AND sensor_id = '{{spot}}'",
+    "booked_waiting": f"SELECT sensor_id, license_plate, booked_until FROM {_LATEST_FROM} WHERE rn = 1 AND status = 'BOOKED_WAITING' ORDER BY sensor_id ASC",
+}
+
+# (intención, ¿necesita plaza?, patrón) en orden de prioridad: las más específicas primero
+INTENT_RULES = [
+    ("spot_booking", True, re.compile(r"\b(quien (ha )?reserv\w*|who (has )?booked|who reserved|matriculas?|license plates?|plates?)\b")),
+    ("spot_history", True, re.compile(r"\b(historial|history|historico)\b")),
+    ("spot_changes", True, re.compile(r"\b(cuando|a que hora|when|what time|cambi\w*|chang\w*)\b")),
+    ("violations", False, re.compile(r"\b(infraccion\w*|violacion\w*|violations?|mal aparcad\w*|wrong spots?|wrong places?|multas?|ilegal\w*|illegal\w*)\b")),
+    ("booked_waiting", False, re.compile(r"\b((reservad\w*|reserved|booked)(\s+\w+){0,3}\s+(vaci\w*|libres?|empty|free)|esperando|waiting)\b")),
+    ("capacity", False, re.compile(r"\b(capacidad|capacity|cuantas plazas (hay|tiene)|how many (spots|spaces|places) (are there|does|do|in total)|total (spots|spaces|plazas))\b")),
+    ("count_parked", False, re.compile(r"\b(cuantos (coches|vehiculos|autos)|how many (cars|vehicles))\b")),
+    ("status_all", False, re.compile(r"\b(estado de (todas|las plazas|cada plaza)|status of (all|every|each)|all (the )?spots|todas las plazas)\b")),
+    ("free", False, re.compile(r"\b(libres?|disponibles?|donde (puedo )?aparcar|donde aparco|free|available|where (can|could|should) i park|empty)\b")),
+    ("occupied", False, re.compile(r"\b(ocupad\w*|occupied|taken)\b")),
+]
+
+# Preguntas que las plantillas no saben responder: negaciones (invierten la plantilla) y momentos
+# distintos de "ahora" (las plantillas solo dan el estado actual). Van directas al LLM
+_NEGATION = re.compile(r"\b(not|no|none|nothing|never|sin|ningun\w*|nada|nunca|nadie)\b|n't\b")
+_NOT_NOW = re.compile(
+    r"\b(tomorrow|tonight|yesterday|later|morning|afternoon|evening|next|ago|last (night|week|month|year)|"
+    r"manana|ayer|tarde|noche|luego|despues|proxim\w*|pasad\w*|semana|week\w*|mes|month\w*)\b")
+
+_SPOT_ID = re.compile(r"\b(?:spot|plaza|place|sitio)\s*[-_#]?\s*(?:n(?:o|um|umero|º)?\.?\s*)?(\d{1,3})\b")
+
+# Memo de preguntas ya vistas -> SQL generado por el LLM (contenedor caliente)
+_sql_memo = OrderedDict()
+SQL_MEMO_MAX_ENTRIES = int(os.environ.get("SQL_MEMO_MAX_ENTRIES", "256"))
+
+def normalize_prompt(prompt: str) -> str:
+    """Lowercase, accent-free, single-spaced version of the question."""
+    text = unicodedata.normalize("NFKD", prompt.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[¿?¡!.,;]", " ", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def extract_spot_id(text: str) -> str | None:
+    match = _SPOT_ID.search(text)
+    return f"spot-{int(match.group(1)):02d}" if match else None
+
+def route_intent(prompt: str):
+    """Maps common questions to a SQL template. Returns (intent, sql) or (None, None)."""
+    text = normalize_prompt(prompt)
+    spot = extract_spot_id(text)
+    # "plaza no 5" es un número de plaza, no una negación
+    words = _SPOT_ID.sub(" ", text)
+    if _NEGATION.search(words) or _NOT_NOW.search(words):
+        return None, None
+
+    for intent, needs_spot, pattern in INTENT_RULES:
+        if needs_spot and not spot:
+            continue
+        if pattern.search(text):
+            return intent, SQL_TEMPLATES[intent].format(spot=spot)
+
+    # Una plaza concreta sin más contexto: su estado actual
+    if spot:
+        return "spot_booking", SQL_TEMPLATES["spot_booking"].format(spot=spot)
+    return None, None
+
+def memo_get(prompt: str) -> str | None:
+    key = normalize_prompt(prompt)
+    sql = _sql_memo.get(key)
+    if sql is not None:
+        _sql_memo.move_to_end(key)
+    return sql
+
+def memo_put(prompt: str, sql: str) -> None:
+    key = normalize_prompt(prompt)
+    _sql_memo[key] = sql
+    _sql_memo.move_to_end(key)
+    while len(_sql_memo) > SQL_MEMO_MAX_ENTRIES:
+        _sql_memo.popitem(last=False)
+
+# -----------------------------
+# Guardia de coste para la SQL generada por el LLM
+# -----------------------------
+LLM_SQL_DEFAULT_DAYS = int(os.environ.get("LLM_SQL_DEFAULT_DAYS", "30"))  # Ventana si la SQL no trae fechas
+LLM_SQL_MAX_ROWS = int(os.environ.get("LLM_SQL_MAX_ROWS", "200"))
+LLM_SQL_MAX_BYTES_SCANNED = int(os.environ.get("LLM_SQL_MAX_BYTES_SCANNED", str(1024 ** 3)))  # 0 = sin límite
+
+# Columnas que describe el modelo de datos de los prompts (un SELECT * se reduce a ellas)
+LLM_SQL_COLUMNS = [
+    "device_id", "sensor_id", "status", "license_plate", "booked_until", "db_reservation_state",
+    "event_timestamp", "event_date", "event_time", "lot_physical_capacity", "lot_usable_spaces"
+]
+
+# Comentarios y literales: los comentarios se eliminan y el contenido de los literales no se analiza
+_SQL_COMMENT_OR_LITERAL = re.compile(r"--[^\n]*|/\*.*?(?:\*/|$)|'(?:[^']|'')*'", re.DOTALL)
+_SQL_FORBIDDEN = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|DROP|CREATE|ALTER|TRUNCATE|UNLOAD|MSCK|GRANT|REVOKE|CALL|EXECUTE|PREPARE|"
+    r"DEALLOCATE|DESCRIBE|SHOW|EXPLAIN|VACUUM|OPTIMIZE)\b", re.IGNORECASE)
+# Funciones con la sintaxis "x FROM y" que no leen ninguna tabla
+_SQL_FROM_FUNCTIONS = re.compile(r"\b(EXTRACT|SUBSTRING|TRIM)\s*\(([^()]*)\)", re.IGNORECASE)
+_SQL_FROM = re.compile(r"\bFROM\b", re.IGNORECASE)
+# Fin de la cláusula FROM (al mismo nivel de paréntesis) y separadores de sus elementos
+_SQL_FROM_END = re.compile(r"\b(?:WHERE|GROUP|ORDER|HAVING|LIMIT|OFFSET|FETCH|WINDOW|UNION|INTERSECT|EXCEPT)\b", re.IGNORECASE)
+_SQL_FROM_SEPARATOR = re.compile(r",|\b(?:(?:CROSS|INNER|NATURAL|(?:LEFT|RIGHT|FULL)(?:\s+OUTER)?)\s+)?JOIN\b", re.IGNORECASE)
+_SQL_JOIN_CONDITION = re.compile(r"\b(?:ON|USING)\b", re.IGNORECASE)
+_SQL_CTE_NAME = re.compile(r"\b(\w+)\s+AS\s*\(", re.IGNORECASE)
+# Solo un filtro por día acota de verdad el escaneo (year = '2026' abre el año entero)
+_SQL_PARTITION_FILTER = re.compile(r"\bday\s*(?:[<>=]|BETWEEN\b|IN\b)", re.IGNORECASE)
+_SQL_SELECT_STAR = re.compile(r"\bSELECT\s+(?:DISTINCT\s+)?(\*)", re.IGNORECASE)
+_SQL_LIMIT = re.compile(r"\bLIMIT\s+(\d+)", re.IGNORECASE)
+
+def _blank(text: str) -> str:
+    return re.sub(r"[^\n]", " ", text)
+
+def split_sql(sql: str):
+    """
+    Returns (clean, masked): the query without comments, and the same text with the content of its
+    string literals blanked out. Both have the same length, so positions found in masked apply to clean.
+    """
+    clean = _SQL_COMMENT_OR_LITERAL.sub(lambda m: m.group() if m.group().startswith("'") else _blank(m.group()), sql)
+    masked = _SQL_COMMENT_OR_LITERAL.sub(lambda m: "'" + _blank(m.group()[1:-1]) + "'" if m.group().startswith("'") else _blank(m.group()), clean)
+    return clean, masked
+
+def _depths(masked: str) -> list:
+    """Parenthesis depth at each position of the query."""
+    depths, depth = [], 0
+    for char in masked:
+        if char == ")":
+            depth -= 1
+        depths.append(depth)
+        if char == "(":
+            depth += 1
+    return depths
+
+def from_items(masked: str, depths: list):
+    """Yields every table-like item of every FROM clause: comma-separated sources and JOIN targets."""
+    for match in _SQL_FROM.finditer(masked):
+        depth = depths[match.start()]
+        pos = end = match.end()
+        # La cláusula termina al cerrar su paréntesis o en la primera palabra clave de su mismo nivel
+        while end < len(masked) and depths[end] >= depth:
+            if depths[end] == depth and (masked[end] == ")" or _SQL_FROM_END.match(masked, end)):
+                break
+            end += 1
+        for separator in _SQL_FROM_SEPARATOR.finditer(masked, pos, end):
+            if depths[separator.start()] == depth:
+                yield masked[pos:separator.start()]
+                pos = separator.end()
+        yield masked[pos:end]
+
+def guard_llm_sql(sql: str, lot: str | None, today: datetime | None = None):
+    """
+    Checks and rewrites an LLM-generated query before it reaches Athena, so one question can never
+    trigger an unbounded scan. Rejects anything but a single SELECT on the Gold table (ValueError), then
+    restricts it to the lot and to a partition window, reduces a top-level SELECT * to the columns the
+    answer uses and caps its LIMIT. Returns (query, rewrites applied).
+    """
+    today = today or datetime.utcnow()
+    clean, masked = split_sql(sql.strip())
+    # Un único ';' final es aceptable
+    stripped = masked.rstrip().rstrip(";").rstrip()
+    clean, masked = clean[:len(stripped)], stripped
+    rewrites = []
+
+    if ";" in masked:
+        raise ValueError("Solo se permite una sentencia SQL")
+    if not re.match(r"\s*(SELECT|WITH)\b", masked, re.IGNORECASE):
+        raise ValueError("Solo se permiten consultas SELECT")
+    forbidden = _SQL_FORBIDDEN.search(masked)
+    if forbidden:
+        raise ValueError(f"Sentencia no permitida: {forbidden.group(1).upper()}")
+
+    tables = _SQL_FROM_FUNCTIONS.sub(lambda m: m.group(1) + "(" + _blank(m.group(2)) + ")", masked)
+    ctes = {name.lower() for name in _SQL_CTE_NAME.findall(tables)}
+    depths = _depths(masked)
+    # Cada elemento de cada FROM (también los de "FROM a, b" y los JOIN) debe ser la tabla Gold o un CTE
+    for item in from_items(tables, depths):
+        item = _SQL_JOIN_CONDITION.split(item, 1)[0].strip()
+        if not item or item.startswith("(") or re.match(r"\w+\s*\(", item):
+            continue  # Subconsulta (se revisa su propio FROM), UNNEST(...) o función (from_iso8601_timestamp(...))
+        target = re.match(r"[^\s(),]+", item).group()
+        if not _TABLE_REF.fullmatch(target) and target.lower() not in ctes:
+            raise ValueError(f"Solo se puede consultar la tabla {DATABASE}.{TABLE}")
+    if not _TABLE_REF.search(masked):
+        raise ValueError(f"La consulta debe leer la tabla {DATABASE}.{TABLE}")
+
+    # SELECT * de primer nivel sobre la tabla (o sobre un SELECT * de ella) -> solo las columnas del modelo
+    for match in reversed(list(_SQL_SELECT_STAR.finditer(masked))):
+        star = match.start(1)
+        if depths[star] != 0:
+            continue
+        from_match = next((m for m in re.finditer(r"\bFROM\b", masked[star:], re.IGNORECASE)
+                           if depths[star + m.start()] == 0), None)
+        source = masked[star + from_match.end():].lstrip() if from_match else ""
+        if _TABLE_REF.match(source) or re.match(r"\(\s*SELECT\s+\*", source, re.IGNORECASE):
+            clean = clean[:star] + ", ".join(LLM_SQL_COLUMNS) + clean[star + 1:]
+            masked = masked[:star] + _blank(", ".join(LLM_SQL_COLUMNS)) + masked[star + 1:]
+            depths = _depths(masked)
+            rewrites.append("columns")
+
+    # LIMIT de primer nivel: se añade si falta y se recorta si supera LLM_SQL_MAX_ROWS
+    limits = [m for m in _SQL_LIMIT.finditer(masked) if depths[m.start()] == 0]
+    if not limits:
+        clean = f"{clean} LIMIT {LLM_SQL_MAX_ROWS}"
+        rewrites.append("limit")
+    elif int(limits[-1].group(1)) > LLM_SQL_MAX_ROWS:
+        clean = clean[:limits[-1].start(1)] + str(LLM_SQL_MAX_ROWS) + clean[limits[-1].end(1):]
+        rewrites.append("limit")
+
+    # Ventana de particiones: la de las fechas de la propia query, o los últimos LLM_SQL_DEFAULT_DAYS días
+    window = None
+    if not _SQL_PARTITION_FILTER.search(masked):
+        dates = _SQL_DATE.findall(clean)
+        if dates:
+            start = datetime.strptime(min(dates), "%Y-%m-%d")
+            end = today if query_touches_today(clean) else datetime.strptime(max(dates), "%Y-%m-%d")
+        else:
+            start, end = today - timedelta(days=LLM_SQL_DEFAULT_DAYS - 1), today
+        window = build_partition_predicate(start, max(start, end))
+        rewrites.append("partition_window")
+
+    return restrict_table(clean, [lot_predicate(lot), window]), rewrites
+
+# -----------------------------
+# Estado actual materializado (DynamoDB)
+# -----------------------------
+def _as_athena_value(value):
+    """Formats a DynamoDB value the way Athena returns it (VarCharValue strings)."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def read_status_records(lot_id: str = LOT_ID, since_version: int | None = None, consistent: bool = False) -> list:
+    """STATUS# records of the lot (only those changed after since_version, if given)."""
+    table = dynamodb.Table(STATE_TABLE)
+    query_kwargs = {
+        "KeyConditionExpression": Key("LotID").eq(lot_id) & Key("EntityID").begins_with("STATUS#")
+    }
+    if since_version is not None:
+        query_kwargs["FilterExpression"] = Attr("StateVersion").gt(since_version)
+    if consistent:
+        query_kwargs["ConsistentRead"] = True
+    records = []
+    while True:
+        with metrics.stage("state_store_read"):
+            resp = table.query(**query_kwargs)
+        records.extend(item.get("Record", {}) for item in resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            break
+        query_kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return records
+
+def status_rows(records: list, device_id: str | None):
+    """Result (Athena shape) with the records of device_id (or all of them), ordered by sensor_id."""
+    if device_id:
+        records = [r for r in records if r.get("device_id") == device_id]
+    records = sorted(records, key=lambda r: r.get("sensor_id") or "")
+
+    rows = [{c: _as_athena_value(r.get(c)) for c in GOLD_COLUMNS} for r in records]
+    return {"columns": list(GOLD_COLUMNS) if rows else [], "rows": rows}
+
+def read_latest_status(device_id: str | None, lot_id: str = LOT_ID, since_version: int | None = None,
+                       consistent: bool = False):
+    """Returns the latest status per sensor from the state store, ordered by sensor_id.
+
+    With since_version, only the spots whose status changed after that version of the change feed.
+    """
+    if device_id and not _SAFE_ID.match(device_id):
+        raise ValueError("Formato de device_id inválido")
+    return status_rows(read_status_records(lot_id, since_version, consistent), device_id)
+
+def latest_status_from_store(device_id: str | None, lot_id: str = LOT_ID):
+    """
+    Latest status from the state store, or None if the lot has no STATUS# records yet (the caller then
+    asks Athena). A device_id without records is an empty result, not a reason to scan the history.
+    """
+    if device_id and not _SAFE_ID.match(device_id):
+        raise ValueError("Formato de device_id inválido")
+    records = read_status_records(lot_id)
+    return status_rows(records, device_id) if records else None
+
+# -----------------------------
+# Feed de cambios (STATE#VERSION y StateVersion de cada STATUS#, mantenidos por data-processing)
+# -----------------------------
+STATE_VERSION_ID = "STATE#VERSION"
+
+def read_state_version(lot_id: str = LOT_ID) -> int:
+    """Current version of the lot's state: grows by one every time some spots change status."""
+    with metrics.stage("state_version_read"):
+        item = dynamodb.Table(STATE_TABLE).get_item(
+            Key={"LotID": lot_id, "EntityID": STATE_VERSION_ID}, ConsistentRead=True
+        ).get("Item", {})
+    return int(item.get("StateVersion", 0))
+
+def make_etag(lot_id: str, version: int) -> str:
+    return f'"{lot_id.split("#", 1)[-1]}-{version}"'
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match check (several ETags, weak W/ prefixes and '*' allowed)."""
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or etag in (c[2:] if c.startswith("W/") else c for c in candidates)
+
+# -----------------------------
+# Agregados de ocupación (ROLLUP#HOUR# / ROLLUP#DAY#, mantenidos por data-processing)
+# -----------------------------
+ROLLUP_HOUR_PREFIX = "ROLLUP#HOUR#"
+ROLLUP_DAY_PREFIX = "ROLLUP#DAY#"
+STATS_MAX_HOUR_RANGE_DAYS = 31  # Con granularity=hour: como mucho 744 filas
+
+HOUR_STATS_COLUMNS = ["hour", "occupied_minutes", "average_occupied", "occupancy_rate", "peak_occupied", "capacity"]
+DAY_STATS_COLUMNS = ["date", "occupied_minutes", "average_occupied", "occupancy_rate", "peak_occupied",
+                     "violations", "violations_booked", "violations_maintenance"]
+
+def _query_rollups(lot_id: str, first_key: str, last_key: str):
+    table = dynamodb.Table(STATE_TABLE)
+    query_kwargs = {"KeyConditionExpression": Key("LotID").eq(lot_id) & Key("EntityID").between(first_key, last_key)}
+    items = []
+    while True:
+        with metrics.stage("rollup_read"):
+            resp = table.query(**query_kwargs)
+        items.extend(resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            break
+        query_kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return items
+
+def _occupancy_figures(seconds, hours, capacity):
+    """(occupied_minutes, average_occupied, occupancy_rate) for `seconds` of occupancy over `hours` hours."""
+    average = seconds / (3600.0 * hours) if hours else 0.0
+    rate = average / capacity if capacity else None
+    return round(seconds / 60.0, 1), round(average, 2), (round(rate, 4) if rate is not None else None)
+
+def read_stats(granularity: str, date_from: str, date_to: str, sensor_id: str | None = None, lot_id: str = LOT_ID):
+    """
+    Occupancy statistics between two dates (inclusive) from the rollups, without Athena.
+    With sensor_id the occupancy figures refer to that spot alone (capacity 1).
+    """
+    if granularity not in ("hour", "day"):
+        raise ValueError("granularity debe ser 'hour' o 'day'")
+    if not (_SAFE_DATE.match(date_from) and _SAFE_DATE.match(date_to)):
+        raise ValueError("Formato de fecha inválido (se espera YYYY-MM-DD)")
+    if sensor_id and not _SAFE_ID.match(sensor_id):
+        raise ValueError("Formato de sensor_id inválido")
+
+    days = (datetime.strptime(date_to, "%Y-%m-%d") - datetime.strptime(date_from, "%Y-%m-%d")).days
+    max_days = STATS_MAX_HOUR_RANGE_DAYS if granularity == "hour" else MAX_RANGE_DAYS
+    if days < 0:
+        raise ValueError("'from' debe ser anterior a 'to'")
+    if days >= max_days:
+        raise ValueError(f"El rango máximo con granularity={granularity} es de {max_days} días")
+
+    def occupied_seconds(item):
+        key = f"Occupied_{sensor_id}" if sensor_id else "OccupiedSeconds"
+        return float(item.get(key, 0))
+
+    def capacity_of(item):
+        return 1 if sensor_id else int(item.get("Capacity", 0))
+
+    hour_items = _query_rollups(lot_id, f"{ROLLUP_HOUR_PREFIX}{date_from}T00", f"{ROLLUP_HOUR_PREFIX}{date_to}T23")
+
+    if granularity == "hour":
+        rows = []
+        for item in hour_items:
+            capacity = capacity_of(item)
+            minutes, average, rate = _occupancy_figures(occupied_seconds(item), 1, capacity)
+            peak = None if sensor_id else item.get("PeakOccupied")
+            rows.append(dict(zip(HOUR_STATS_COLUMNS, map(_as_athena_value, [
+                item["EntityID"][len(ROLLUP_HOUR_PREFIX):], minutes, average, rate, peak, capacity
+            ]))))
+        return {"columns": list(HOUR_STATS_COLUMNS) if rows else [], "rows": rows}
+
+    # Por día: las horas se suman (la media es sobre las horas con datos) y las infracciones salen de ROLLUP#DAY#
+    by_date = {}
+    for item in hour_items:
+        day = by_date.setdefault(item["EntityID"][len(ROLLUP_HOUR_PREFIX):][:10],
+                                 {"seconds": 0.0, "hours": 0, "peak": None, "capacity": 0, "violations": {}})
+        day["seconds"] += occupied_seconds(item)
+        day["hours"] += 1
+        day["capacity"] = max(day["capacity"], capacity_of(item))
+        if not sensor_id and "PeakOccupied" in item:
+            day["peak"] = max(day["peak"] or 0, int(item["PeakOccupied"]))
+
+    for item in _query_rollups(lot_id, f"{ROLLUP_DAY_PREFIX}{date_from}", f"{ROLLUP_DAY_PREFIX}{date_to}"):
+        day = by_date.setdefault(item["EntityID"][len(ROLLUP_DAY_PREFIX):],
+                                 {"seconds": 0.0, "hours": 0, "peak": None, "capacity": 0, "violations": {}})
+        day["violations"] = item
+
+    rows = []
+    for date in sorted(by_date):
+        day = by_date[date]
+        minutes, average, rate = _occupancy_figures(day["seconds"], day["hours"], day["capacity"])
+        violations = day["violations"]
+        counts = [violations.get("Violations", 0), violations.get("Violations_OCCUPIED_BUT_BOOKED", 0),
+                  violations.get("Violations_OCCUPIED_MAINTENANCE", 0)]
+        if sensor_id:
+            counts = [None, None, None]  # Las infracciones solo se agregan por parking
+        rows.append(dict(zip(DAY_STATS_COLUMNS, map(_as_athena_value, [
+            date, minutes, average, rate, day["peak"], *counts
+        ]))))
+    return {"columns": list(DAY_STATS_COLUMNS) if rows else [], "rows": rows}
+
+# Preguntas analíticas que se responden con los agregados en lugar de Athena
+STATS_QUESTION = re.compile(
+    r"how busy|busiest|average occupancy|occupancy rate|peak|per hour|hourly|by hour|"
+    r"ocupacion (media|promedio|por hora|por dia)|media de ocupacion|porcentaje de ocupacion|hora punta|pico"
+)
+# Recuentos de infracciones de un periodo pasado (las actuales siguen yendo a la plantilla "violations")
+_STATS_VIOLATIONS = re.compile(r"(infracciones|violations).*\b(ayer|yesterday|semana|week|mes|month)\b")
+_STATS_HOURLY = re.compile(r"per hour|hourly|by hour|each hour|por hora|cada hora")
+
+def route_stats_question(prompt: str, today=None):
+    """Maps analytical questions to a rollup read. Returns (granularity, from, to) or None."""
+    text = normalize_prompt(prompt)
+    about_violations = bool(_STATS_VIOLATIONS.search(text))
+    if not (STATS_QUESTION.search(text) or about_violations):
+        return None
+
+    today = today or datetime.utcnow().date()
+    if re.search(r"yesterday|ayer", text):
+        start = end = today - timedelta(days=1)
+    elif re.search(r"(this|last|past) (week|7 days)|(esta|ultima) semana|ultimos 7 dias", text):
+        start, end = today - timedelta(days=6), today
+    elif re.search(r"(this|last|past) month|(este|ultimo) mes|ultimos 30 dias", text):
+        start, end = today - timedelta(days=29), today
+    else:
+        start = end = today
+
+    # Un solo día se desglosa por horas, salvo que solo interesen las infracciones (que son diarias)
+    hourly = _STATS_HOURLY.search(text) or (start == end and not about_violations)
+    granularity = "hour" if hourly else "day"
+    return granularity, start.isoformat(), end.isoformat()
+
+# -----------------------------
+# Panel del dashboard (varias vistas en una sola petición)
+# -----------------------------
+DASHBOARD_VIEWS = ("latest", "history", "violations")
+
+def parse_views(value: str | None) -> list:
+    """'latest,violations' -> ['latest', 'violations'] (all the views by default)."""
+    if not value:
+        return list(DASHBOARD_VIEWS)
+    views = list(dict.fromkeys(v.strip().lower() for v in value.split(",") if v.strip()))
+    unknown = [v for v in views if v not in DASHBOARD_VIEWS]
+    if unknown or not views:
+        raise ValueError(f"Vistas desconocidas: {', '.join(unknown) or value}. Usa {', '.join(DASHBOARD_VIEWS)}.")
+    return views
+
+def build_violations_query(lot: str | None) -> str:
+    """Spots whose latest status is a violation (same query as the 'violations' intent)."""
+    return scope_to_lot(SQL_TEMPLATES["violations"], lot)
+
+# -----------------------------
+# Forma de la respuesta (páginas, proyección, formato columnar)
+# -----------------------------
+RESPONSE_FORMATS = ("rows", "columnar")
+
+def parse_format(value: str | None) -> str:
+    fmt = (value or "rows").lower()
+    if fmt not in RESPONSE_FORMATS:
+        raise ValueError(f"Formato '{fmt}' desconocido. Usa 'rows' o 'columnar'.")
+    return fmt
+
+def paginate(result, limit: int):
+    """Trims the extra row fetched by the filters query; if there was one, adds the cursor of the next page."""
+    rows = result["rows"]
+    if len(rows) <= limit:
+        return result
+    page = dict(result, rows=rows[:limit])
+    page["next_cursor"] = encode_cursor(rows[limit - 1])
+    return page
+
+def shape_result(result, fields: list | None = None, fmt: str = "rows"):
+    """Keeps only the requested columns and, with fmt='columnar', lists each column once with its values.
+
+    In the columnar form, columns with the same value on every row (the lot constants) go to
+    'constants' instead of being repeated. The cached result is never modified.
+    """
+    columns = [c for c in fields if c in result["columns"]] if fields else result["columns"]
+    extra = {k: v for k, v in result.items() if k not in ("columns", "rows")}
+    rows = result["rows"]
+
+    if fmt != "columnar":
+        if fields:
+            rows = [{c: r.get(c) for c in columns} for r in rows]
+        return {"columns": columns, "rows": rows, **extra}
+
+    shaped = {"columns": [], "values": [], "constants": {}, "row_count": len(rows)}
+    for c in columns:
+        values = [r.get(c) for r in rows]
+        if len(values) > 1 and values.count(values[0]) == len(values):
+            shaped["constants"][c] = values[0]
+        else:
+            shaped["columns"].append(c)
+            shaped["values"].append(values)
+    shaped.update(extra)
+    return shaped
+
 # -----------------------------
 # Auxiliar para CORS
 # -----------------------------
-def make_response(status_code, body_dict):
+# Compresión gzip de las respuestas (requiere binary media types en API Gateway, ver CONFIG.md)
+RESPONSE_GZIP = os.environ.get("RESPONSE_GZIP", "false").lower() == "true"
+RESPONSE_GZIP_MIN_BYTES = int(os.environ.get("RESPONSE_GZIP_MIN_BYTES", "1024"))
+RESPONSE_GZIP_LEVEL = 5  # Casi la misma reducción que 9, en mucho menos tiempo
+
+def make_response(status_code, body_dict, headers=None):
     return {
         "statusCode": status_code,
         "headers": {
             "Access-Control-Allow-Origin": "*",
-            "Access-Control-Allow-Headers": "Content-Type,Authorization",
-            "Access-Control-Allow-Methods": "OPTIONS,GET,POST"
+            "Access-Control-Allow-Headers": "Content-Type,Authorization,If-None-Match",
+            "Access-Control-Allow-Methods": "OPTIONS,GET,POST",
+            "Access-Control-Expose-Headers": "ETag",
+            **(headers or {})
         },
-        "body": json.dumps(body_dict)
+        "body": json.dumps(body_dict, separators=(",", ":")) if body_dict is not None else ""
     }
 
+def request_header(event, name: str) -> str | None:
+    """Case-insensitive lookup of a request header (API Gateway keeps the client's casing)."""
+    headers = event.get("headers") or {}
+    return next((v for k, v in headers.items() if k.lower() == name.lower()), None)
+
+def accepts_gzip(event) -> bool:
+    return "gzip" in (request_header(event, "Accept-Encoding") or "").lower()
+
+def encode_response(response, event):
+    """Gzips large bodies when the client accepts it (API Gateway decodes isBase64Encoded bodies)."""
+    body = response["body"].encode("utf-8")
+    metrics.value("response_bytes", len(body), "Bytes")
+    if not RESPONSE_GZIP or len(body) < RESPONSE_GZIP_MIN_BYTES or not accepts_gzip(event):
+        return response
+
+    with metrics.stage("gzip"):
+        compressed = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+    metrics.value("response_gzip_bytes", len(compressed), "Bytes")
+    headers = dict(response["headers"], **{"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+    return dict(response, headers=headers, body=base64.b64encode(compressed).decode("ascii"), isBase64Encoded=True)
+
 # -----------------------------
 # HANDLER PRINCIPAL (Enrutador)
 # -----------------------------
+@metrics.handler
 def lambda_handler(event, context):
+    return encode_response(route_request(event), event)
+
+def route_request(event):
     if event.get("httpMethod") == "OPTIONS":
         return make_response(200, {"ok": True})
 
@@ -156,16 +1203,27 @@ def lambda_handler(event, context):
     
     # Por defecto usaremos el modo LLM si no se especifica
     mode = params.get("mode", "llm").lower()
+    metrics.set_property("Mode", mode)
     print("Modo seleccionado:", mode)
 
+    # Parking consultado (un despliegue sirve a todos los parkings de la tabla)
+    try:
+        lot_id, lot = resolve_lot(params.get("lot"))
+    except ValueError as e:
+        return make_response(400, {"error": str(e)})
+
     # ==========================================
     # MODO 1: FILTROS DIRECTOS (Dashboards/Diagramas)
     # ==========================================
     if mode == "filters":
         device_id = params.get("device_id")
         date = params.get("date")
+        time_from = params.get("from")
+        time_to = params.get("to")
         latest = params.get("latest", "false").lower() == "true"
+        run_async = params.get("async", "false").lower() == "true"
         limit_raw = params.get("limit", "100")
+        cursor = params.get("cursor")
 
         try:
             limit = int(limit_raw)
@@ -174,16 +1232,49 @@ def lambda_handler(event, context):
             return make_response(400, {"error": "El límite (limit) debe ser un número entero"})
 
         try:
+            fields = parse_fields(params.get("fields"), GOLD_COLUMNS)
+            fmt = parse_format(params.get("format"))
+            query = None
+            source = "athena"
             if latest:
-                query = build_latest_status_query(device_id=device_id)
+                # Lectura directa del estado materializado; Athena solo si el parking aún no tiene registros
+                result = latest_status_from_store(device_id=device_id, lot_id=lot_id)
+                source = "dynamodb"
+                if result is None:
+                    query = build_latest_status_query(device_id=device_id, lot=lot)
+                    result, cache_hit = cached_athena_query(query, lot_id)
+                    source = "cache" if cache_hit else "athena"
             else:
-                query = build_filtered_query(device_id=device_id, date=date, limit=limit)
-            result = run_athena_query(query)
-            return make_response(200, {
-                "mode": "filters", 
+                # En modo síncrono se pide una fila de más para saber si hay otra página
+                query = build_filtered_query(device_id=device_id, date=date, limit=limit if run_async else limit + 1,
+                                             time_from=time_from, time_to=time_to, lot=lot,
+                                             fields=fields, cursor=cursor)
+                if run_async:
+                    # Devuelve el identificador de la query al instante; el cliente la recoge con mode=result
+                    qid = start_athena_query(query)
+                    return make_response(202, {
+                        "mode": "filters",
+                        "lot": lot_id,
+                        "query": query,
+                        "query_id": qid,
+                        "state": "QUEUED"
+                    })
+                result, cache_hit = cached_athena_query(query, lot_id)
+                result = paginate(result, limit)
+                source = "cache" if cache_hit else "athena"
+            body = {
+                "mode": "filters",
+                "lot": lot_id,
                 "query": query, 
-                "result": result
-            })
+                "source": source,
+                "result": shape_result(result, fields, fmt)
+            }
+            if fmt == "columnar":
+                # El formato compacto no repite la SQL
+                del body["query"]
+            return make_response(200, body)
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
         except Exception as e:
             return make_response(500, {"error": str(e)})
 
@@ -198,8 +1289,22 @@ def lambda_handler(event, context):
 
         try:
             get_secret()
-            
-            # STEP 1: Generate the SQL Query
+
+            # STEP 0: Preguntas analíticas ("how busy was it yesterday") -> agregados en DynamoDB
+            stats_route = route_stats_question(user_prompt)
+            stats_result = read_stats(*stats_route, lot_id=lot_id) if stats_route else None
+
+            # STEP 1: Generate the SQL Query (plantilla local o memo antes de recurrir al LLM)
+            sql_rewrites = []
+            if stats_result and stats_result["rows"]:
+                intent, sql_query, sql_source = f"stats_{stats_route[0]}", None, "rollups"
+            else:
+                intent, sql_query = route_intent(user_prompt)
+                sql_source = "template"
+                if sql_query is None:
+                    sql_query = memo_get(user_prompt)
+                    sql_source = "memo"
+
             sql_gen_prompt = f"""
             Generate a SQL query for AWS Athena (Presto SQL).
             Table: `{DATABASE}.{TABLE}`
@@ -245,22 +1350,42 @@ def lambda_handler(event, context):
             4. If the user's question is NOT related to the parking system (spots, availability, capacity, status, parking), return ONLY the text: NOT_PARKING_RELATED
             """
             
-            raw_sql_query = ask_llm(sql_gen_prompt)
-            sql_query = raw_sql_query.replace("```sql", "").replace("```", "").strip()
-
-            # Check if the LLM flagged the question as off-topic
-            if "NOT_PARKING_RELATED" in sql_query.upper():
-                return make_response(200, {
-                    "output": "Lo siento, solo puedo ayudarte con preguntas sobre el parking: plazas libres, ocupadas, capacidad, etc. ¿En qué puedo ayudarte?",
-                    "sql": None,
-                    "result": {"columns": [], "rows": []}
-                })
-            
-            if "SELECT" not in sql_query.upper():
-                 return make_response(400, {"error": "El LLM no pudo generar una query válida", "debug": sql_query})
+            if sql_query is None and sql_source != "rollups":
+                raw_sql_query = ask_llm(sql_gen_prompt, stage="llm_sql")
+                sql_query = raw_sql_query.replace("```sql", "").replace("```", "").strip()
+                sql_source = "llm"
+                if "SELECT" in sql_query.upper() or "NOT_PARKING_RELATED" in sql_query.upper():
+                    memo_put(user_prompt, sql_query)
+            print(f"[DEBUG] SQL source: {sql_source} ({intent})")
+
+            if sql_source == "rollups":
+                athena_results = stats_result
+            else:
+                # Check if the LLM flagged the question as off-topic
+                if "NOT_PARKING_RELATED" in sql_query.upper():
+                    return make_response(200, {
+                        "output": "Lo siento, solo puedo ayudarte con preguntas sobre el parking: plazas libres, ocupadas, capacidad, etc. ¿En qué puedo ayudarte?",
+                        "sql": None,
+                        "result": {"columns": [], "rows": []}
+                    })
+
+                if "SELECT" not in sql_query.upper():
+                     return make_response(400, {"error": "El LLM no pudo generar una query válida", "debug": sql_query})
 
-            # PASO 2: Ejecutar en Athena
-            athena_results = run_athena_query(sql_query)
+                # PASO 2: Ejecutar en Athena (solo las particiones del parking consultado).
+                # La SQL del LLM (también la memorizada) pasa antes por la guardia de coste.
+                if sql_source == "template":
+                    sql_query = scope_to_lot(sql_query, lot)
+                    max_bytes = None
+                else:
+                    try:
+                        sql_query, sql_rewrites = guard_llm_sql(sql_query, lot)
+                    except ValueError as e:
+                        metrics.count("llm_sql_rejected")
+                        return make_response(400, {"error": f"La query generada no es válida: {e}", "debug": sql_query})
+                    print(f"[DEBUG] SQL rewrites: {sql_rewrites}")
+                    max_bytes = LLM_SQL_MAX_BYTES_SCANNED or None
+                athena_results, _ = cached_athena_query(sql_query, lot_id, max_bytes=max_bytes)
 
             # STEP 3: Generate final response (RAG)
             rag_prompt = f"""
@@ -276,6 +1401,7 @@ def lambda_handler(event, context):
             - license_plate = the license plate of the car that booked the spot.
             - booked_until = when the reservation expires.
             - The data consists of status change events. If filtered with row_number, each row represents the most recent state of each spot.
+            - If the rows have occupied_minutes / occupancy_rate columns they are occupancy STATISTICS per hour or per day instead: average_occupied = average number of cars parked, occupancy_rate = fraction of the capacity in use (0.42 = 42%), peak_occupied = most cars parked at the same time, violations = cars parked on booked or out-of-order spots.
 
             Real sensor data:
             {json.dumps(athena_results['rows'])}
@@ -298,19 +1424,199 @@ def lambda_handler(event, context):
             - IMPORTANT: Reply in the SAME LANGUAGE as the user's question. Detect the language of the question and respond accordingly.
             """
             
-            final_response = ask_llm(rag_prompt)
+            final_response = ask_llm(rag_prompt, stage="llm_answer")
 
             return make_response(200, {
                 "output": final_response,
                 "sql": sql_query,
+                "sql_source": sql_source,
+                "sql_rewrites": sql_rewrites,
                 "result": athena_results
             })
 
         except Exception as e:
             return make_response(500, {"error": str(e)})
             
+    # ==========================================
+    # MODO 3: RESULTADO DE UNA QUERY ASÍNCRONA
+    # ==========================================
+    elif mode == "result":
+        qid = params.get("query_id", "")
+        next_token = params.get("next_token")
+        page_size_raw = params.get("page_size", str(ATHENA_PAGE_SIZE))
+
+        if not _QUERY_ID.match(qid):
+            return make_response(400, {"error": "Falta o es inválido el parámetro 'query_id'"})
+
+        try:
+            page_size = max(1, min(int(page_size_raw), ATHENA_MAX_ROWS))
+        except ValueError:
+            return make_response(400, {"error": "page_size debe ser un número entero"})
+
+        try:
+            fmt = parse_format(params.get("format"))
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
+
+        try:
+            state, reason = get_query_state(qid)
+            if state in ("QUEUED", "RUNNING"):
+                return make_response(202, {"mode": "result", "query_id": qid, "state": state})
+            if state != "SUCCEEDED":
+                return make_response(500, {"mode": "result", "query_id": qid, "state": state, "error": reason})
+
+            result = fetch_query_results(qid, next_token=next_token, max_rows=page_size)
+            return make_response(200, {
+                "mode": "result",
+                "query_id": qid,
+                "state": state,
+                "result": shape_result(result, fmt=fmt)
+            })
+        except ClientError as e:
+            return make_response(400, {"error": str(e)})
+        except Exception as e:
+            return make_response(500, {"error": str(e)})
+
+    # ==========================================
+    # MODO 4: ESTADÍSTICAS DE OCUPACIÓN (agregados, sin Athena)
+    # ==========================================
+    elif mode == "stats":
+        granularity = params.get("granularity", "hour").lower()
+        date = params.get("date")
+        time_from = params.get("from")
+        time_to = params.get("to")
+        sensor_id = params.get("sensor_id")
+
+        if date:
+            time_from, time_to = date, date
+        elif time_to and not time_from:
+            return make_response(400, {"error": "El parámetro 'to' requiere 'from'"})
+        today = datetime.utcnow().strftime("%Y-%m-%d")
+
+        try:
+            fields = parse_fields(params.get("fields"), HOUR_STATS_COLUMNS if granularity == "hour" else DAY_STATS_COLUMNS)
+            fmt = parse_format(params.get("format"))
+            result = read_stats(granularity, time_from or today, time_to or today, sensor_id=sensor_id, lot_id=lot_id)
+            return make_response(200, {
+                "mode": "stats",
+                "lot": lot_id,
+                "source": "dynamodb",
+                "granularity": granularity,
+                "result": shape_result(result, fields, fmt)
+            })
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
+        except Exception as e:
+            return make_response(500, {"error": str(e)})
+
+    # ==========================================
+    # MODO 5: FEED DE CAMBIOS (el dashboard solo descarga las plazas que cambian)
+    # ==========================================
+    elif mode == "changes":
+        since_raw = params.get("since")
+
+        try:
+            since = int(since_raw) if since_raw else None
+            if since is not None and since < 0:
+                raise ValueError
+        except ValueError:
+            return make_response(400, {"error": "El parámetro 'since' debe ser una versión (entero >= 0)"})
+
+        try:
+            fields = parse_fields(params.get("fields"), GOLD_COLUMNS)
+            fmt = parse_format(params.get("format"))
+
+            # Sin cambios desde la versión del cliente: solo se ha leído un item
+            version = read_state_version(lot_id)
+            etag = make_etag(lot_id, version)
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if etag_matches(request_header(event, "If-None-Match"), etag):
+                return make_response(304, None, headers)
+
+            if since is not None and since > version:
+                since = None  # Cliente por delante (contador reiniciado): instantánea completa
+            if since == version:
+                result = {"columns": [], "rows": []}
+            else:
+                result = read_latest_status(device_id=None, lot_id=lot_id, since_version=since, consistent=True)
+            return make_response(200, {
+                "mode": "changes",
+                "lot": lot_id,
+                "version": version,
+                "since": since,
+                "full": since is None,
+                "source": "dynamodb",
+                "result": shape_result(result, fields, fmt)
+            }, headers)
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
+        except Exception as e:
+            return make_response(500, {"error": str(e)})
+
+    # ==========================================
+    # MODO 6: PANEL DEL DASHBOARD (varias vistas, queries de Athena en paralelo)
+    # ==========================================
+    elif mode == "dashboard":
+        device_id = params.get("device_id")
+        date = params.get("date")
+        time_from = params.get("from")
+        time_to = params.get("to")
+        cursor = params.get("cursor")
+
+        try:
+            limit = max(1, min(int(params.get("limit", "100")), 1000))
+        except ValueError:
+            return make_response(400, {"error": "El límite (limit) debe ser un número entero"})
+
+        try:
+            views = parse_views(params.get("views"))
+            fmt = parse_format(params.get("format"))
+
+            panels = {}
+            queries = {}  # Vista -> SQL que hay que lanzar en Athena
+            if "latest" in views:
+                # Estado materializado; Athena solo si el parking aún no tiene registros
+                result = latest_status_from_store(device_id=device_id, lot_id=lot_id)
+                if result is not None:
+                    panels["latest"] = {"source": "dynamodb", "result": result}
+                else:
+                    queries["latest"] = build_latest_status_query(device_id=device_id, lot=lot)
+            if "history" in views:
+                # Una fila de más para saber si hay otra página (como en mode=filters)
+                queries["history"] = build_filtered_query(device_id=device_id, date=date, limit=limit + 1,
+                                                          time_from=time_from, time_to=time_to, lot=lot, cursor=cursor)
+            if "violations" in views:
+                queries["violations"] = build_violations_query(lot)
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
+
+        try:
+            # Todas las queries a la vez: la página espera a la más lenta, no a la suma de todas
+            outcomes = cached_athena_queries(list(queries.values()), lot_id)
+            for view, (result, cache_hit) in zip(queries, outcomes):
+                if isinstance(result, Exception):
+                    # Una vista que falla no tumba las demás
+                    print(f"Error en la vista {view}: {result}")
+                    panels[view] = {"error": str(result)}
+                    continue
+                if view == "history":
+                    result = paginate(result, limit)
+                panels[view] = {"source": "cache" if cache_hit else "athena", "result": result}
+
+            for panel in panels.values():
+                if "result" in panel:
+                    panel["result"] = shape_result(panel["result"], fmt=fmt)
+            status_code = 500 if all("error" in panel for panel in panels.values()) else 200
+            return make_response(status_code, {
+                "mode": "dashboard",
+                "lot": lot_id,
+                "views": {view: panels[view] for view in views}
+            })
+        except Exception as e:
+            return make_response(500, {"error": str(e)})
+
     # ==========================================
     # MODO DESCONOCIDO
     # ==========================================
     else:
-        return make_response(400, {"error": f"Modo '{mode}' desconocido. Usa 'llm' o 'filters'."})
\ No newline at end of file
+        return make_response(400, {"error": f"Modo '{mode}' desconocido. Usa 'llm', 'filters', 'result', 'stats', 'changes' o 'dashboard'."})
\ No newline at end of file
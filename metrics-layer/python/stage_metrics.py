@@ -0,0 +1,154 @@
+"""
+Per-stage timings and counters for the parking Lambdas, emitted as one
+CloudWatch Embedded Metric Format (EMF) log line per invocation.
+
+CloudWatch turns the line into metrics automatically (no PutMetricData calls),
+and the non-metric fields (request ID, sampled rate) stay searchable in Logs
+Insights.
+
+Usage in a Lambda:
+
+    from stage_metrics import StageMetrics
+    metrics = StageMetrics("data-processing")
+
+    @metrics.handler
+    def lambda_handler(event, context):
+        with metrics.stage("s3_get"):
+            ...
+        metrics.count("readings", len(readings))
+        metrics.value("athena_bytes_scanned", 1234, "Bytes")
+        metrics.observe("record_latency", 85.0)
+
+Only a fraction of the invocations is measured (METRICS_SAMPLE_RATE, default
+1.0; 0 disables it). In the others every call is a no-op, so hot paths can stay
+instrumented.
+"""
+import functools
+import json
+import os
+import random
+import time
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "ParkingPipeline")
+# CloudWatch accepts at most 100 values per metric in one EMF record
+MAX_VALUES_PER_METRIC = 100
+
+class _NoOpStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NO_OP_STAGE = _NoOpStage()
+
+class _Stage:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.add_time(self.name, (time.perf_counter() - self.start) * 1000.0)
+        return False
+
+class StageMetrics:
+    def __init__(self, function_name, sample_rate=None):
+        self.function_name = function_name
+        self.sample_rate = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0")) if sample_rate is None else sample_rate
+        self.sampled = False
+        self._reset()
+
+    def _reset(self):
+        self.timings = {}   # stage -> total ms
+        self.counters = {}  # name -> (value, unit)
+        self.samples = {}   # name -> [values] (per-record distributions)
+        self.properties = {}
+
+    # -----------------------------
+    # Recording
+    # -----------------------------
+    def stage(self, name):
+        """Context manager adding the elapsed time to `<name>_ms` (repeated stages are summed)."""
+        return _Stage(self, name) if self.sampled else _NO_OP_STAGE
+
+    def add_time(self, name, elapsed_ms):
+        if self.sampled:
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed_ms
+
+    def count(self, name, amount=1):
+        if self.sampled:
+            value, unit = self.counters.get(name, (0, "Count"))
+            self.counters[name] = (value + amount, unit)
+
+    def value(self, name, value, unit="None"):
+        """Sets a single value for this invocation (last write wins)."""
+        if self.sampled and value is not None:
+            self.counters[name] = (value, unit)
+
+    def observe(self, name, value):
+        """Adds one value (milliseconds) to a per-record distribution."""
+        if self.sampled:
+            self.samples.setdefault(name, []).append(value)
+
+    def set_property(self, name, value):
+        if self.sampled:
+            self.properties[name] = value
+
+    # -----------------------------
+    # Invocation lifecycle
+    # -----------------------------
+    def begin(self, context=None):
+        self._reset()
+        self.sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        if self.sampled and context is not None:
+            self.properties["RequestId"] = getattr(context, "aws_request_id", None)
+
+    def flush(self):
+        """Prints the EMF record of the invocation (nothing when it was not sampled)."""
+        if not self.sampled:
+            return
+        record = dict(self.properties)
+        definitions = []
+
+        for name, total in self.timings.items():
+            record[f"{name}_ms"] = round(total, 3)
+            definitions.append({"Name": f"{name}_ms", "Unit": "Milliseconds"})
+        for name, (value, unit) in self.counters.items():
+            record[name] = value
+            definitions.append({"Name": name, "Unit": unit})
+        for name, values in self.samples.items():
+            if len(values) > MAX_VALUES_PER_METRIC:
+                step = len(values) / MAX_VALUES_PER_METRIC
+                values = [values[int(i * step)] for i in range(MAX_VALUES_PER_METRIC)]
+            record[f"{name}_ms"] = [round(v, 3) for v in values]
+            definitions.append({"Name": f"{name}_ms", "Unit": "Milliseconds"})
+
+        record["Function"] = self.function_name
+        record["SampleRate"] = self.sample_rate
+        record["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": NAMESPACE,
+                "Dimensions": [["Function"]],
+                "Metrics": definitions,
+            }],
+        }
+        print(json.dumps(record, default=str))
+        self.sampled = False
+
+    def handler(self, func):
+        """Decorator for lambda_handler: starts the measurement, times the whole call and flushes it."""
+        @functools.wraps(func)
+        def wrapper(event, context):
+            self.begin(context)
+            start = time.perf_counter()
+            try:
+                return func(event, context)
+            finally:
+                self.add_time("total", (time.perf_counter() - start) * 1000.0)
+                self.flush()
+        return wrapper
@@ -1,10 +1,31 @@
 import json
+import base64
 import boto3
 import os
+import re
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
 from botocore.exceptions import ClientError
+from stage_metrics import StageMetrics
 
 dynamodb = boto3.resource('dynamodb')
 
+# Per-stage timings (metrics layer)
+metrics = StageMetrics('modify-state')
+
+VALID_STATES = ['AVAILABLE', 'BOOKED', 'MAINTENANCE']
+
+# TransactWriteItems accepts at most 100 actions: 99 spots plus the METADATA counter
+TRANSACT_MAX_SPOTS = 99
+BATCH_GET_MAX_KEYS = 100
+# How many times a chunk is retried when a spot changed between the read and the write
+MAX_CONFLICT_RETRIES = 3
+
+# Lot names as they appear in LotID ('LOT#<name>'), Gold partitions and MQTT topics
+LOT_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_\-.]+$')
+
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
 # Helper for CORS
 def make_response(status_code, body_dict):
     return {
@@ -17,73 +38,228 @@ def make_response(status_code, body_dict):
         "body": json.dumps(body_dict)
     }
 
+def build_spot_update(change):
+    """Returns (UpdateExpression, ExpressionAttributeValues) for one spot change."""
+    new_state = change['state']
+    update_expr = "SET ReservationState = :s"
+    expr_attr_vals = {':s': new_state}
+
+    # Add optional booking details if provided, or remove them if freeing the spot
+    if new_state == "BOOKED":
+        if change.get('license_plate'):
+            update_expr += ", LicensePlate = :lp"
+            expr_attr_vals[':lp'] = change['license_plate']
+        if change.get('booked_until'):
+            update_expr += ", BookedUntil = :bu"
+            expr_attr_vals[':bu'] = change['booked_until']
+    elif new_state in ["AVAILABLE", "MAINTENANCE"]:
+        # If freeing or breaking the spot, explicitly clear the booking data
+        update_expr += " REMOVE LicensePlate, BookedUntil"
+
+    return update_expr, expr_attr_vals
+
+def repair_modifier(old_state, new_state):
+    """+1 when a spot breaks, -1 when it is fixed, 0 otherwise."""
+    if new_state == "MAINTENANCE" and old_state != "MAINTENANCE":
+        return 1
+    if old_state == "MAINTENANCE" and new_state != "MAINTENANCE":
+        return -1
+    return 0
+
+def validate_change(change):
+    """Returns an error message for an invalid spot change, or None."""
+    if not isinstance(change, dict) or not change.get("sensor_id") or not change.get("state"):
+        return "Missing required fields: 'sensor_id' and 'state'"
+    if change["state"] not in VALID_STATES:
+        return f"Invalid state: {change['state']}"
+    return None
+
+def resolve_lot_id(body, default_lot_id):
+    """Lot targeted by the request: its optional 'lot' ('north' or 'LOT#north'), or the deployment default."""
+    lot = body.get("lot")
+    if lot is None:
+        return default_lot_id
+    name = lot[len("LOT#"):] if isinstance(lot, str) and lot.startswith("LOT#") else lot
+    if not isinstance(name, str) or not LOT_NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid lot: {lot}")
+    return f"LOT#{name}"
+
+def update_single_spot(table, lot_id, change):
+    """One spot: the same one-item transaction as bulk mode, so the spot and its METADATA counter change together."""
+    with metrics.stage('dynamodb_read'):
+        known_states = read_spot_states(table.name, lot_id, [change['sensor_id']])
+    apply_chunk(table.name, lot_id, [change], known_states)
+    return known_states[change['sensor_id']] or 'AVAILABLE'
+
+def read_spot_states(table_name, lot_id, sensor_ids):
+    """Current ReservationState of each spot with BatchGetItem (None when the spot has no item yet)."""
+    states = {sensor_id: None for sensor_id in sensor_ids}
+    for i in range(0, len(sensor_ids), BATCH_GET_MAX_KEYS):
+        request = {table_name: {
+            'Keys': [{'LotID': lot_id, 'EntityID': f'SPOT#{sensor_id}'} for sensor_id in sensor_ids[i:i + BATCH_GET_MAX_KEYS]],
+            'ProjectionExpression': 'EntityID, ReservationState'
+        }}
+        while request:
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(table_name, []):
+                states[item['EntityID'][len('SPOT#'):]] = item.get('ReservationState', 'AVAILABLE')
+            request = response.get('UnprocessedKeys') or {}
+    return states
+
+def build_transaction(table_name, lot_id, chunk, known_states):
+    """One TransactWriteItems request: every spot guarded by its expected old state, plus one aggregated ADD."""
+    actions = []
+    repair_delta = 0
+
+    for change in chunk:
+        old_state = known_states[change['sensor_id']]
+        update_expr, expr_attr_vals = build_spot_update(change)
+        if old_state is None:
+            condition = "attribute_not_exists(ReservationState)"
+        else:
+            condition = "ReservationState = :old"
+            expr_attr_vals[':old'] = old_state
+        actions.append({'Update': {
+            'TableName': table_name,
+            'Key': {'LotID': {'S': lot_id}, 'EntityID': {'S': f'SPOT#{change["sensor_id"]}'}},
+            'UpdateExpression': update_expr,
+            'ConditionExpression': condition,
+            'ExpressionAttributeValues': {k: serializer.serialize(v) for k, v in expr_attr_vals.items()},
+            'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+        }})
+        repair_delta += repair_modifier(old_state or 'AVAILABLE', change['state'])
+
+    if repair_delta != 0:
+        actions.append({'Update': {
+            'TableName': table_name,
+            'Key': {'LotID': {'S': lot_id}, 'EntityID': {'S': 'METADATA'}},
+            'UpdateExpression': "ADD SpotsUnderRepair :val",
+            'ExpressionAttributeValues': {':val': {'N': str(repair_delta)}}
+        }})
+
+    return actions, repair_delta
+
+def apply_chunk(table_name, lot_id, chunk, known_states):
+    """Applies one chunk atomically. Returns its repair delta."""
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        actions, repair_delta = build_transaction(table_name, lot_id, chunk, known_states)
+        try:
+            with metrics.stage('transact_write'):
+                dynamodb.meta.client.transact_write_items(TransactItems=actions)
+            return repair_delta
+        except ClientError as e:
+            reasons = e.response.get('CancellationReasons', [])
+            conflicts = [r for r in reasons if r.get('Code') == 'ConditionalCheckFailed']
+            if not conflicts or attempt == MAX_CONFLICT_RETRIES:
+                raise
+            # A spot changed since it was read: take its real old state from the failure and retry
+            for change, reason in zip(chunk, reasons):
+                if reason.get('Code') == 'ConditionalCheckFailed':
+                    old_item = {k: deserializer.deserialize(v) for k, v in reason.get('Item', {}).items()}
+                    known_states[change['sensor_id']] = old_item.get('ReservationState', 'AVAILABLE') if old_item else None
+            print(f"[DEBUG] {len(conflicts)} spots changed concurrently, retrying chunk (attempt {attempt + 1})")
+            metrics.count('transaction_conflicts')
+
+def update_bulk(table, lot_id, changes):
+    """
+    Applies a list of spot changes in chunks of TRANSACT_MAX_SPOTS, each one atomic.
+    Returns (results, repair_delta, failure): if a chunk fails, the chunks before it stay applied and
+    failure holds the error and the sensor_ids that were not changed (that chunk and the ones after it).
+    """
+    sensor_ids = [change['sensor_id'] for change in changes]
+    with metrics.stage('dynamodb_read'):
+        known_states = read_spot_states(table.name, lot_id, sensor_ids)
+    results = []
+    repair_delta = 0
+
+    for i in range(0, len(changes), TRANSACT_MAX_SPOTS):
+        chunk = changes[i:i + TRANSACT_MAX_SPOTS]
+        try:
+            repair_delta += apply_chunk(table.name, lot_id, chunk, known_states)
+        except Exception as e:
+            if not results:
+                raise  # Nothing was applied: a plain error, the request can be retried as is
+            print(f"Error updating chunk {i // TRANSACT_MAX_SPOTS + 1}: {str(e)}")
+            failure = {"error": "Internal server error updating state.", "sensor_ids": sensor_ids[i:]}
+            return results, repair_delta, failure
+        results += [
+            {"sensor_id": change['sensor_id'], "state": change['state'],
+             "previous_state": known_states[change['sensor_id']] or 'AVAILABLE'}
+            for change in chunk
+        ]
+
+    return results, repair_delta, None
+
+@metrics.handler
 def lambda_handler(event, context):
     # Handle CORS Preflight
     if event.get("httpMethod") == "OPTIONS":
         return make_response(200, {"ok": True})
 
     table_name = os.environ.get('DYNAMODB_TABLE_NAME', 'ParkingLotState')
-    lot_id = os.environ.get('LOT_ID', 'LOT#pi-zone-A')
+    default_lot_id = os.environ.get('LOT_ID', 'LOT#pi-zone-A')
     table = dynamodb.Table(table_name)
 
     try:
-        # Parse the incoming JSON body from API Gateway
-        body = json.loads(event.get("body", "{}"))
-        sensor_id = body.get("sensor_id")
-        new_state = body.get("state") # 'AVAILABLE', 'BOOKED', or 'MAINTENANCE'
-        
-        # Optional fields for booking
-        license_plate = body.get("license_plate", None)
-        booked_until = body.get("booked_until", None)
-
-        if not sensor_id or not new_state:
-            return make_response(400, {"error": "Missing required fields: 'sensor_id' and 'state'"})
-
-        if new_state not in ['AVAILABLE', 'BOOKED', 'MAINTENANCE']:
-            return make_response(400, {"error": f"Invalid state: {new_state}"})
-
-        # 1. Fetch current spot state to see if we are entering or leaving MAINTENANCE
-        current_spot = table.get_item(Key={'LotID': lot_id, 'EntityID': f'SPOT#{sensor_id}'}).get('Item', {})
-        old_state = current_spot.get('ReservationState', 'AVAILABLE')
-
-        # 2. Update the specific Spot
-        update_expr = "SET ReservationState = :s"
-        expr_attr_vals = {':s': new_state}
-        
-        # Add optional booking details if provided, or remove them if freeing the spot
-        if new_state == "BOOKED":
-            if license_plate:
-                update_expr += ", LicensePlate = :lp"
-                expr_attr_vals[':lp'] = license_plate
-            if booked_until:
-                update_expr += ", BookedUntil = :bu"
-                expr_attr_vals[':bu'] = booked_until
-        elif new_state in ["AVAILABLE", "MAINTENANCE"]:
-            # If freeing or breaking the spot, explicitly clear the booking data
-            update_expr += " REMOVE LicensePlate, BookedUntil"
-
-        table.update_item(
-            Key={'LotID': lot_id, 'EntityID': f'SPOT#{sensor_id}'},
-            UpdateExpression=update_expr,
-            ExpressionAttributeValues=expr_attr_vals
-        )
-
-        # 3. Handle METADATA math if MAINTENANCE state changed
-        repair_modifier = 0
-        if new_state == "MAINTENANCE" and old_state != "MAINTENANCE":
-            repair_modifier = 1  # Spot broke
-        elif old_state == "MAINTENANCE" and new_state != "MAINTENANCE":
-            repair_modifier = -1 # Spot fixed
-
-        if repair_modifier != 0:
-            table.update_item(
-                Key={'LotID': lot_id, 'EntityID': 'METADATA'},
-                UpdateExpression="ADD SpotsUnderRepair :val",
-                ExpressionAttributeValues={':val': repair_modifier}
-            )
+        # Parse the incoming JSON body from API Gateway (base64 if the API has binary media types)
+        raw_body = event.get("body") or "{}"
+        if event.get("isBase64Encoded"):
+            raw_body = base64.b64decode(raw_body).decode("utf-8")
+        body = json.loads(raw_body)
+        if not isinstance(body, dict):
+            return make_response(400, {"error": "Invalid JSON body payload."})
+        try:
+            lot_id = resolve_lot_id(body, default_lot_id)
+        except ValueError as e:
+            return make_response(400, {"error": str(e)})
+
+        # Bulk mode: {"changes": [{"sensor_id": ..., "state": ...}, ...]}
+        if "changes" in body:
+            changes = body["changes"]
+            max_changes = int(os.environ.get('MAX_BULK_CHANGES', '500'))
+
+            if not isinstance(changes, list) or not changes:
+                return make_response(400, {"error": "'changes' must be a non-empty list"})
+            if len(changes) > max_changes:
+                return make_response(400, {"error": f"At most {max_changes} changes per request"})
+            for change in changes:
+                error = validate_change(change)
+                if error:
+                    return make_response(400, {"error": error, "change": change})
+            sensor_ids = [change["sensor_id"] for change in changes]
+            if len(set(sensor_ids)) != len(sensor_ids):
+                return make_response(400, {"error": "Each sensor_id can appear only once per request"})
+
+            results, repair_delta, failure = update_bulk(table, lot_id, changes)
+            metrics.count('spots_updated', len(results))
+            if failure:
+                # Partial success: the client learns which spots changed and which ones to send again
+                metrics.count('bulk_partial_failures')
+                return make_response(207, {
+                    "message": f"Updated {len(results)} of {len(changes)} spots",
+                    "lot": lot_id,
+                    "updated": results,
+                    "repair_delta": repair_delta,
+                    "failed": failure
+                })
+            return make_response(200, {
+                "message": f"Successfully updated {len(results)} spots",
+                "lot": lot_id,
+                "updated": results,
+                "repair_delta": repair_delta
+            })
+
+        # 'state' is 'AVAILABLE', 'BOOKED', or 'MAINTENANCE'; license_plate and booked_until are optional
+        error = validate_change(body)
+        if error:
+            return make_response(400, {"error": error})
+
+        old_state = update_single_spot(table, lot_id, body)
+        metrics.count('spots_updated')
 
         return make_response(200, {
-            "message": f"Successfully updated {sensor_id} to {new_state}",
+            "message": f"Successfully updated {body['sensor_id']} to {body['state']}",
+            "lot": lot_id,
             "previous_state": old_state
         })
 